@@ -1,7 +1,20 @@
+import argparse
 import os
+import random
+import tempfile
 import timeit
 from collections import deque
 
+from duplicate_files_in_folders.file_manager import FileManager
+
+
+# Benchmark of deleting empty folders after moving duplicates out of a large scan folder.
+# A deterministic tree is generated for every run, then the files of a few folders are deleted - as if they were
+# moved - and each method deletes the folders that became empty:
+# - walk: FileManager.delete_empty_folders_in_tree() - os.walk(topdown=False) and os.listdir() on every folder
+# - scandir: list all the folders with a scandir BFS, then try to delete them bottom-up
+# - targeted: FileManager.delete_empty_folders() - only the folders files were moved out of, and their parents
+
 
 def list_directories_bottom_up(directory, raise_on_permission_error=False):
     stack = []
@@ -23,31 +36,93 @@ def list_directories_bottom_up(directory, raise_on_permission_error=False):
                 continue
 
     # Return directories in bottom-up order
-    # while stack:
-    #     yield stack.pop()
-    return stack
+    return stack[::-1]
 
 
-def list_directories_bottom_up_walk(base_path):
-    folders_by_depth = {}  # collect all folders in the scan_dir folder by depth
-    for root, dirs, files in os.walk(base_path, topdown=False):
-        if base_path == root:
+def delete_empty_folders_scandir(base_path, moved_from_dirs):
+    deleted_folders = 0
+    for folder in list_directories_bottom_up(base_path):
+        try:
+            os.rmdir(folder)
+            deleted_folders += 1
+        except OSError:
             continue
-        depth = root.count(os.sep) - base_path.count(os.sep)
-        if depth not in folders_by_depth:
-            folders_by_depth[depth] = []
-        folders_by_depth[depth].append(root)
-    return folders_by_depth
+    return deleted_folders
+
+
+def delete_empty_folders_walk(base_path, moved_from_dirs):
+    return FileManager.get_instance().delete_empty_folders_in_tree(base_path)
+
+
+def delete_empty_folders_targeted(base_path, moved_from_dirs):
+    return FileManager.get_instance().delete_empty_folders(base_path, moved_from_dirs)
+
+
+BENCHMARKED_FUNCTIONS = {
+    'walk': delete_empty_folders_walk,
+    'scandir': delete_empty_folders_scandir,
+    'targeted': delete_empty_folders_targeted,
+}
+
+
+def create_test_tree(base_dir, depth=3, subdirs_per_dir=8, files_per_dir=2):
+    """
+    Create a directory tree for the benchmark - files are empty, only the number of folders matters.
+    :return: list of the leaf folders
+    """
+    level_dirs = [base_dir]
+    for level in range(depth + 1):
+        next_level_dirs = []
+        for current_dir in level_dirs:
+            os.makedirs(current_dir, exist_ok=True)
+            for i in range(files_per_dir):
+                open(os.path.join(current_dir, f"file_{i}.bin"), 'wb').close()
+            if level < depth:
+                next_level_dirs.extend(os.path.join(current_dir, f"dir_{j}") for j in range(subdirs_per_dir))
+        if level < depth:
+            level_dirs = next_level_dirs
+    return level_dirs
+
+
+def empty_folders(leaf_dirs, emptied, seed=42):
+    """
+    Delete the files of random leaf folders, as if they were moved.
+    :return: the folders the files were deleted from
+    """
+    moved_from_dirs = random.Random(seed).sample(leaf_dirs, min(emptied, len(leaf_dirs)))
+    for folder in moved_from_dirs:
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+    return moved_from_dirs
+
+
+def compare_performance(iterations, depth, subdirs, files, emptied):
+    for name, func in BENCHMARKED_FUNCTIONS.items():
+        durations, deleted_folders = [], set()
+        for _ in range(iterations):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                FileManager.reset_file_manager([], [temp_dir], run_mode=True)
+                leaf_dirs = create_test_tree(temp_dir, depth, subdirs, files)
+                moved_from_dirs = empty_folders(leaf_dirs, emptied)
+                durations.append(timeit.timeit(lambda: deleted_folders.add(func(temp_dir, moved_from_dirs)), number=1))
+        assert len(deleted_folders) == 1, f"{name} deleted a different number of folders in different runs"
+        print(f"Average function {name} duration: {sum(durations) / iterations:.4f} seconds "
+              f"(min {min(durations):.4f}), deleted {deleted_folders.pop()} folders")
 
 
-test_directory = 'path/to/directory'
-num = 1000
-scan_time = timeit.timeit(lambda: list_directories_bottom_up(test_directory), number=num)
-walk_time = timeit.timeit(lambda: list_directories_bottom_up_walk(test_directory), number=num)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark deleting the empty folders left after moving files.")
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--subdirs', type=int, default=8)
+    parser.add_argument('--files', type=int, default=2, help='Number of files in each generated folder.')
+    parser.add_argument('--emptied', type=int, default=10, help='Number of leaf folders files are moved out of.')
+    benchmark_args = parser.parse_args()
 
-print(f"list_directories_bottom_up: {scan_time:.6f} seconds")
-print(f"list_directories_bottom_up_walk: {walk_time:.6f} seconds")
+    compare_performance(benchmark_args.iterations, benchmark_args.depth, benchmark_args.subdirs, benchmark_args.files,
+                        benchmark_args.emptied)
 
-# Sample output:
-#  list_directories_bottom_up: 104.569966 seconds
-#  list_directories_bottom_up_walk: 113.394339 seconds
+# Sample output (--depth 4 - a tree of 4,681 folders, files moved out of 10 of them):
+# Average function walk duration: 0.0981 seconds (min 0.0910), deleted 10 folders
+# Average function scandir duration: 0.0692 seconds (min 0.0475), deleted 10 folders
+# Average function targeted duration: 0.0068 seconds (min 0.0016), deleted 10 folders
@@ -1,10 +1,15 @@
+import argparse
 import os
+import random
+import tempfile
 import time
 import concurrent.futures
 from pathlib import Path
 import timeit
 from collections import deque
 
+from duplicate_files_in_folders.file_manager import FileManager
+
 
 class FileInformation:
     def __init__(self, path, size, modified_time, created_time):
@@ -216,53 +221,83 @@ def get_files_and_stats_v9_scandir_deque_generic(directory):
             continue
     return files_stats
 
-def compare_performance(directory, iterations=5):
-    durations_v2 = []
-    durations_v3 = []
-    durations_v6 = []
-    durations_v7 = []
-    durations_v8 = []
-    durations_v9 = []
-    original_durations = []
-
-    for _ in range(iterations):
-        original_durations.append(timeit.timeit(lambda: get_files_and_stats(directory), number=1))
-        durations_v2.append(timeit.timeit(lambda: get_files_and_stats_v2_oswalk_tpe_generic(directory), number=1))
-        durations_v3.append(timeit.timeit(lambda: get_files_and_stats_v3_oswalk_tpe_class(directory), number=1))
-        durations_v6.append(timeit.timeit(lambda: get_files_and_stats_v6_scandir_tpe_stack_class(directory), number=1))
-        durations_v7.append(timeit.timeit(lambda: get_files_and_stats_v7_scandir_tpe_stack_generic(directory), number=1))
-        durations_v8.append(timeit.timeit(lambda: get_files_and_stats_v8_scandir_tpe_deque_generic(directory), number=1))
-        durations_v9.append(timeit.timeit(lambda: get_files_and_stats_v9_scandir_deque_generic(directory), number=1))
-
-    # Candidate for the best result
-    avg_original_duration = sum(original_durations) / iterations
-    avg_optimized_duration_v2 = sum(durations_v2) / iterations
-    avg_optimized_duration_v3 = sum(durations_v3) / iterations
-    avg_optimized_duration_v6 = sum(durations_v6) / iterations
-    avg_optimized_duration_v7 = sum(durations_v7) / iterations
-    avg_optimized_duration_v8 = sum(durations_v8) / iterations
-    avg_optimized_duration_v9 = sum(durations_v9) / iterations
-
-    print(f"Average original function duration: {avg_original_duration:.2f} seconds")
-    print(f"Average function v2 (oswalk, tpe, generic) duration: {avg_optimized_duration_v2:.2f} seconds")
-    print(f"Average function v3 (oswalk, tpe, class) duration: {avg_optimized_duration_v3:.2f} seconds")
-    print(f"Average function v6 (scandir, tpe, stack, class) duration: {avg_optimized_duration_v6:.2f} seconds")
-    print(f"Average function v7 (scandir, tpe, stack, generic) duration: {avg_optimized_duration_v7:.2f} seconds")
-    print(f"Average function v8 (scandir, tpe, deque, generic) duration: {avg_optimized_duration_v8:.2f} seconds")
-    print(f"Average function v9 (scandir, deque, generic) duration: {avg_optimized_duration_v9:.2f} seconds")
+def get_files_and_stats_v10_file_manager(directory):
+    return FileManager.get_files_and_stats(directory)
+
+
+def get_files_and_stats_v11_file_manager_parallel(directory, max_workers=8):
+    return FileManager.get_files_and_stats_parallel([directory], max_workers)[0]
+
+
+BENCHMARKED_FUNCTIONS = {
+    "original (oswalk)": get_files_and_stats,
+    "v2 (oswalk, tpe, generic)": get_files_and_stats_v2_oswalk_tpe_generic,
+    "v3 (oswalk, tpe, class)": get_files_and_stats_v3_oswalk_tpe_class,
+    "v6 (scandir, tpe, stack, class)": get_files_and_stats_v6_scandir_tpe_stack_class,
+    "v7 (scandir, tpe, stack, generic)": get_files_and_stats_v7_scandir_tpe_stack_generic,
+    "v8 (scandir, tpe, deque, generic)": get_files_and_stats_v8_scandir_tpe_deque_generic,
+    "v9 (scandir, deque, generic)": get_files_and_stats_v9_scandir_deque_generic,
+    "v10 (FileManager.get_files_and_stats)": get_files_and_stats_v10_file_manager,
+    "v11 (FileManager.get_files_and_stats_parallel, 8 workers)": get_files_and_stats_v11_file_manager_parallel,
+}
+
+
+def create_test_tree(base_dir, depth=3, subdirs_per_dir=4, files_per_dir=20, seed=42):
+    """
+    Create a deterministic directory tree for the benchmark, so results can be reproduced between runs and machines.
+    :return: number of files created
+    """
+    rnd = random.Random(seed)
+    files_created = 0
+    level_dirs = [base_dir]
+    for level in range(depth + 1):
+        next_level_dirs = []
+        for current_dir in level_dirs:
+            os.makedirs(current_dir, exist_ok=True)
+            for i in range(files_per_dir):
+                with open(os.path.join(current_dir, f"file_{i}.bin"), 'wb') as f:
+                    f.write(rnd.randbytes(rnd.randint(0, 4096)))
+                files_created += 1
+            if level < depth:
+                next_level_dirs.extend(os.path.join(current_dir, f"dir_{j}") for j in range(subdirs_per_dir))
+        level_dirs = next_level_dirs
+    return files_created
 
 
-if __name__ == "__main__":
-    test_directory = "DEFINE DIRECTORY_FOR_TESTING"
-    compare_performance(test_directory, 3)
+def compare_performance(directory, iterations=5):
+    expected_paths = sorted(str(file_info['path']) for file_info in get_files_and_stats(directory))
+    for name, func in BENCHMARKED_FUNCTIONS.items():
+        result = func(directory)
+        paths = sorted(str(file_info.path if isinstance(file_info, FileInformation) else file_info['path'])
+                       for file_info in result)
+        assert paths == expected_paths, f"{name} returned a different list of files"
+
+    for name, func in BENCHMARKED_FUNCTIONS.items():
+        durations = [timeit.timeit(lambda: func(directory), number=1) for _ in range(iterations)]
+        print(f"Average function {name} duration: {sum(durations) / iterations:.3f} seconds "
+              f"(min {min(durations):.3f})")
 
-    sample_output = False
-    if sample_output:
-        res = get_files_and_stats_v9_scandir_deque_generic(test_directory)
-        for file_res in res:
-            print(file_res)
 
-# Sample output:
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark directory tree listing methods.")
+    parser.add_argument('--directory', help='Directory to benchmark. Default is a generated tree in a temp folder.')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--subdirs', type=int, default=4)
+    parser.add_argument('--files', type=int, default=20, help='Number of files in each generated folder.')
+    parser.add_argument('--seed', type=int, default=42)
+    benchmark_args = parser.parse_args()
+
+    if benchmark_args.directory:
+        compare_performance(benchmark_args.directory, benchmark_args.iterations)
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            total_files = create_test_tree(temp_dir, benchmark_args.depth, benchmark_args.subdirs,
+                                           benchmark_args.files, benchmark_args.seed)
+            print(f"Generated test tree with {total_files} files in {temp_dir}")
+            compare_performance(temp_dir, benchmark_args.iterations)
+
+# Sample output (real directory, before the parallel walker was added):
 # Average original function duration: 5.09 seconds
 # Average function v2 (oswalk, tpe, generic) duration: 3.28 seconds
 # Average function v3 (oswalk, tpe, class) duration: 3.91 seconds
@@ -1,37 +1,116 @@
 # Identifies and processes duplicate files between a scan_dir and reference directory.
 # https://github.com/niradar/duplicate_files_in_folders
 
-from duplicate_files_in_folders.duplicates_finder import find_duplicates_files_v3, process_duplicates, \
-    clean_scan_dir_duplications, create_csv_file
-from duplicate_files_in_folders.initializer import setup_logging, setup_hash_manager, setup_file_manager
+import logging
+import sys
+
+from duplicate_files_in_folders.action_plan import ActionPlanWriter, apply_action_plan, undo_action_plan
+from duplicate_files_in_folders.duplicates_finder import iter_duplicates, iter_duplicate_batches, \
+    merge_duplicate_groups, process_duplicate_batches, create_csv_file, link_duplicates
+from duplicate_files_in_folders.initializer import setup_logging, setup_hash_manager, setup_file_manager, \
+    setup_tree_snapshot, setup_job_state, setup_metrics, setup_profiler
+from duplicate_files_in_folders.job_state import JobStateError
+from duplicate_files_in_folders.metrics import MetricsCollector
+from duplicate_files_in_folders.reference_manifest import export_reference_manifest, get_manifest_file_path
 from duplicate_files_in_folders.utils import parse_arguments
 from duplicate_files_in_folders.utils_io import display_initial_config, output_results, confirm_script_execution, \
-    output_csv_file_creation_results
+    output_csv_file_creation_results, output_manifest_export_results, output_link_results, output_plan_results, \
+    get_coverage_string, output_metrics_results, output_profile_results
+
+logger = logging.getLogger(__name__)
 
 
 def main(args):
+    # The stages of the run are measured with --metrics_json and profiled with --profile
+    metrics = setup_metrics(args)
+    profiler = setup_profiler(args)
+    run(args)
+    if metrics is not None:
+        output_metrics_results(args, metrics)
+    if profiler is not None:
+        output_profile_results(args, profiler)
+
+
+def run(args):
     setup_logging()
     fm = setup_file_manager(args)
     display_initial_config(args)
     confirm_script_execution(args)
     hash_manager = setup_hash_manager(args.reference_dir, args.full_hash, args.clear_cache)
+    tree_snapshot = setup_tree_snapshot(args)
+    try:
+        job_state = setup_job_state(args)
+    except JobStateError as e:
+        logger.error(str(e))
+        sys.exit(f"Error: {e}")
+
+    if args.action == 'export_manifest':
+        # Always run in run mode as it creates a file and maybe a folder.
+        files_exported = fm.with_run_mode(export_reference_manifest, args, args.reference_dir,
+                                          get_manifest_file_path(args), output_progress=True)
+        output_manifest_export_results(args, files_exported)
+        if tree_snapshot is not None:
+            with MetricsCollector.stage('save'):
+                tree_snapshot.save_data()
+        return
+
+    if args.apply_plan or args.undo_plan:
+        # The operations of a test run are executed or undone without finding the duplicates again
+        with MetricsCollector.stage('actions'):
+            if args.apply_plan:
+                results = apply_action_plan(args, args.apply_plan)
+            else:
+                results = undo_action_plan(args, args.undo_plan)
+            deleted_scan_folders = 0
+            if args.apply_plan and args.delete_empty_folders:
+                deleted_scan_folders = fm.delete_empty_folders(args.scan_dir, fm.moved_from_dirs, True)
+        output_plan_results(args, results, deleted_scan_folders)
+        return
 
-    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, args.scan_dir, args.reference_dir,
-                                                                 output_progress=True)
+    # The duplicates are found by a streaming pipeline in a background thread - files are moved and the report is
+    # written batch by batch, while the next batches are hashed
+    counts = {}
 
     if args.action == 'move_duplicates':
-        files_moved, files_created = process_duplicates(duplicates, args)
-        duplicate_scan_files_moved = clean_scan_dir_duplications(args, duplicates)
-        deleted_scan_folders = fm.delete_empty_folders_in_tree(args.scan_dir, True) if args.delete_empty_folders else 0
+        # A test run can write its operations to an action plan, so the real run applies them with --apply_plan
+        plan = ActionPlanWriter(args.save_plan, args) if args.save_plan else None
+        try:
+            files_moved, files_created, duplicate_scan_files_moved = process_duplicate_batches(
+                args, iter_duplicate_batches(args, args.scan_dir, args.reference_dir, counts, output_progress=True,
+                                             background=True), plan)
+        finally:
+            if plan is not None:
+                plan.close()
+        deleted_scan_folders = 0
+        with MetricsCollector.stage('actions'):
+            if args.delete_empty_folders and args.full_cleanup:
+                deleted_scan_folders = fm.delete_empty_folders_in_tree(args.scan_dir, True)
+            elif args.delete_empty_folders:
+                deleted_scan_folders = fm.delete_empty_folders(args.scan_dir, fm.moved_from_dirs, True)
 
         output_results(args, files_moved, files_created, deleted_scan_folders, duplicate_scan_files_moved,
-                       scan_stats, ref_stats)
+                       counts['scan_files'], counts['ref_files'], plan.plan_file if plan is not None else None,
+                       get_coverage_string(args, counts))
+    elif args.action == 'link_duplicates':
+        duplicates = merge_duplicate_groups(iter_duplicates(args, args.scan_dir, args.reference_dir, counts,
+                                                            output_progress=True))
+        with MetricsCollector.stage('actions'):
+            files_linked, bytes_reclaimed = link_duplicates(args, duplicates)
+        output_link_results(args, files_linked, bytes_reclaimed, counts['scan_files'], counts['ref_files'],
+                            get_coverage_string(args, counts))
     elif args.action == 'create_csv':
         # Always run in run mode as it creates a file and maybe a folder.
-        fm.with_run_mode(create_csv_file, args, duplicates)
-        output_csv_file_creation_results(args, duplicates, scan_stats, ref_stats)
+        report_files = fm.with_run_mode(create_csv_file, args, iter_duplicates(
+            args, args.scan_dir, args.reference_dir, counts, output_progress=True, background=True))
+        output_csv_file_creation_results(args, counts['groups'], counts['scan_files'], counts['ref_files'],
+                                         report_files, get_coverage_string(args, counts))
 
-    hash_manager.save_data()
+    with MetricsCollector.stage('save'):
+        hash_manager.save_data()
+        if tree_snapshot is not None:
+            tree_snapshot.save_data()
+        if job_state is not None:
+            job_state.finish()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+from argparse import Namespace
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Iterator, List
+
+from duplicate_files_in_folders.file_executor import FileOperationsExecutor
+from duplicate_files_in_folders.file_manager import FileManager
+
+logger = logging.getLogger(__name__)
+
+PLAN_VERSION = 1
+
+
+class ActionPlanError(Exception):
+    pass
+
+
+class ActionPlanWriter:
+    """
+    Writes the file operations of a test run to an action plan (--save_plan) - a JSON lines file with a header line
+    followed by a line per operation, in the order they would have been executed. Each line has the operation, the
+    source and destination paths, and the size, modified time and digest the source had when the plan was made.
+    The plan is applied by a real run with --apply_plan, without walking or hashing the folders again, and undone
+    with --undo_plan.
+    """
+
+    def __init__(self, plan_file: str, args: Namespace):
+        """
+        :param plan_file: path of the plan file to create
+        :param args: parsed arguments
+        """
+        self.plan_file = plan_file
+        self.operations = 0
+        self.moved_sources = set()  # in test mode files are not moved, so a later batch may plan to move them again
+        self.write_lock = Lock()  # operations across devices are executed by a thread pool
+        digest = 'checksum' if args.reference_checksums else 'full' if args.full_hash else 'partial'
+        header = {'version': PLAN_VERSION, 'scan_dir': os.path.abspath(args.scan_dir),
+                  'move_to': os.path.abspath(args.move_to), 'digest': digest, 'created': datetime.now().isoformat()}
+        self.file = open(plan_file, 'w', encoding='utf-8')
+        self.file.write(json.dumps(header, ensure_ascii=False) + '\n')
+
+    def add(self, op: Dict):
+        """
+        Write an operation to the plan. Operations on a file the plan already moves are left out - a real run
+        wouldn't find the file there anymore.
+        :param op: the operation, as added by FileOperationsExecutor.add()
+        """
+        entry = {'operation': op['operation'], 'src': op['src'], 'dst': op['dst'], 'size': op['size'],
+                 'mtime': op.get('mtime'), 'digest': op.get('digest')}
+        with self.write_lock:
+            if op['src'] in self.moved_sources:
+                return
+            if op['operation'] == 'move':
+                self.moved_sources.add(op['src'])
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.operations += 1
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_action_plan_header(plan_file: str) -> Dict:
+    """
+    Read the header of an action plan.
+    :param plan_file: path of the plan file
+    :return: the header dictionary
+    :raises: ActionPlanError if the file is not an action plan or was written by a different version
+    """
+    try:
+        with open(plan_file, encoding='utf-8') as f:
+            header = json.loads(f.readline())
+    except (OSError, ValueError) as e:
+        raise ActionPlanError(f"Invalid action plan {plan_file}: {e}")
+    if not isinstance(header, dict) or header.get('version') != PLAN_VERSION:
+        raise ActionPlanError(f"Invalid action plan {plan_file}: unsupported version")
+    return header
+
+
+def iter_action_plan(plan_file: str) -> Iterator[Dict]:
+    """
+    Iterate over the operations of an action plan, in order.
+    :param plan_file: path of the plan file
+    :return: iterator of the operations
+    """
+    read_action_plan_header(plan_file)
+    with open(plan_file, encoding='utf-8') as f:
+        f.readline()  # header
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def check_plan_entry(entry: Dict) -> str | None:
+    """
+    Check that an operation of a plan can still be applied - a stat of the source and the destination, instead of
+    reading the files again.
+    :param entry: the operation
+    :return: None if it can be applied, else the reason it can't
+    """
+    try:
+        stats = os.stat(entry['src'])
+    except OSError:
+        return "the source file is missing"
+    if stats.st_size != entry['size'] or (entry.get('mtime') is not None and stats.st_mtime != entry['mtime']):
+        return "the source file changed since the plan was made"
+    if os.path.lexists(entry['dst']):
+        return "the destination file exists"
+    return None
+
+
+def apply_action_plan(args: Namespace, plan_file: str) -> Dict[str, int]:
+    """
+    Execute the operations of an action plan made by a test run, without finding the duplicates again. Each operation
+    is checked with a stat of its files first - operations whose source changed or whose destination is taken are
+    skipped. The operations are executed in chunks of --batch_files, in the order of the plan.
+    :param args: parsed arguments
+    :param plan_file: path of the plan file
+    :return: dictionary with the number of files 'moved', 'copied' and 'skipped'
+    """
+    executor = FileOperationsExecutor(args.move_workers, show_progress=True, desc='Applying plan')
+    results = {'moved': 0, 'copied': 0, 'skipped': 0}
+
+    def run_executor():
+        executed = executor.run()
+        results['moved'] += executed['moved']
+        results['copied'] += executed['copied']
+
+    for entry in iter_action_plan(plan_file):
+        reason = check_plan_entry(entry)
+        if reason:
+            logger.warning(f"Skipping {entry['operation']} of {entry['src']} to {entry['dst']}: {reason}")
+            results['skipped'] += 1
+            continue
+        executor.add(entry['operation'], entry['src'], entry['dst'],
+                     {'size': entry['size'], 'modified_time': entry.get('mtime'), 'dev': None})
+        if len(executor.operations) >= args.batch_files:
+            run_executor()
+    run_executor()
+    return results
+
+
+def undo_action_plan(args: Namespace, plan_file: str) -> Dict[str, int]:
+    """
+    Undo an applied action plan, in reverse order - moved files are moved back to their source, and copies are
+    deleted. Operations whose destination file is missing or has another size are skipped, and so are moves whose
+    source path was taken since.
+    :param args: parsed arguments
+    :param plan_file: path of the plan file
+    :return: dictionary with the number of files 'moved' back, copies 'deleted' and operations 'skipped'
+    """
+    fm = FileManager.get_instance()
+    entries: List[Dict] = list(iter_action_plan(plan_file))
+    results = {'moved': 0, 'deleted': 0, 'skipped': 0}
+    created_dirs = set()
+    for entry in reversed(entries):
+        try:
+            dst_size = os.stat(entry['dst']).st_size
+        except OSError:
+            dst_size = None
+        if dst_size != entry['size'] or (entry['operation'] == 'move' and os.path.lexists(entry['src'])):
+            logger.warning(f"Not undoing {entry['operation']} of {entry['src']} to {entry['dst']}: the files "
+                           f"changed since it was done")
+            results['skipped'] += 1
+            continue
+        if entry['operation'] == 'move':
+            src_dir = os.path.dirname(entry['src'])
+            if src_dir not in created_dirs and not os.path.isdir(src_dir):  # removed as an empty folder
+                fm.make_dirs(src_dir, resolved=True)
+            created_dirs.add(src_dir)
+            fm.move_file(entry['dst'], entry['src'], resolved=True)
+            results['moved'] += 1
+        else:
+            fm.delete_file(entry['dst'], resolved=True)
+            results['deleted'] += 1
+    return results
@@ -1,16 +1,36 @@
-import csv
+import filecmp
+import logging
 import os
+import queue
 import concurrent.futures
-from datetime import datetime
+import functools
+import threading
+import time
 
 import tqdm
-from probables import BloomFilter
 from duplicate_files_in_folders.hash_manager import HashManager
+from duplicate_files_in_folders.file_filter import FileFilter
+from duplicate_files_in_folders.file_executor import FileOperationsExecutor, DestinationPlanner
 from duplicate_files_in_folders.file_manager import FileManager
-from typing import Dict, List, Set
-from duplicate_files_in_folders.utils import copy_or_move_file, get_file_key
+from duplicate_files_in_folders.hashing_planner import plan_hashing, format_plan, HashingBudget, is_budgeted
+from duplicate_files_in_folders.job_state import JobState
+from duplicate_files_in_folders.memory_governor import CandidateSpill, MemoryGovernor
+from duplicate_files_in_folders.metrics import MetricsCollector
+from duplicate_files_in_folders.report_writer import create_report_sink, get_report_extension
+from duplicate_files_in_folders.tree_snapshot import TreeSnapshot
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+from duplicate_files_in_folders.reference_manifest import load_reference_manifest, load_checksum_file, \
+    detect_checksum_algorithm
+from duplicate_files_in_folders.utils import get_destination_path, get_file_key, get_file_key_from_manifest, \
+    get_file_key_by_checksum
 from argparse import Namespace
 
+logger = logging.getLogger(__name__)
+
+OVERLAP_HASH_WORKERS = 4  # threads hashing the candidates found while walking, see --overlap
+OVERLAP_QUEUE_SIZE = 1024  # candidates queued for hashing before the walks wait
+BACKGROUND_QUEUE_SIZE = 2  # batches of duplicates found ahead of their consumer, see iter_in_background
+
 
 def get_files_keys(args: Namespace, file_infos: List[Dict]) -> Dict[str, List[Dict]]:
     """
@@ -21,22 +41,28 @@ def get_files_keys(args: Namespace, file_infos: List[Dict]) -> Dict[str, List[Di
     """
     results = {}
     for file_info in file_infos:
-        file_info_key = get_file_key(args, file_info['path'])
+        file_info_key = get_file_key(args, file_info['path'], FileManager.get_hardlink_id(file_info))
         if file_info_key not in results:
             results[file_info_key] = []
         results[file_info_key].append(file_info)
     return results
 
 
-def get_files_keys_parallel(args: Namespace, file_infos: List[Dict]) -> Dict[str, List[Dict]]:
+def get_files_keys_parallel(args: Namespace, file_infos: List[Dict], max_workers: int = None) \
+        -> Dict[str, List[Dict]]:
     """
     Generate keys for a list of files using threads.
     :param args: Parsed arguments
     :param file_infos: List of file stats to generate keys for
+    :param max_workers: number of worker threads - default is the ThreadPoolExecutor default
     :return: Dictionary of file keys to file stats - each key maps to a list of file stats
     """
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_to_file = {executor.submit(get_file_key, args, file_info['path']): file_info for file_info in file_infos}
+    # hash a single hardlink of every file in the threads, the other hardlinks reuse its hash
+    first_links, other_links = FileManager.split_hardlinks(file_infos)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_file = {executor.submit(get_file_key, args, file_info['path'],
+                                          FileManager.get_hardlink_id(file_info)): file_info
+                          for file_info in first_links}
         results = {}
         for future in concurrent.futures.as_completed(future_to_file):
             file_info = future_to_file[future]
@@ -48,60 +74,72 @@ def get_files_keys_parallel(args: Namespace, file_infos: List[Dict]) -> Dict[str
             except Exception as exc:
                 print(f'File {file_info["path"]} generated an exception: {exc}')
                 raise exc
-        return results
+    for file_info_key, other_link_infos in get_files_keys(args, other_links).items():
+        results.setdefault(file_info_key, []).extend(other_link_infos)
+    return results
 
 
-def filter_files_by_args(args: Namespace, files_stats: List[Dict]) -> List[Dict]:
+def get_files_keys_from_manifest(args: Namespace, file_infos: List[Dict]) -> Dict[str, List[Dict]]:
     """
-    Filter files based on size and extensions criteria.
+    Generate keys for a list of files loaded from a reference manifest, using the hashes stored in the manifest.
+    :param args: Parsed arguments
+    :param file_infos: List of file stats loaded from the manifest
+    :return: Dictionary of file keys to file stats - each key maps to a list of file stats
+    """
+    results = {}
+    for file_info in file_infos:
+        file_info_key = get_file_key_from_manifest(args, file_info)
+        if file_info_key not in results:
+            results[file_info_key] = []
+        results[file_info_key].append(file_info)
+    return results
+
+
+def get_files_keys_by_checksum(args: Namespace, file_infos: List[Dict], algorithm: str, max_workers: int = None) \
+        -> Dict[str, List[Dict]]:
+    """
+    Generate keys for a list of files based on their full content checksum, using threads. Used when the reference is
+    a checksum file - files loaded from it already have their checksum, other files are read.
+    :param args: Parsed arguments
+    :param file_infos: List of file stats to generate keys for
+    :param algorithm: the checksum algorithm - md5, sha1 or sha256
+    :param max_workers: number of worker threads - default is the ThreadPoolExecutor default
+    :return: Dictionary of file keys to file stats - each key maps to a list of file stats
+    """
+    # compute the checksum of a single hardlink of every file, the other hardlinks reuse it
+    first_links, other_links = FileManager.split_hardlinks(file_infos)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        checksums = list(executor.map(
+            lambda file_info: file_info.get('checksum') or HashManager.compute_checksum(file_info['path'], algorithm),
+            first_links))
+    hardlink_checksums = {FileManager.get_hardlink_id(file_info): checksum
+                          for file_info, checksum in zip(first_links, checksums)}
+    checksums += [hardlink_checksums[FileManager.get_hardlink_id(file_info)] for file_info in other_links]
+
+    results = {}
+    for file_info, checksum in zip(first_links + other_links, checksums):
+        file_info_key = get_file_key_by_checksum(args, file_info, algorithm, checksum)
+        if file_info_key not in results:
+            results[file_info_key] = []
+        results[file_info_key].append(file_info)
+    return results
+
+
+def filter_files_by_args(args: Namespace, files_stats: List[Dict], base_dir: str = None) -> List[Dict]:
+    """
+    Filter files based on the size, extension, name, folder and modified time criteria. Walking the directories
+    applies the same filter while scanning - use it for file stats that come from another source, e.g. a reference
+    manifest.
     :param args: Parsed arguments
     :param files_stats: List of file stats to filter (the output of FileManager.get_files_and_stats())
+    :param base_dir: if given, files in excluded folders under base_dir are filtered out
     :return: Filtered list of file stats based on the arguments
     """
-    min_size = args.min_size if args.min_size is not None else 0
-    max_size = args.max_size if args.max_size is not None else float('inf')
-    filtered_files = [file_info for file_info in files_stats
-                      if min_size <= int(file_info['size']) <= max_size and
-                      (args.whitelist_ext is None or file_info['name'].split('.')[-1] in args.whitelist_ext) and
-                      (args.blacklist_ext is None or file_info['name'].split('.')[-1] not in args.blacklist_ext)]
-    return filtered_files
-
-
-def find_potential_duplicates(dir1_stats: List[Dict], dir2_stats: List[Dict], ignore_diff: Set[str]) -> List[Dict]:
-    """
-    Find potential duplicates between two directories based on file size, name, and modified time.
-    :param dir1_stats: file stats for the first directory
-    :param dir2_stats: file stats for the second directory
-    :param ignore_diff: set of differences to ignore when comparing files
-    :return: List of potential duplicates, where each element is a dictionary of file stats
-    """
-    size_bloom = BloomFilter(est_elements=len(dir1_stats), false_positive_rate=0.05)
-    name_bloom = BloomFilter(est_elements=len(dir1_stats), false_positive_rate=0.05)
-    modified_time_bloom = BloomFilter(est_elements=len(dir1_stats), false_positive_rate=0.05)
-    check_name = 'filename' not in ignore_diff
-    check_mdate = 'mdate' not in ignore_diff
-    check_size = 'size' not in ignore_diff  # for now, size is always checked but can be ignored in the future
-
-    # Add the file sizes, names, and modified times of the first directory to the bloom filters
-    for file_info in dir1_stats:
-        if check_size:
-            size_bloom.add(str(file_info['size']))
-        if check_name:
-            name_bloom.add(file_info['name'])
-        if check_mdate:
-            modified_time_bloom.add(str(file_info['modified_time']))
-
-    # Find potential duplicates in the second directory based on the bloom filters
-    potential_duplicates = []
-    for file_info in dir2_stats:
-        if (
-                (not check_size or size_bloom.check(str(file_info['size']))) and
-                (not check_name or name_bloom.check(file_info['name'])) and
-                (not check_mdate or modified_time_bloom.check(str(file_info['modified_time'])))):
-            potential_duplicates.append(file_info)
-
-    # Return the potential duplicates
-    return potential_duplicates
+    file_filter = FileFilter.from_args(args)
+    if file_filter is None:
+        return files_stats
+    with MetricsCollector.stage('filter'):
+        return [file_info for file_info in files_stats if file_filter.accepts(file_info, base_dir)]
 
 
 def aggregate_duplicate_candidates(potential_duplicates: List[Dict], combined: Dict, key: str, args: Namespace,
@@ -126,45 +164,589 @@ def aggregate_duplicate_candidates(potential_duplicates: List[Dict], combined: D
     return combined
 
 
-def find_duplicates_files_v3(args: Namespace, scan_dir: str, ref_dir: str, output_progress=False) \
-        -> (Dict, List[Dict], List[Dict]):
+def get_candidate_group(args: Namespace, file_info: Dict) -> tuple:
     """
-     Find duplicate files between scan_dir and ref directories.
-     Returns a dictionary of duplicates and the file stats for both directories.
+    Get the attributes a file must share with a duplicate before their content is compared - the size, and the name
+    and modified time unless they are ignored.
+    :param args: Parsed arguments
+    :param file_info: the file stats
+    :return: tuple of (size, name or None, modified time or None)
+    """
+    return (file_info['size'],
+            file_info['name'] if 'filename' not in args.ignore_diff else None,
+            file_info['modified_time'] if 'mdate' not in args.ignore_diff else None)
+
+
+def get_relative_folder_parts(file_path: str, base_dir: str) -> List[str]:
+    """
+    Get the folder of a file relative to a base directory, as a list of folder names.
+    :param file_path: the full path of the file
+    :param base_dir: the base directory
+    :return: list of folder names, empty if the file is directly under the base directory
+    """
+    relative_folder = os.path.relpath(os.path.dirname(file_path), base_dir)
+    return [] if relative_folder == '.' else relative_folder.split(os.sep)
+
+
+def prioritize_ref_candidates(scan_files: List[Dict], ref_files: List[Dict], scan_dir: str, ref_dir: str) \
+        -> List[Dict]:
+    """
+    Sort the reference candidates of a group by how likely they are to be duplicates of the scan files: hardlinks of a
+    scan file first, then files with the same name and modified time as a scan file, then files whose folder is
+    nearest to the folder of a scan file.
+    :param scan_files: the scan files of the group
+    :param ref_files: the reference candidates of the group
+    :param scan_dir: the scan directory
+    :param ref_dir: the reference directory
+    :return: the reference candidates, sorted by priority
+    """
+    scan_names_and_times = {(file_info['name'], file_info['modified_time']) for file_info in scan_files}
+    scan_inodes = {FileManager.get_inode(file_info) for file_info in scan_files} - {None}
+    scan_folders = [get_relative_folder_parts(file_info['path'], scan_dir) for file_info in scan_files]
+
+    def priority(ref_file: Dict) -> tuple:
+        same_inode = FileManager.get_inode(ref_file) in scan_inodes
+        same_name_and_time = (ref_file['name'], ref_file['modified_time']) in scan_names_and_times
+        ref_folder = get_relative_folder_parts(ref_file['path'], ref_dir)
+        # distance in the folder tree - the number of folders to go up and down from one folder to the other
+        distance = min(len(scan_folder) + len(ref_folder) - 2 * len(os.path.commonprefix([scan_folder, ref_folder]))
+                       for scan_folder in scan_folders)
+        return not same_inode, not same_name_and_time, distance, ref_file['path']
+
+    return sorted(ref_files, key=priority)
+
+
+def aggregate_ref_candidates_until_resolved(potential_ref_duplicates: List[Dict], combined: Dict, args: Namespace,
+                                            scan_dir: str, ref_dir: str, file_key_func, max_workers: int = None) \
+        -> Dict:
+    """
+    Aggregate the reference candidates into the dictionary of the scan candidates, stopping as soon as all the scan
+    files are resolved. The candidates are grouped by the attributes a duplicate must share with a scan file (see
+    get_candidate_group). In each group, the candidates are hashed by priority (see prioritize_ref_candidates) until
+    every scan file in the group has a matching reference file - the remaining candidates are not read at all. The
+    matches of each key are ordered by path.
+    Only use it when a single reference file is needed for every scan file, i.e. when moving without copy_to_all.
+    :param potential_ref_duplicates: the reference candidates
+    :param combined: Dictionary with the keys of the scan candidates under 'scan'. The keys of the hashed reference
+                     candidates are added under 'ref'.
+    :param args: Parsed arguments
+    :param scan_dir: the scan directory
+    :param ref_dir: the reference directory
+    :param file_key_func: Function to generate the key of a single file - func(args, file_info) -> str
+    :param max_workers: number of groups resolved concurrently - default is the ThreadPoolExecutor default
+    :return: Dictionary of results
+    """
+    scan_groups = {}  # group -> (scan files of the group, keys of the scan files without a matching reference file)
+    for file_info_key, locations in combined.items():
+        for file_info in locations.get('scan', []):
+            scan_files, unresolved_keys = scan_groups.setdefault(get_candidate_group(args, file_info), ([], set()))
+            scan_files.append(file_info)
+            unresolved_keys.add(file_info_key)
+
+    ref_groups = {}
+    for file_info in potential_ref_duplicates:
+        group = get_candidate_group(args, file_info)
+        if group in scan_groups:  # bloom filter false positives don't match any scan file
+            ref_groups.setdefault(group, []).append(file_info)
+
+    def resolve_group(group: tuple) -> List[tuple]:
+        scan_files, unresolved_keys = scan_groups[group]
+        group_results = []
+        for ref_file in prioritize_ref_candidates(scan_files, ref_groups[group], scan_dir, ref_dir):
+            if not unresolved_keys:
+                break
+            ref_file_key = file_key_func(args, ref_file)
+            group_results.append((ref_file_key, ref_file))
+            unresolved_keys.discard(ref_file_key)
+        return group_results
+
+    hashed_files = 0
+    resolved_keys = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for group_results in executor.map(resolve_group, ref_groups):
+            for ref_file_key, ref_file in group_results:
+                combined.setdefault(ref_file_key, {}).setdefault('ref', []).append(ref_file)
+                resolved_keys.add(ref_file_key)
+            hashed_files += len(group_results)
+    # a key may be resolved in more than one group, in the order of the candidates - the matches are ordered by path,
+    # so the reference file a scan file is moved next to doesn't depend on the order they were hashed in
+    for ref_file_key in resolved_keys:
+        combined[ref_file_key]['ref'].sort(key=lambda file_info: file_info['path'])
+
+    logger.info(f"Hashed {hashed_files} out of {len(potential_ref_duplicates)} reference candidates, "
+                f"stopped early in groups where all scan files were resolved")
+    return combined
+
+
+def get_ref_file_key_function(args: Namespace):
+    """
+    Choose the function used to generate the key of a single reference file.
+    :param args: parsed arguments
+    :return: function to generate the key of a single file - func(args, file_info) -> str
+    """
+    if args.reference_checksums:
+        return functools.partial(get_file_key_by_checksum,
+                                 algorithm=detect_checksum_algorithm(args.reference_checksums))
+    if args.reference_manifest:
+        return get_file_key_from_manifest
+    return lambda key_args, file_info: get_file_key(key_args, file_info['path'], FileManager.get_hardlink_id(file_info))
+
+
+def get_files_and_stats_for_dirs(args: Namespace, scan_dir: str, ref_dir: str) -> (List[Dict], List[Dict]):
+    """
+    Get the file stats for the scan and reference directories, filtered by the filter arguments. The filter is applied
+    while walking the directories, so excluded folders are not walked and rejected files are never stat-ed or stored -
+    except in the reference snapshot, which stats and keeps all the files of the folders it walks.
+    If more than one walk worker is configured, both directory trees are walked concurrently, otherwise they are
+    walked one after the other.
+    If a TreeSnapshot is set up, the reference directory is walked through it, so only changed folders are re-scanned.
+    If a reference manifest is given, the reference file stats are loaded from it and the reference directory is not
+    accessed at all. If a reference checksum file is given, only the files listed in it are used as reference.
     :param args: parsed arguments
     :param scan_dir: the directory to scan for duplicates
     :param ref_dir: the reference directory
-    :param output_progress: whether to output progress
-    :return: a dictionary of duplicates, the file stats for the scan directory, and the file stats for the reference directory
-             Dictionary format: {file_key: {'scan': [file_info], 'ref': [file_info]}}
+    :return: the file stats for the scan directory and the file stats for the reference directory
     """
-    hash_manager = HashManager.get_instance()
+    file_filter = FileFilter.from_args(args)
 
-    if output_progress:
-        print(f"Scanning directories for duplicates: {scan_dir} and {ref_dir}")
+    def get_scan_stats():
+        if args.walk_workers > 1:
+            return FileManager.get_files_and_stats_parallel([scan_dir], args.walk_workers, file_filter=file_filter)[0]
+        return FileManager.get_files_and_stats(scan_dir, file_filter=file_filter)
 
-    # Get the file stats for both directories and filter them based on the arguments
-    scan_stats = filter_files_by_args(args, FileManager.get_files_and_stats(scan_dir))
-    ref_stats = filter_files_by_args(args, FileManager.get_files_and_stats(ref_dir))
+    if args.reference_manifest or args.reference_checksums:
+        if args.reference_manifest:
+            _, ref_stats = load_reference_manifest(args.reference_manifest, ref_dir)
+        else:
+            _, ref_stats = load_checksum_file(args.reference_checksums, ref_dir)
+        return get_scan_stats(), filter_files_by_args(args, ref_stats, ref_dir)
 
-    # Use bloom filters to find potential duplicates between the two directories
-    potential_scan_duplicates = find_potential_duplicates(ref_stats, scan_stats, args.ignore_diff)
-    potential_ref_duplicates = find_potential_duplicates(scan_stats, ref_stats, args.ignore_diff)
+    if TreeSnapshot.is_initialized():
+        tree_snapshot = TreeSnapshot.get_instance()
+        if args.walk_workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                ref_future = executor.submit(tree_snapshot.get_files_and_stats, ref_dir, args.full_rescan,
+                                             file_filter=file_filter)
+                scan_stats = get_scan_stats()
+                return scan_stats, ref_future.result()
+        return get_scan_stats(), tree_snapshot.get_files_and_stats(ref_dir, args.full_rescan, file_filter=file_filter)
 
-    if output_progress:
-        print(f"Found {len(potential_scan_duplicates)} potential duplicates in the scan directory out of " +
-              f"{len(scan_stats)} files.")
-        print(f"Found {len(potential_ref_duplicates)} potential duplicates in the reference directory out of " +
-              f"{len(ref_stats)} files.")
-        print("Aggregating potential duplicates...")
+    if args.walk_workers > 1:
+        scan_stats, ref_stats = FileManager.get_files_and_stats_parallel([scan_dir, ref_dir], args.walk_workers,
+                                                                         file_filter=file_filter)
+        return scan_stats, ref_stats
+    return get_scan_stats(), FileManager.get_files_and_stats(ref_dir, file_filter=file_filter)
+
+
+def get_keys_function(args: Namespace, side_plan: Dict):
+    """
+    Get the function used to generate the keys of the candidates of one side, according to its hashing plan.
+    :param args: parsed arguments
+    :param side_plan: the plan of the side, returned by plan_hashing()
+    :return: function to generate the keys of a list of files - func(args, file_infos) -> Dict[str, List[Dict]]
+    """
+    if side_plan['key_source'] == 'manifest':  # the manifest already has the hashes of the reference files
+        return get_files_keys_from_manifest
+    if side_plan['key_source'] == 'checksums':  # compare full content checksums, with the algorithm of the file
+        return functools.partial(get_files_keys_by_checksum, max_workers=side_plan['workers'],
+                                 algorithm=detect_checksum_algorithm(args.reference_checksums))
+    if side_plan['executor'] == 'threads':
+        return functools.partial(get_files_keys_parallel, max_workers=side_plan['workers'])
+    return get_files_keys
+
+
+def pair_hardlinked_candidates(args: Namespace, scan_candidates: List[Dict], ref_candidates: List[Dict],
+                               resolve_early: bool) -> (Dict, List[Dict], List[Dict]):
+    """
+    Pair scan and reference candidates that are hardlinks of the same file (same device and inode) - they are
+    duplicates without reading them. A group of candidates (see get_candidate_group) is resolved without reading when:
+    - resolve_early is True: every scan file of the group has a hardlink among the reference files of the group
+    - resolve_early is False: all the files of the group, on both sides, are hardlinks of the same file
+    The hardlinks of resolved groups get a synthetic key of their inode, and the groups are removed from the candidates.
+    :param args: parsed arguments
+    :param scan_candidates: the scan candidates
+    :param ref_candidates: the reference candidates
+    :param resolve_early: if True, a single reference file is needed for every scan file
+    :return: Dictionary of the paired files in the format of find_duplicates_files_v3(), and the remaining scan and
+             reference candidates
+    """
+    groups = {}
+    for side, candidates in [('scan', scan_candidates), ('ref', ref_candidates)]:
+        for file_info in candidates:
+            groups.setdefault(get_candidate_group(args, file_info), {'scan': [], 'ref': []})[side].append(file_info)
+
+    paired = {}
+    resolved_groups = set()
+    for group, files in groups.items():
+        scan_inodes = {FileManager.get_inode(file_info) for file_info in files['scan']}
+        ref_inodes = {FileManager.get_inode(file_info) for file_info in files['ref']}
+        if None in scan_inodes or not scan_inodes or not (scan_inodes & ref_inodes):
+            continue
+        if not (scan_inodes <= ref_inodes if resolve_early else len(scan_inodes | ref_inodes) == 1):
+            continue
+        resolved_groups.add(group)
+        for side in ['scan', 'ref']:
+            for file_info in files[side]:
+                inode = FileManager.get_inode(file_info)
+                if inode in scan_inodes:
+                    paired.setdefault(f"inode_{inode[0]}_{inode[1]}", {}).setdefault(side, []).append(file_info)
+
+    if resolved_groups:
+        logger.info(f"Paired {sum(len(locations['scan']) for locations in paired.values())} scan files with "
+                    f"hardlinks in the reference folder, without reading them")
+    return paired, \
+        [file_info for file_info in scan_candidates if get_candidate_group(args, file_info) not in resolved_groups], \
+        [file_info for file_info in ref_candidates if get_candidate_group(args, file_info) not in resolved_groups]
+
+
+def prefilter_candidates_by_partial_hash(args: Namespace, scan_candidates: List[Dict], ref_candidates: List[Dict],
+                                         plan: Dict) -> (List[Dict], List[Dict]):
+    """
+    Drop the candidates whose partial hash (the hash of their first 2MB) doesn't match the partial hash of any
+    candidate of the same group on the other side, so they are not read in full.
+    Groups with a cached full hash are kept as they are, as the partial hash of the cached files is not known.
+    :param args: parsed arguments
+    :param scan_candidates: the scan candidates
+    :param ref_candidates: the reference candidates
+    :param plan: the hashing plan, returned by plan_hashing()
+    :return: the prefiltered scan candidates and reference candidates
+    """
+    start = time.perf_counter()
+    cached_paths = plan['scan']['cached_paths'] | plan['ref']['cached_paths']
+    groups_with_cached = {get_candidate_group(args, file_info) for file_info in scan_candidates + ref_candidates
+                          if file_info['path'] in cached_paths}
+    to_hash = [file_info for file_info in scan_candidates + ref_candidates
+               if get_candidate_group(args, file_info) not in groups_with_cached]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(plan['scan']['workers'],
+                                                               plan['ref']['workers'])) as executor:
+        partial_hashes = dict(zip((file_info['path'] for file_info in to_hash),
+                                  executor.map(lambda file_info: HashManager.compute_partial_hash(file_info['path']),
+                                               to_hash)))
+
+    def get_partial_keys(candidates: List[Dict]) -> Set[tuple]:
+        return {(get_candidate_group(args, file_info), partial_hashes[file_info['path']])
+                for file_info in candidates if file_info['path'] in partial_hashes}
+
+    def keep(file_info: Dict, other_side_keys: Set[tuple]) -> bool:
+        group = get_candidate_group(args, file_info)
+        return group in groups_with_cached or (group, partial_hashes[file_info['path']]) in other_side_keys
+
+    scan_keys, ref_keys = get_partial_keys(scan_candidates), get_partial_keys(ref_candidates)
+    prefiltered_scan = [file_info for file_info in scan_candidates if keep(file_info, ref_keys)]
+    prefiltered_ref = [file_info for file_info in ref_candidates if keep(file_info, scan_keys)]
+    logger.info(f"Partial hash prefilter read {len(to_hash)} files in {time.perf_counter() - start:.2f}s, dropped "
+                f"{len(scan_candidates) - len(prefiltered_scan)} scan and {len(ref_candidates) - len(prefiltered_ref)} "
+                f"reference candidates")
+    return prefiltered_scan, prefiltered_ref
+
+
+def hash_candidates(args: Namespace, plan: Dict, candidates: Dict[str, List[Dict]], scan_dir: str, ref_dir: str,
+                    resolve_early: bool) -> Dict:
+    """
+    Generate the keys of the scan and reference candidates according to the hashing plan, and log the actual time of
+    each side next to its estimate.
+    :param args: parsed arguments
+    :param plan: the hashing plan, returned by plan_hashing()
+    :param candidates: the candidates of each side - {'scan': [file_info], 'ref': [file_info]}
+    :param scan_dir: the scan directory
+    :param ref_dir: the reference directory
+    :param resolve_early: if True, stop hashing the reference candidates of a group once all its scan files are
+                          resolved (see aggregate_ref_candidates_until_resolved). The scan side must be hashed first.
+    :return: Dictionary of file keys to the candidates of each side - {file_key: {'scan': [...], 'ref': [...]}}
+    """
+    def hash_side(side: str, combined: Dict) -> Dict:
+        start = time.perf_counter()
+        with MetricsCollector.stage(f'keys_{side}'):
+            if side == 'ref' and resolve_early:
+                combined = aggregate_ref_candidates_until_resolved(candidates['ref'], combined, args, scan_dir,
+                                                                   ref_dir, get_ref_file_key_function(args),
+                                                                   plan['ref']['workers'])
+            else:
+                combined = aggregate_duplicate_candidates(candidates[side], combined, side, args,
+                                                          get_keys_function(args, plan[side]))
+        logger.info(f"Hashed {len(candidates[side])} {side} candidates in {time.perf_counter() - start:.2f}s "
+                    f"(estimated {plan[side]['estimated_seconds']:.2f}s)")
+        return combined
 
-    # Aggregate the potential duplicates into one dictionary
+    if not plan['concurrent']:
+        combined = {}
+        for side in plan['order']:
+            combined = hash_side(side, combined)
+        return combined
+
+    # the sides are on different devices - hash both at once, each into its own dictionary
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        side_results = list(executor.map(lambda side: hash_side(side, {}), ['scan', 'ref']))
     combined = {}
-    combined = aggregate_duplicate_candidates(potential_scan_duplicates, combined, 'scan', args)
-    get_keys_function = get_files_keys_parallel \
-        if (len(hash_manager.get_hashes_by_folder(ref_dir)) > len(ref_stats) / 2) else get_files_keys
-    combined = aggregate_duplicate_candidates(potential_ref_duplicates, combined, 'ref', args,
-                                              get_keys_function)
+    for side_result in side_results:
+        for file_key, locations in side_result.items():
+            combined.setdefault(file_key, {}).update(locations)
+    return combined
+
+
+def iter_scan_stats(args: Namespace, scan_dir: str) -> Iterator[Dict]:
+    """
+    Walk stage of the scan side - yield the file stats of the scan directory, filtered by the filter arguments, one
+    directory at a time. With more than one walk worker, the directory is walked in parallel and yielded at the end.
+    :param args: parsed arguments
+    :param scan_dir: the directory to scan for duplicates
+    :return: generator of file stats
+    """
+    file_filter = FileFilter.from_args(args)
+    if args.walk_workers > 1:
+        yield from FileManager.get_files_and_stats_parallel([scan_dir], args.walk_workers, file_filter=file_filter)[0]
+    else:
+        yield from FileManager.iter_files_and_stats(scan_dir, file_filter=file_filter)
+
+
+def iter_ref_stats(args: Namespace, ref_dir: str) -> Iterator[Dict]:
+    """
+    Walk stage of the reference side - yield the reference file stats, filtered by the filter arguments. Same sources
+    as get_files_and_stats_for_dirs(): a reference manifest, a checksum file, the TreeSnapshot or a walk of the
+    reference directory, one directory at a time.
+    :param args: parsed arguments
+    :param ref_dir: the reference directory
+    :return: generator of file stats
+    """
+    file_filter = FileFilter.from_args(args)
+    if args.reference_manifest:
+        yield from filter_files_by_args(args, load_reference_manifest(args.reference_manifest, ref_dir)[1], ref_dir)
+    elif args.reference_checksums:
+        yield from filter_files_by_args(args, load_checksum_file(args.reference_checksums, ref_dir)[1], ref_dir)
+    elif TreeSnapshot.is_initialized():
+        yield from TreeSnapshot.get_instance().get_files_and_stats(ref_dir, args.full_rescan, file_filter=file_filter)
+    elif args.walk_workers > 1:
+        yield from FileManager.get_files_and_stats_parallel([ref_dir], args.walk_workers, file_filter=file_filter)[0]
+    else:
+        yield from FileManager.iter_files_and_stats(ref_dir, file_filter=file_filter)
+
+
+def join_candidate_groups(args: Namespace, scan_stats: Iterable[Dict], ref_stats: Iterable[Dict],
+                          counts: Dict[str, int], governor: MemoryGovernor = None) \
+        -> Dict[tuple, Dict[str, List[Dict]]] | CandidateSpill:
+    """
+    Candidate join stage - index the scan files by their candidate group (see get_candidate_group), then stream the
+    reference files through the index. Only reference files that share a group with a scan file are kept, and only
+    scan files that share a group with a reference file are returned - the other files are released as they go.
+    With a memory governor (--max_memory), the index is spilled to a CandidateSpill whenever the memory is near the
+    limit: reference files of spilled groups are written to it too, and at the end the groups left in memory are
+    added to it, so the groups are read back from disk - the same groups as the in-memory join.
+    :param args: parsed arguments
+    :param scan_stats: the scan file stats - any iterable, e.g. iter_scan_stats()
+    :param ref_stats: the reference file stats - any iterable, e.g. iter_ref_stats()
+    :param counts: dictionary the number of files of each side is added to, as 'scan_files' and 'ref_files'
+    :param governor: the memory governor, if any
+    :return: Dictionary of candidate group to the candidates of each side - {group: {'scan': [...], 'ref': [...]}},
+             or the CandidateSpill they were spilled to
+    """
+    scan_groups = {}
+    groups = {}
+    spill = None
+
+    def spill_index():
+        nonlocal spill
+        if spill is None:
+            spill = CandidateSpill()
+            logger.info(f"Memory is near the --max_memory limit - spilling the candidates to {spill.db_path}")
+        for spilled_group, files in scan_groups.items():
+            spill.add('scan', spilled_group, files)
+        for spilled_group, files in groups.items():
+            spill.add('ref', spilled_group, files['ref'])
+        scan_groups.clear()
+        groups.clear()
+        governor.spills += 1
+
+    for file_info in scan_stats:
+        counts['scan_files'] += 1
+        scan_groups.setdefault(get_candidate_group(args, file_info), []).append(file_info)
+        if governor is not None and governor.tick() and scan_groups:
+            spill_index()
+
+    for file_info in ref_stats:
+        counts['ref_files'] += 1
+        group = get_candidate_group(args, file_info)
+        if group in scan_groups:
+            groups.setdefault(group, {'scan': scan_groups[group], 'ref': []})['ref'].append(file_info)
+        elif spill is not None and spill.has_scan_files(group):
+            spill.add('ref', group, [file_info])
+        if governor is not None and governor.tick() and (scan_groups or groups):
+            spill_index()
+
+    if spill is None:
+        return groups
+    for spilled_group, files in groups.items():  # the matched groups left in memory
+        spill.add('scan', spilled_group, files['scan'])
+        spill.add('ref', spilled_group, files['ref'])
+    logger.info(f"Spilled {spill.rows} candidates to disk in {governor.spills} spills")
+    return spill
+
+
+def join_candidate_groups_overlapped(args: Namespace, scan_stats: Iterable[Dict], ref_stats: Iterable[Dict],
+                                     counts: Dict[str, int], hash_ref: bool) -> Dict[tuple, Dict[str, List[Dict]]]:
+    """
+    Candidate join stage that overlaps the walks with hashing (--overlap). Both sides are walked at once, each in its
+    own thread, into a single index of candidate groups. As soon as a group has files on both sides, its scan files
+    are queued for hashing - and so are the scan files that arrive in it later. The keys are cached by the
+    HashManager, so the hashing stage finds them ready. Unlike join_candidate_groups(), the reference files are
+    indexed too, as a scan file that matches them may still arrive.
+    :param args: parsed arguments
+    :param scan_stats: the scan file stats - any iterable, e.g. iter_scan_stats()
+    :param ref_stats: the reference file stats - any iterable, e.g. iter_ref_stats()
+    :param counts: dictionary the number of files of each side is added to, as 'scan_files' and 'ref_files'
+    :param hash_ref: if True, the reference files of matched groups are queued too - when all of them are hashed
+                     anyway, i.e. without early termination (see aggregate_ref_candidates_until_resolved)
+    :return: Dictionary of candidate group to the candidates of each side - {group: {'scan': [...], 'ref': [...]}}
+    """
+    index = {}  # group -> {'scan': [...], 'ref': [...]}
+    lock = threading.Lock()
+    queued = threading.BoundedSemaphore(OVERLAP_QUEUE_SIZE)  # the walks wait when too many files are queued
+    state = {'hashed': 0}
+
+    def hash_file(file_info: Dict):
+        try:
+            get_file_key(args, file_info['path'], FileManager.get_hardlink_id(file_info))
+            with lock:
+                state['hashed'] += 1
+        except OSError as e:  # hashed again - and the error raised - by the hashing stage
+            logger.warning(f"Error hashing {file_info['path']} while walking: {e}")
+        finally:
+            queued.release()
+
+    def queue_files(executor: concurrent.futures.Executor, file_infos: List[Dict]):
+        for file_info in file_infos:
+            queued.acquire()
+            executor.submit(hash_file, file_info)
+
+    def walk(side: str, stats: Iterable[Dict], executor: concurrent.futures.Executor):
+        other_side = 'ref' if side == 'scan' else 'scan'
+        hash_side = side == 'scan' or hash_ref
+        for file_info in stats:
+            with lock:
+                counts[f'{side}_files'] += 1
+                files = index.setdefault(get_candidate_group(args, file_info), {'scan': [], 'ref': []})
+                files[side].append(file_info)
+                newly_matched = len(files[side]) == 1 and files[other_side]
+                matched = bool(files[other_side])
+                to_queue = [] if not matched else \
+                    (files['scan'] + (files['ref'] if hash_ref else []) if newly_matched else
+                     [file_info] if hash_side else [])
+            queue_files(executor, to_queue)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=OVERLAP_HASH_WORKERS,
+                                               thread_name_prefix='overlap_hash') as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as walker:
+            ref_walk = walker.submit(walk, 'ref', ref_stats, executor)
+            walk('scan', scan_stats, executor)
+            ref_walk.result()
+        logger.info(f"Walked both folders in {time.perf_counter() - start:.2f}s, waiting for the files queued for "
+                    f"hashing")
+    logger.info(f"Hashed {state['hashed']} files while walking, in {time.perf_counter() - start:.2f}s")
+    return {group: files for group, files in index.items() if files['scan'] and files['ref']}
+
+
+def get_group_value(group: tuple, files: Dict[str, List[Dict]]) -> int:
+    """
+    Get the bytes a candidate group may reclaim - the size of its files times the number of its scan files.
+    :param group: the candidate group - see get_candidate_group()
+    :param files: the files of the group - {'scan': [file_info], 'ref': [file_info]}
+    :return: the potential bytes reclaimed
+    """
+    return group[0] * len(files['scan'])
+
+
+def count_candidates(groups: Dict[tuple, Dict[str, List[Dict]]] | CandidateSpill) -> Tuple[int, int, int]:
+    """
+    Count the candidates of the candidate groups. The hardlinks of a reference file are counted once, as it is hashed
+    once.
+    :param groups: the candidate groups, returned by join_candidate_groups()
+    :return: number of scan candidates, number of reference candidates, potential bytes reclaimed
+    """
+    if isinstance(groups, CandidateSpill):
+        return groups.get_counts()
+    return sum(len(files['scan']) for files in groups.values()), \
+        sum(len(FileManager.split_hardlinks(files['ref'])[0]) for files in groups.values()), \
+        sum(get_group_value(group, files) for group, files in groups.items())
+
+
+def iter_candidate_groups(groups: Dict[tuple, Dict[str, List[Dict]]] | CandidateSpill,
+                          most_valuable_first: bool = False) -> Iterator[Tuple[tuple, Dict[str, List[Dict]]]]:
+    """
+    Iterate over the candidate groups in the order of the groups (by size), or from the group that may reclaim the
+    most bytes to the least if most_valuable_first is True. Groups are removed from the dictionary as they are
+    yielded, and spilled groups are read from disk one at a time.
+    :param groups: the candidate groups, returned by join_candidate_groups()
+    :param most_valuable_first: if True, order the groups by their potential bytes reclaimed - see get_group_value()
+    :return: generator of (group, {'scan': [...], 'ref': [...]})
+    """
+    if isinstance(groups, CandidateSpill):
+        yield from groups.iter_groups(most_valuable_first)
+        return
+    if most_valuable_first:
+        order = sorted(groups, key=lambda group: (-get_group_value(group, groups[group]), group))
+    else:
+        order = sorted(groups)
+    for group in order:
+        yield group, groups.pop(group)
+
+
+def iter_candidate_batches(groups: Dict[tuple, Dict[str, List[Dict]]] | CandidateSpill, batch_files: int,
+                           most_valuable_first: bool = False) -> Iterator[Tuple[List[Dict], List[Dict]]]:
+    """
+    Split the candidate groups into batches of about batch_files files, in the order of iter_candidate_groups(). A
+    group is never split between batches, so a batch may be larger if a single group is. The candidates of a batch
+    are released once it is processed.
+    :param groups: the candidate groups, returned by join_candidate_groups()
+    :param batch_files: number of files after which a batch is yielded
+    :param most_valuable_first: if True, order the groups by their potential bytes reclaimed - see get_group_value()
+    :return: generator of (scan candidates, reference candidates) of each batch
+    """
+    scan_batch, ref_batch = [], []
+    for group, files in iter_candidate_groups(groups, most_valuable_first):
+        scan_batch.extend(files['scan'])
+        ref_batch.extend(files['ref'])
+        if len(scan_batch) + len(ref_batch) >= batch_files:
+            yield scan_batch, ref_batch
+            scan_batch, ref_batch = [], []
+    if scan_batch:
+        yield scan_batch, ref_batch
+
+
+def find_duplicates_in_batch(args: Namespace, scan_dir: str, ref_dir: str, scan_candidates: List[Dict],
+                             ref_candidates: List[Dict], resolve_early: bool, output_progress: bool = False,
+                             budget: HashingBudget = None) -> Dict | None:
+    """
+    Hashing and grouping stages of a batch of candidates - pair the hardlinks, plan and run the hashing, and keep the
+    keys found on both sides. With a budget, the batch is hashed only if its plan fits the remaining budget.
+    :param args: parsed arguments
+    :param scan_dir: the scan directory
+    :param ref_dir: the reference directory
+    :param scan_candidates: the scan candidates of the batch
+    :param ref_candidates: the reference candidates of the batch, in the same candidate groups
+    :param resolve_early: if True, a single reference file is needed for every scan file - stop hashing the reference
+                          candidates of a group once all its scan files are resolved
+    :param output_progress: whether to output the hashing plan
+    :param budget: the time and read budget of the run, if any
+    :return: Dictionary of the duplicates of the batch, in the format of find_duplicates_files_v3(), or None if the
+             batch doesn't fit the budget
+    """
+    paired_duplicates, scan_candidates, ref_candidates = \
+        pair_hardlinked_candidates(args, scan_candidates, ref_candidates, resolve_early)
+    plan = plan_hashing(args, scan_dir, ref_dir, scan_candidates, ref_candidates, scan_first=resolve_early)
+    logger.info(format_plan(plan))
+    if budget is not None and not budget.allows(plan):
+        return None
+    if output_progress:
+        print(format_plan(plan))
+    if plan['prefilter']:
+        with MetricsCollector.stage('keys_prefilter'):
+            scan_candidates, ref_candidates = prefilter_candidates_by_partial_hash(args, scan_candidates,
+                                                                                    ref_candidates, plan)
+    combined = hash_candidates(args, plan, {'scan': scan_candidates, 'ref': ref_candidates}, scan_dir, ref_dir,
+                               resolve_early)
+    combined.update(paired_duplicates)
+    if budget is not None:
+        budget.charge(plan)
 
     # Filter out combined items that don't appear in both scan dir and reference dir - ie size = 2
     combined = {file_key: file_locations for file_key, file_locations in combined.items() if len(file_locations) == 2}
@@ -173,77 +755,459 @@ def find_duplicates_files_v3(args: Namespace, scan_dir: str, ref_dir: str, outpu
     for value in combined.values():
         value['scan'] = sorted(value['scan'], key=lambda x: x['path'])
         value['ref'] = sorted(value['ref'], key=lambda x: x['path'])
+    return combined
+
+
+def iter_duplicate_batches_of_stats(args: Namespace, scan_dir: str, ref_dir: str, scan_stats: Iterable[Dict],
+                                    ref_stats: Iterable[Dict], counts: Dict[str, int] = None, output_progress=False) \
+        -> Iterator[Dict]:
+    """
+    Run the pipeline on the file stats of both sides - join them into candidate groups, then hash and group the
+    candidates one batch at a time (see --batch_files), yielding the duplicates of each batch before the next one is
+    hashed. Only the scan file stats and the candidates are kept in memory, the reference file stats are streamed -
+    unless ref_stats holds them, see iter_ref_stats().
+    If a JobState is set up, the candidate groups are saved - a resumed job loads them instead of walking the
+    folders (scan_stats and ref_stats are not iterated) - and the batches completed by a previous run are skipped.
+    With --max_memory, the candidate groups may be spilled to disk by the join, and are then read back group by
+    group, with the same results.
+    With --max_runtime or --max_bytes_read, the batches are ordered from the most valuable (see get_group_value) and
+    the batches left when the budget is spent are deferred - they are counted, not hashed. A job resumed in the next
+    run starts from them.
+    :param args: parsed arguments
+    :param scan_dir: the scan directory
+    :param ref_dir: the reference directory
+    :param scan_stats: the scan file stats - any iterable
+    :param ref_stats: the reference file stats - any iterable
+    :param counts: if given, the number of files, candidates and duplicate groups are added to it
+    :param output_progress: whether to output progress
+    :return: generator of the duplicates of each batch - {file_key: {'scan': [file_info], 'ref': [file_info]}}
+    """
+    counts = counts if counts is not None else {}
+    for count_key in ['scan_files', 'ref_files', 'scan_candidates', 'ref_candidates', 'batches', 'skipped_batches',
+                      'groups', 'candidate_bytes', 'deferred_batches', 'deferred_candidates', 'deferred_bytes']:
+        counts.setdefault(count_key, 0)
+    budget = HashingBudget(args.max_runtime, args.max_bytes_read) if is_budgeted(args) else None
+
+    # a single reference file is needed for every scan file - stop hashing the reference candidates once found
+    resolve_early = args.action in ('move_duplicates', 'link_duplicates') and not args.copy_to_all
+    job = JobState.get_instance() if JobState.is_initialized() else None
+    saved_candidates = job.load_candidates() if job is not None else None
+    if saved_candidates is not None:  # resumed job - the folders are not walked again
+        groups, saved_counts = saved_candidates
+        counts.update(saved_counts)
+    else:
+        with MetricsCollector.stage('candidate_join'):  # the lazy walk stages are measured apart, see iter_stage()
+            if args.overlap:
+                groups = join_candidate_groups_overlapped(args, scan_stats, ref_stats, counts,
+                                                          hash_ref=not resolve_early and not args.reference_manifest)
+            else:
+                governor = MemoryGovernor(args.max_memory) if args.max_memory else None
+                groups = join_candidate_groups(args, scan_stats, ref_stats, counts, governor)
+        if job is not None:
+            job.save_candidates(groups, {'scan_files': counts['scan_files'], 'ref_files': counts['ref_files']})
+    counts['scan_candidates'], counts['ref_candidates'], counts['candidate_bytes'] = count_candidates(groups)
+    if output_progress:
+        print(f"Found {counts['scan_candidates']} potential duplicates in the scan directory out of "
+              f"{counts['scan_files']} files.")
+        print(f"Found {counts['ref_candidates']} potential duplicates in the reference directory out of "
+              f"{counts['ref_files']} files.")
+        print("Aggregating potential duplicates...")
+
+    batches = iter_candidate_batches(groups, args.batch_files, most_valuable_first=budget is not None)
+    try:
+        for index, (scan_candidates, ref_candidates) in enumerate(batches):
+            if job is not None and job.is_batch_completed(index):
+                counts['skipped_batches'] += 1
+                continue
+            if saved_candidates is not None:  # the files the interrupted batch moved are gone
+                scan_candidates = drop_moved_candidates(job, scan_candidates)
+                ref_candidates = drop_moved_candidates(job, ref_candidates)
+            batch = None
+            if budget is None or budget.exhausted_by is None:
+                batch = find_duplicates_in_batch(args, scan_dir, ref_dir, scan_candidates, ref_candidates,
+                                                 resolve_early, output_progress, budget)
+            if batch is None:  # the budget is spent
+                counts['deferred_batches'] += 1
+                counts['deferred_candidates'] += len(scan_candidates) + len(ref_candidates)
+                counts['deferred_bytes'] += sum(int(file_info['size']) for file_info in scan_candidates)
+                continue
+            counts['batches'] += 1
+            counts['groups'] += len(batch)
+            if job is not None:
+                job.batch_yielded(index)
+            yield batch
+    finally:
+        batches.close()
+        if isinstance(groups, CandidateSpill):  # the candidates were spilled to disk by the memory governor
+            groups.close()
+
+
+def drop_moved_candidates(job: JobState, candidates: List[Dict]) -> List[Dict]:
+    """
+    Drop the candidates of a resumed job that a previous run moved away - journaled as moved, or no longer there - so
+    they are not hashed again. The batch a run was interrupted in may have moved some of its files.
+    :param job: the resumed job
+    :param candidates: the saved candidates of a batch
+    :return: the candidates that can still be hashed
+    """
+    remaining = [file_info for file_info in candidates
+                 if not job.is_moved_away(FileManager.resolve_path(file_info['path'])) and
+                 os.path.exists(file_info['path'])]
+    if len(remaining) < len(candidates):
+        logger.info(f"Dropped {len(candidates) - len(remaining)} candidates moved by a previous run of the job")
+    return remaining
+
+
+def iter_in_background(items: Iterable, queue_size: int = BACKGROUND_QUEUE_SIZE) -> Iterator:
+    """
+    Iterate over items produced in a background thread, so the consumer works on an item while the next ones are
+    produced. At most queue_size items wait in the queue - the producer waits when the consumer falls behind.
+    The items are yielded in the order they are produced. An error of the producer is raised in the consumer, after
+    the items produced before it. If the consumer stops early, the producer is stopped at its next item.
+    :param items: the items, e.g. a generator - it is iterated in the background thread
+    :param queue_size: maximum number of items produced ahead of the consumer
+    :return: generator of the items
+    """
+    item_queue = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    done = object()  # marks the end of the items
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    producer = threading.Thread(target=produce, name='background_producer', daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = item_queue.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
+
+def iter_duplicate_batches(args: Namespace, scan_dir: str, ref_dir: str, counts: Dict[str, int] = None,
+                           output_progress=False, background=False) -> Iterator[Dict]:
+    """
+    Find duplicate files between scan_dir and ref_dir as a streaming pipeline of generator stages:
+    walk and filter (iter_scan_stats, iter_ref_stats) -> candidate join (join_candidate_groups) -> hashing and
+    grouping of bounded batches (iter_candidate_batches, find_duplicates_in_batch) -> the consumer, e.g. a report.
+    Unlike find_duplicates_files_v3(), the file stats of the directories are not returned, only counted. With a
+    single walk worker (the default), the reference tree is streamed and never held in memory - the parallel walk
+    (--walk_workers) and the reference snapshot (--ref_snapshot) list all the reference files first.
+    Ordering guarantees:
+    - a batch is yielded as soon as all its groups are keyed on both sides - every group is complete, with all its
+      scan and reference files, and its 'scan' and 'ref' lists are sorted by path
+    - batches are yielded in the order of the file size, from the smallest files to the largest - or, with a budget
+      (--max_runtime, --max_bytes_read), from the groups that may reclaim the most bytes. Inside a batch, the order
+      of the groups is not defined
+    - a key is yielded once per batch - without --full_hash, files of different sizes that start with the same 2MB
+      have the same key, and may be yielded in different batches (see merge_duplicate_groups)
+    - the counts of the files and candidates are set before the first batch is yielded, the number of batches and
+      groups is final when the generator is exhausted
+    :param args: parsed arguments
+    :param scan_dir: the directory to scan for duplicates
+    :param ref_dir: the reference directory
+    :param counts: if given, the number of files, candidates, batches and duplicate groups are added to it
+    :param output_progress: whether to output progress
+    :param background: if True, the duplicates are found in a background thread, so the next batches are hashed
+                       while the consumer processes a batch (see iter_in_background)
+    :return: generator of the duplicates of each batch - {file_key: {'scan': [file_info], 'ref': [file_info]}}
+    """
+    if output_progress:
+        print(f"Scanning directories for duplicates: {scan_dir} and {ref_dir}")
+    scan_stats = MetricsCollector.iter_stage('walk', iter_scan_stats(args, scan_dir))
+    ref_stats = MetricsCollector.iter_stage('walk', iter_ref_stats(args, ref_dir))
+    batches = iter_duplicate_batches_of_stats(args, scan_dir, ref_dir, scan_stats, ref_stats, counts, output_progress)
+    yield from iter_in_background(batches) if background else batches
+
+
+def iter_duplicates(args: Namespace, scan_dir: str, ref_dir: str, counts: Dict[str, int] = None,
+                    output_progress=False, background=False) -> Iterator[Tuple[str, Dict]]:
+    """
+    Find duplicate files between scan_dir and ref_dir, one group at a time. Same as iter_duplicate_batches(), with
+    the same ordering guarantees, but yields the groups of each batch one by one.
+    :param args: parsed arguments
+    :param scan_dir: the directory to scan for duplicates
+    :param ref_dir: the reference directory
+    :param counts: if given, the number of files, candidates, batches and duplicate groups are added to it
+    :param output_progress: whether to output progress
+    :param background: if True, the duplicates are found in a background thread - see iter_duplicate_batches()
+    :return: generator of (file key, {'scan': [file_info], 'ref': [file_info]})
+    """
+    for batch in iter_duplicate_batches(args, scan_dir, ref_dir, counts, output_progress, background):
+        yield from batch.items()
+
+
+def for_each_duplicate_group(args: Namespace, scan_dir: str, ref_dir: str, on_group, counts: Dict[str, int] = None,
+                             output_progress=False) -> int:
+    """
+    Callback version of iter_duplicates() - the duplicates are found in a background thread, and on_group is called
+    in the calling thread for each group as soon as its batch is keyed, in the order of iter_duplicate_batches().
+    :param args: parsed arguments
+    :param scan_dir: the directory to scan for duplicates
+    :param ref_dir: the reference directory
+    :param on_group: function called for each group - func(file_key, locations)
+    :param counts: if given, the number of files, candidates, batches and duplicate groups are added to it
+    :param output_progress: whether to output progress
+    :return: number of groups
+    """
+    groups = 0
+    for file_key, locations in iter_duplicates(args, scan_dir, ref_dir, counts, output_progress, background=True):
+        on_group(file_key, locations)
+        groups += 1
+    return groups
 
+
+def merge_duplicate_groups(duplicate_groups: Iterable[Tuple[str, Dict]]) -> Dict:
+    """
+    Collect the duplicate groups yielded by iter_duplicates() into a dictionary. A key yielded in more than one batch
+    is merged into a single group, as find_duplicates_files_v3() always did.
+    :param duplicate_groups: the (file key, locations) pairs
+    :return: Dictionary of duplicates - {file_key: {'scan': [file_info], 'ref': [file_info]}}
+    """
+    combined = {}
+    for file_key, locations in duplicate_groups:
+        if file_key in combined:
+            for side in ['scan', 'ref']:
+                locations[side] = sorted(combined[file_key][side] + locations[side], key=lambda x: x['path'])
+        combined[file_key] = locations
+    return combined
+
+
+def find_duplicates_files_v3(args: Namespace, scan_dir: str, ref_dir: str, output_progress=False) \
+        -> (Dict, List[Dict], List[Dict]):
+    """
+     Find duplicate files between scan_dir and ref directories.
+     Returns a dictionary of duplicates and the file stats for both directories. Use iter_duplicates() to process the
+     duplicates as they are found, without holding the file stats in memory.
+    :param args: parsed arguments
+    :param scan_dir: the directory to scan for duplicates
+    :param ref_dir: the reference directory
+    :param output_progress: whether to output progress
+    :return: a dictionary of duplicates, the file stats for the scan directory, and the file stats for the reference directory
+             Dictionary format: {file_key: {'scan': [file_info], 'ref': [file_info]}}
+    """
+    if output_progress:
+        print(f"Scanning directories for duplicates: {scan_dir} and {ref_dir}")
+
+    # Get the file stats for both directories, filtered based on the arguments
+    with MetricsCollector.stage('walk'):
+        scan_stats, ref_stats = get_files_and_stats_for_dirs(args, scan_dir, ref_dir)
+    batches = iter_duplicate_batches_of_stats(args, scan_dir, ref_dir, scan_stats, ref_stats,
+                                              output_progress=output_progress)
+    combined = merge_duplicate_groups(group for batch in batches for group in batch.items())
     return combined, scan_stats, ref_stats
 
 
+def get_key_digest(file_key: str | None) -> str | None:
+    """
+    Get the hash of the files of a duplicate group from its key - see get_file_key().
+    :param file_key: the key of the group
+    :return: the hash, or None if the key has none - e.g. hardlinks paired without reading them
+    """
+    if not file_key or file_key.startswith('inode_'):
+        return None
+    return file_key.split('_', 1)[0]
+
+
+def add_duplicate_operations(args: Namespace, executor: FileOperationsExecutor, locations: Dict, file_key: str = None):
+    """
+    Add the operations of a group of duplicates to an executor - move the scan file to the move_to folder, in the
+    structure of its reference file, or with copy_to_all, move or copy it next to every reference file.
+    :param args: parsed arguments
+    :param executor: the executor of the move_to folder
+    :param locations: the locations of the group - {'scan': [file_info], 'ref': [file_info]}
+    :param file_key: the key of the group, if known - its hash is written to the action plan of a test run
+    """
+    digest = get_key_digest(file_key)
+
+    def add_operation(operation: str, scan_file: Dict, ref_file: Dict):
+        destination = get_destination_path(scan_file['path'], args.move_to, ref_file['path'], args.reference_dir,
+                                           args.keep_structure, args.scan_dir)
+        executor.add(operation, scan_file['path'], destination, scan_file, digest)
+
+    scan_files = locations.get('scan', [])
+    ref_files = locations.get('ref', [])
+
+    # Copy or move files to reference locations
+    if not args.copy_to_all:
+        add_operation('move', scan_files[0], ref_files[0])
+    else:
+        num_to_copy = max(0, len(ref_files) - len(scan_files))
+        for i in range(num_to_copy):
+            add_operation('copy', scan_files[0], ref_files[i])
+        for scan_file, ref_file in zip(scan_files, ref_files[num_to_copy:]):
+            add_operation('move', scan_file, ref_file)
+
+
 def process_duplicates(combined: Dict, args: Namespace) -> (int, int):
     """
     Process the duplicates from source by moving or copying the files to the move_to folder.
+    The operations are collected first and executed as a batch - see FileOperationsExecutor.
     :param combined: the dictionary of duplicates returned by find_duplicates_files_v3
     :param args: parsed arguments
     :return: number of files moved, number of files created
     """
-    files_created = files_moved = 0
+    executor = FileOperationsExecutor(args.move_workers, show_progress=True, desc='Processing duplicates',
+                                      destination_root=args.move_to)
 
-    # Process each file key in the combined dictionary - it contains the scan and ref locations of the duplicates
-    for file_key, locations in tqdm.tqdm(combined.items(), desc='Processing duplicates'):
-        scan_files = locations.get('scan', [])
-        ref_files = locations.get('ref', [])
+    # Plan the operations of each file key in the combined dictionary - it contains the scan and ref locations
+    for file_key, locations in combined.items():
+        add_duplicate_operations(args, executor, locations, file_key)
 
-        src_filepath = scan_files[0]['path']
-        srcs_to_move = [(file['path'], 0) for file in scan_files]
+    results = executor.run()
+    return results['moved'], results['copied']
 
-        # Copy or move files to reference locations
-        if not args.copy_to_all:
-            copy_or_move_file(src_filepath, args.move_to, ref_files[0]['path'], args.reference_dir, move=True,
-                              keep_structure=args.keep_structure, scan_base_path=args.scan_dir)
-            files_moved += 1
-        else:
-            num_to_copy = max(0, len(ref_files) - len(srcs_to_move))
-            for i in range(num_to_copy):
-                copy_or_move_file(src_filepath, args.move_to, ref_files[i]['path'], args.reference_dir, move=False,
-                                  keep_structure=args.keep_structure, scan_base_path=args.scan_dir)
-                files_created += 1
 
-            for (src, _), tgt in zip(srcs_to_move, ref_files[num_to_copy:]):
-                copy_or_move_file(src, args.move_to, tgt['path'], args.reference_dir, move=True,
-                                  keep_structure=args.keep_structure, scan_base_path=args.scan_dir)
-                files_moved += 1
+def process_duplicate_batches(args: Namespace, duplicate_batches: Iterable[Dict], plan=None) -> (int, int, int):
+    """
+    Process the duplicates batch by batch, as they are found - see iter_duplicate_batches(). The files of a batch are
+    moved before the next batch is consumed: first the operations of process_duplicates(), then the scan files left
+    in the groups are moved to the scan duplicates folder, as in clean_scan_dir_duplications(). If the run stops,
+    the batches processed so far are done. With background=True, the next batches are hashed while moving.
+    If a JobState is set up, each batch is checkpointed once its files are moved (in run mode), so a resumed job
+    skips it.
+    The scan duplicates folder is under the move_to folder, so both executors plan their names with the same
+    listing - each one sees the files the other one moved.
+    :param args: parsed arguments
+    :param duplicate_batches: the duplicates of each batch, e.g. iter_duplicate_batches(background=True)
+    :param plan: ActionPlanWriter to write the operations of a test run to, if any - see --apply_plan
+    :return: number of files moved, number of files created, number of duplicate scan files moved
+    """
+    planner = DestinationPlanner(args.move_to)
+    executor = FileOperationsExecutor(args.move_workers, show_progress=True, desc='Processing duplicates', plan=plan,
+                                      planner=planner)
+    scan_dups_move_to = get_scan_dups_move_to(args)
+    scan_dups_executor = FileOperationsExecutor(args.move_workers, show_progress=True,
+                                                desc='Moving scan folder duplicates', plan=plan, planner=planner)
+    job = JobState.get_instance() if JobState.is_initialized() else None
+    files_moved = files_created = duplicate_scan_files_moved = 0
+    for batch in duplicate_batches:
+        with MetricsCollector.stage('actions'):
+            for file_key, locations in batch.items():
+                add_duplicate_operations(args, executor, locations, file_key)
+            results = executor.run()
+            files_moved += results['moved']
+            files_created += results['copied']
+            duplicate_scan_files_moved += add_scan_duplicate_moves(args, scan_dups_executor, scan_dups_move_to,
+                                                                   batch)
+            scan_dups_executor.run()
+        if job is not None and FileManager.get_instance().run_mode:
+            job.complete_batch()
+    if executor.skipped or scan_dups_executor.skipped:
+        logger.info(f"Skipped {executor.skipped + scan_dups_executor.skipped} file operations done by a previous "
+                    f"run of the job")
+    return files_moved, files_created, duplicate_scan_files_moved
+
+
+def link_duplicates(args: Namespace, combined: Dict) -> (int, int):
+    """
+    Replace the duplicates in the scan folder with links to their reference file - reflinks or hardlinks, according
+    to args.link_type. The content of each file is compared byte by byte with the reference file before it is
+    replaced, as the default partial hash doesn't prove the files are identical.
+    :param args: parsed arguments
+    :param combined: the dictionary of duplicates returned by find_duplicates_files_v3
+    :return: number of files linked, number of bytes reclaimed
+    """
+    fm = FileManager.get_instance()
+    files_linked = bytes_reclaimed = 0
+
+    for file_key, locations in tqdm.tqdm(combined.items(), desc='Linking duplicates'):
+        target = locations['ref'][0]
+        for file_info in locations.get('scan', []):
+            if FileManager.get_inode(file_info) is not None and \
+                    FileManager.get_inode(file_info) == FileManager.get_inode(target):
+                continue  # already a hardlink of the reference file
+            try:
+                if not filecmp.cmp(file_info['path'], target['path'], shallow=False):
+                    logger.warning(f"Not linking {file_info['path']} - its content differs from {target['path']}")
+                    continue
+                last_link = os.stat(file_info['path']).st_nlink == 1  # else the data is still used by other links
+                fm.link_file(target['path'], file_info['path'], args.link_type)
+            except OSError as e:
+                logger.error(f"Error linking {file_info['path']} to {target['path']}: {e}")
+                continue
+            files_linked += 1
+            if last_link:
+                bytes_reclaimed += int(file_info['size'])
 
-    return files_moved, files_created
+    return files_linked, bytes_reclaimed
 
 
 def get_csv_file_path(args: Namespace) -> str:
     """
-    Get the path of the CSV file to create.
+    Get the path of the report file to create - a CSV file by default, see --report_format.
     :param args: parsed arguments
-    :return: the path of the CSV file
+    :return: the path of the report file - sharded reports add a part number to it
     """
-    return str(os.path.join(args.move_to, os.path.basename(args.scan_dir) + "_dups.csv"))
+    extension = get_report_extension(args.report_format, args.report_gzip)
+    return str(os.path.join(args.move_to, os.path.basename(args.scan_dir) + "_dups" + extension))
 
 
-def create_csv_file(args: Namespace, combined: Dict) -> None:
+def create_csv_file(args: Namespace, combined: Dict | Iterable[Tuple[str, Dict]]) -> List[str]:
     """
-    Create a CSV file with the duplicate files' information.
+    Create a report with the duplicate files' information - a CSV file by default, see --report_format.
+    Groups are written one at a time, so the report is not built in memory.
     :param args: parsed arguments
-    :param combined: the dictionary of duplicates returned by find_duplicates_files_v3
-    :return: number of files moved
+    :param combined: the dictionary of duplicates returned by find_duplicates_files_v3, or the (file key, locations)
+                     pairs yielded by iter_duplicates - each group is written as soon as it is found
+    :return: the paths of the report files
     """
-    csv_file = get_csv_file_path(args)
     if not os.path.exists(args.move_to):
         FileManager.get_instance().make_dirs(args.move_to)
 
-    # Every line in the CSV file will contain a single duplicate file. The first line will contain the header.
-    with open(csv_file, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(["key", "path", "size", "modified_time"])
-        key = 1
-        for file_key, locations in combined.items():
-            for category, files in locations.items():
-                for file in files:
-                    writer.writerow([key, file['path'], file['size'], datetime.fromtimestamp(file['modified_time'])])
-            key += 1
+    # Every row in the report contains a single duplicate file, with the number of its group as the key
+    with create_report_sink(args.report_format, get_csv_file_path(args), args.report_gzip,
+                            args.report_shard_rows) as sink:
+        for file_key, locations in combined.items() if isinstance(combined, dict) else combined:
+            with MetricsCollector.stage('actions'):  # the groups may be found lazily, between the writes
+                sink.write_group(locations)
+    return sink.paths
+
+
+def get_scan_dups_move_to(args: Namespace) -> str:
+    """ Get the folder the duplicates left in the scan folder are moved to. """
+    return str(os.path.join(args.move_to, os.path.basename(args.scan_dir) + "_dups"))
+
+
+def add_scan_duplicate_moves(args: Namespace, executor: FileOperationsExecutor, scan_dups_move_to: str,
+                             combined: Dict) -> int:
+    """
+    Add the moves of the scan files that are still in the scan folder to an executor.
+    :param args: parsed arguments
+    :param executor: the executor of the scan duplicates folder
+    :param scan_dups_move_to: the scan duplicates folder
+    :param combined: the duplicates - the files under 'scan' (for all keys) are moved
+    :return: number of files added
+    """
+    scan_files = [(key, file_info) for key, locations in combined.items() if 'scan' in locations for file_info in
+                  locations['scan'] if os.path.exists(file_info['path'])]
+    for key, file_info in scan_files:
+        src_path = file_info['path']
+        executor.add('move', src_path, get_destination_path(src_path, scan_dups_move_to, src_path, args.scan_dir,
+                                                            args.keep_structure, args.scan_dir), file_info,
+                     get_key_digest(key))
+    return len(scan_files)
 
 
 def clean_scan_dir_duplications(args: Namespace, combined: Dict) -> int:
@@ -253,10 +1217,9 @@ def clean_scan_dir_duplications(args: Namespace, combined: Dict) -> int:
     :param combined: a dictionary which all the files under 'scan' (for all keys) are moved to the move_to folder
     :return: number of files moved
     """
-    scan_paths = [file_info['path'] for key, locations in combined.items() if 'scan' in locations for file_info in
-                  locations['scan'] if os.path.exists(file_info['path'])]
-    scan_dups_move_to: str = str(os.path.join(args.move_to, os.path.basename(args.scan_dir) + "_dups"))
-    for src_path in scan_paths:
-        copy_or_move_file(src_path, scan_dups_move_to, src_path, args.scan_dir, move=True,
-                          keep_structure=args.keep_structure, scan_base_path=args.scan_dir)
-    return len(scan_paths)
+    scan_dups_move_to = get_scan_dups_move_to(args)
+    executor = FileOperationsExecutor(args.move_workers, show_progress=True, desc='Moving scan folder duplicates',
+                                      destination_root=scan_dups_move_to)
+    files_moved = add_scan_duplicate_moves(args, executor, scan_dups_move_to, combined)
+    executor.run()
+    return files_moved
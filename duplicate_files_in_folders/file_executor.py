@@ -0,0 +1,280 @@
+import concurrent.futures
+import logging
+import os
+from typing import Dict, List, Set, Tuple
+
+import tqdm
+
+from duplicate_files_in_folders.file_manager import FileManager
+from duplicate_files_in_folders.job_state import JobState
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+
+class DestinationPlanner:
+    """
+    Chooses the destination paths of a batch in memory, without checking each path on disk.
+    Each folder is listed once, the first time a destination in it is planned, so the destination root is never walked
+    as a whole. Every planned path is added to the names, so later destinations never collide with it. Executors that
+    write under the same root share its planner, as a listing doesn't see the files other executors moved after it.
+    A path that is taken is renamed with the first free numeric suffix - 'name_1.ext', 'name_2.ext' and so on - so
+    the same batch always gets the same names.
+    """
+
+    def __init__(self, root: str = None):
+        self.names: Dict[str, Set[str]] = {}  # folder -> names of the files and folders in it
+        self.existing_dirs: Set[str] = set()  # folders that exist on disk
+        self.next_suffix: Dict[str, int] = {}  # path -> next suffix to try, so renaming many files stays linear
+        self.root = self.get_key(root) if root else None
+
+    @staticmethod
+    def get_key(path: str) -> str:
+        """ Normalize a folder path, to use it as a key. """
+        return os.path.normcase(os.path.abspath(path))
+
+    def is_under_root(self, key: str) -> bool:
+        """ Check if a normalized folder is the root or under it. """
+        return self.root is not None and (key == self.root or key.startswith(self.root.rstrip(os.sep) + os.sep))
+
+    def get_names(self, dir_path: str) -> Set[str]:
+        """
+        Get the names in a folder - listed the first time the folder is used.
+        :param dir_path: the folder
+        :return: the set of names, including the planned ones - empty if the folder doesn't exist yet
+        """
+        key = self.get_key(dir_path)
+        if key not in self.names:
+            names = set()
+            try:
+                names = {os.path.normcase(name) for name in os.listdir(dir_path)}
+                self.existing_dirs.add(key)
+            except OSError:
+                pass
+            self.names[key] = names
+        return self.names[key]
+
+    def plan(self, dst: str) -> str:
+        """
+        Plan a destination path.
+        :param dst: the requested destination path
+        :return: dst if it is free, else dst with the first free suffix
+        """
+        dir_path, file_name = os.path.split(dst)
+        names = self.get_names(dir_path)
+        destination = file_name
+        if os.path.normcase(file_name) in names:
+            base, ext = os.path.splitext(file_name)
+            suffix = self.next_suffix.get(dst, 1)
+            while os.path.normcase(f"{base}_{suffix}{ext}") in names:
+                suffix += 1
+            self.next_suffix[dst] = suffix + 1
+            destination = f"{base}_{suffix}{ext}"
+            logger.info(f"Renaming of {dst} to {destination} is needed to avoid overwrite.")
+        names.add(os.path.normcase(destination))
+
+        # new folders under the root are planned too, so files don't collide with them
+        while self.is_under_root(self.get_key(dir_path)) and self.get_key(dir_path) != self.root:
+            parent, name = os.path.split(dir_path)
+            parent_names = self.get_names(parent)
+            if os.path.normcase(name) in parent_names:
+                break
+            parent_names.add(os.path.normcase(name))
+            dir_path = parent
+        return os.path.join(os.path.dirname(dst), destination)
+
+    def dir_exists(self, dir_path: str) -> bool:
+        """ Check if a folder existed when it was listed. """
+        self.get_names(dir_path)
+        return self.get_key(dir_path) in self.existing_dirs
+
+
+class FileOperationsExecutor:
+    """
+    Executes a batch of move and copy operations, instead of running them one at a time as they are found.
+    - Destination names are chosen in memory when the operations are added - see DestinationPlanner - so no two
+      operations write the same path and existing files are not overwritten.
+    - Destination folders are created once, before any file is moved or copied.
+    - Copies run before moves, since a copied file may be moved by a later operation.
+    - Operations are grouped by (source device, destination device). Moves on the same device are renames - they
+      run one after the other, as they only update the folders. Operations across devices copy the data, so they
+      run in a thread pool of at most max_workers threads.
+    - Progress is reported in bytes.
+    All file operations go through the FileManager, so protected paths and test mode are honored. Each path is
+    resolved once, when its operation is added, and destination folders are resolved once for all their files.
+    If a JobState is set up (--job / --resume), every operation is journaled in run mode, and operations that a
+    previous run of the job already did are skipped when they are added.
+    If a plan is given, the operations of a test run are written to it as they would have been executed - see
+    ActionPlanWriter.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_WORKERS, show_progress: bool = False, desc: str = 'Moving files',
+                 destination_root: str = None, plan=None, planner: DestinationPlanner = None):
+        """
+        :param max_workers: maximum number of threads for operations across devices
+        :param show_progress: show a progress bar
+        :param desc: description of the progress bar
+        :param destination_root: the folder the files are moved or copied to - its folders are listed to plan the names
+        :param plan: ActionPlanWriter to write the operations of a test run to, if any
+        :param planner: the DestinationPlanner of another executor writing under the same root, instead of listing
+                        destination_root again
+        """
+        self.max_workers = max(1, max_workers)
+        self.show_progress = show_progress
+        self.desc = desc
+        self.operations: List[Dict] = []
+        self.planner = planner if planner is not None else DestinationPlanner(destination_root)
+        self.resolved_dirs: Dict[str, str] = {}  # destination folder -> resolved destination folder
+        self.job = JobState.get_instance() if JobState.is_initialized() else None
+        self.skipped = 0  # operations skipped because a previous run of the job did them
+        self.plan = plan
+
+    def add(self, operation: str, src: str, dst: str, file_info: Dict = None, digest: str = None) -> str:
+        """
+        Add an operation to the batch.
+        :param operation: 'move' or 'copy'
+        :param src: path to the source file
+        :param dst: requested path of the destination file - renamed if it exists or is used by another operation
+        :param file_info: the file information of src, if known - its size and device are used instead of stat-ing it
+        :param digest: the hash of src, if known - written to the action plan
+        :return: the final destination path
+        """
+        if operation not in ('move', 'copy'):
+            raise ValueError(f"Invalid operation: {operation}")
+        resolved_src = FileManager.resolve_path(src)
+        if self.job is not None and self.job.is_action_done(operation, resolved_src, dst):
+            self.skipped += 1
+            if operation == 'move':  # its folder may be empty now, like after any other move
+                FileManager.get_instance().moved_from_dirs.add(os.path.dirname(resolved_src))
+            return self.job.get_action_destination(operation, resolved_src, dst)
+        destination = self.planner.plan(dst)
+        if file_info is None:
+            file_info = FileManager.get_file_info(src)
+        dst_dir, dst_name = os.path.split(destination)
+        if dst_dir not in self.resolved_dirs:
+            self.resolved_dirs[dst_dir] = FileManager.resolve_path(dst_dir)
+        self.operations.append({'operation': operation, 'src': resolved_src, 'requested': dst,
+                                'dst': os.path.join(self.resolved_dirs[dst_dir], dst_name),
+                                'size': int(file_info['size']), 'src_dev': file_info.get('dev'),
+                                'mtime': file_info.get('modified_time'), 'digest': digest})
+        return destination
+
+    @staticmethod
+    def get_device(path: str, devices_cache: Dict[str, int | None]) -> int | None:
+        """
+        Get the device of a path, or of its nearest existing parent - destination folders don't exist in test mode.
+        :param path: the path
+        :param devices_cache: cache of folder devices
+        :return: the device id, or None if no parent exists
+        """
+        if path in devices_cache:
+            return devices_cache[path]
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            device = FileOperationsExecutor.get_device(parent, devices_cache) if parent != path else None
+        devices_cache[path] = device
+        return device
+
+    def group_by_devices(self, operations: List[Dict]) -> Dict[Tuple, List[Dict]]:
+        """
+        Group operations by their (source device, destination device).
+        :param operations: list of operations
+        :return: dictionary of (source device, destination device) to the operations
+        """
+        devices_cache = {}
+        groups = {}
+        for op in operations:
+            src_dev = op['src_dev'] if op['src_dev'] is not None else \
+                self.get_device(os.path.dirname(op['src']), devices_cache)
+            dst_dev = self.get_device(os.path.dirname(op['dst']), devices_cache)
+            groups.setdefault((src_dev, dst_dev), []).append(op)
+        return groups
+
+    def create_destination_dirs(self):
+        """ Create the destination folders of all the operations, once. """
+        fm = FileManager.get_instance()
+        dirs = {os.path.dirname(op['dst']) for op in self.operations}
+        for dir_path in sorted(dirs):  # parents first, make_dirs() creates the missing parents anyway
+            if not self.planner.dir_exists(dir_path):
+                fm.make_dirs(dir_path, resolved=True)
+
+    def run(self) -> Dict[str, int]:
+        """
+        Execute all the operations of the batch.
+        :return: dictionary with the number of files 'moved' and 'copied', and the 'bytes' processed
+        :raises: the first error of an operation, after the running operations are finished
+        """
+        results = {'moved': 0, 'copied': 0, 'bytes': 0}
+        if not self.operations:
+            return results
+        self.create_destination_dirs()
+
+        total_bytes = sum(op['size'] for op in self.operations)
+        with tqdm.tqdm(total=total_bytes, unit='B', unit_scale=True, unit_divisor=1024, desc=self.desc,
+                       disable=not self.show_progress) as progress_bar:
+            for operation in ['copy', 'move']:
+                operations = [op for op in self.operations if op['operation'] == operation]
+                local_ops, remote_ops = [], []
+                for (src_dev, dst_dev), group in self.group_by_devices(operations).items():
+                    same_device = operation == 'move' and src_dev is not None and src_dev == dst_dev
+                    (local_ops if same_device else remote_ops).extend(group)
+                    logger.debug(f"{len(group)} files to {operation} from device {src_dev} to device {dst_dev}")
+
+                for op in local_ops:
+                    self.execute(op)
+                    progress_bar.update(op['size'])
+                if remote_ops:
+                    self.execute_parallel(remote_ops, progress_bar)
+
+                results['moved' if operation == 'move' else 'copied'] += len(operations)
+            results['bytes'] = total_bytes
+        self.operations = []
+        return results
+
+    def execute_parallel(self, operations: List[Dict], progress_bar: tqdm.tqdm):
+        """
+        Execute operations in a thread pool of at most max_workers threads.
+        :param operations: list of operations
+        :param progress_bar: progress bar to update with the bytes of each finished operation
+        """
+        if self.max_workers == 1 or len(operations) == 1:
+            for op in operations:
+                self.execute(op)
+                progress_bar.update(op['size'])
+            return
+
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.execute, op): op for op in operations}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+                        for pending in futures:  # finish the running operations, skip the rest
+                            pending.cancel()
+                progress_bar.update(futures[future]['size'])
+        if error is not None:
+            raise error
+
+    def execute(self, op: Dict):
+        """
+        Execute a single operation.
+        :param op: the operation
+        """
+        fm = FileManager.get_instance()
+        journal = self.job is not None and fm.run_mode
+        if journal:
+            self.job.action_started(op)
+        if op['operation'] == 'move':
+            fm.move_file(op['src'], op['dst'], resolved=True)  # records the source folder in fm.moved_from_dirs
+        else:
+            fm.copy_file(op['src'], op['dst'], resolved=True)
+        if journal:
+            self.job.action_done(op)
+        if self.plan is not None and not fm.run_mode:
+            self.plan.add(op)
@@ -0,0 +1,144 @@
+import fnmatch
+import os
+import re
+from argparse import Namespace
+from typing import Dict, List, Set
+
+
+class FileFilter:
+    """
+    Filter for the folders and files found while walking a directory tree, compiled once from the arguments.
+    The walker applies it in steps, so rejected files are never stat-ed or materialized:
+    accepts_dir() is checked before a folder is descended into, accepts_name() before a file is stat-ed, and
+    accepts_stats() right after it.
+    The reference snapshot (TreeSnapshot) only applies accepts_dir() while walking: it stats and keeps every file of the
+    folders it walks, so it can be reused with other filters, and filters the files when it returns them.
+    Extensions and glob patterns are matched case-insensitively against names, and extensions can have several dots,
+    e.g. 'tar.gz' matches 'backup.TAR.GZ'. Regular expressions are searched in names as they are.
+    """
+
+    def __init__(self, whitelist_ext: Set[str] = None, blacklist_ext: Set[str] = None, min_size: int = None,
+                 max_size: int = None, exclude_dir: List[str] = None, exclude_dir_regex: str = None,
+                 include: List[str] = None, include_regex: str = None, modified_after: float = None,
+                 modified_before: float = None):
+        self.whitelist_ext = self.normalize_extensions(whitelist_ext)
+        self.blacklist_ext = self.normalize_extensions(blacklist_ext)
+        self.min_size = min_size if min_size is not None else 0
+        self.max_size = max_size if max_size is not None else float('inf')
+        self.modified_after = modified_after if modified_after is not None else float('-inf')
+        self.modified_before = modified_before if modified_before is not None else float('inf')
+        self.exclude_dir = self.compile_patterns(exclude_dir, exclude_dir_regex)
+        self.include = self.compile_patterns(include, include_regex)
+
+        # the maximum number of dots in an extension - longer suffixes of a file name are not checked
+        extensions = (self.whitelist_ext or set()) | (self.blacklist_ext or set())
+        self.max_ext_parts = max((ext.count('.') + 1 for ext in extensions), default=0)
+
+    @classmethod
+    def from_args(cls, args: Namespace) -> 'FileFilter | None':
+        """
+        Create a filter from the parsed arguments.
+        :param args: parsed arguments
+        :return: the filter, or None if the arguments don't filter any file
+        """
+        filter_args = {'whitelist_ext': args.whitelist_ext, 'blacklist_ext': args.blacklist_ext,
+                       'min_size': args.min_size, 'max_size': args.max_size, 'exclude_dir': args.exclude_dir,
+                       'exclude_dir_regex': args.exclude_dir_regex, 'include': args.include,
+                       'include_regex': args.include_regex, 'modified_after': args.modified_after,
+                       'modified_before': args.modified_before}
+        if all(value is None for value in filter_args.values()):
+            return None
+        return cls(**filter_args)
+
+    @staticmethod
+    def normalize_extensions(extensions: Set[str] | None) -> Set[str] | None:
+        """
+        Normalize extensions to lower case without a leading dot.
+        :param extensions: set of extensions, e.g. {'JPG', '.tar.gz'}
+        :return: the normalized set, or None if no extensions are given
+        """
+        if not extensions:
+            return None
+        return {ext.strip().lstrip('.').lower() for ext in extensions if ext.strip().lstrip('.')}
+
+    @staticmethod
+    def compile_patterns(globs: List[str] | None, regex: str | None) -> List[re.Pattern] | None:
+        """
+        Compile glob patterns into a single matcher, and a regular expression into another one.
+        The regular expression is compiled on its own, so it can start with global flags, e.g. '(?i)^tmp'.
+        :param globs: list of glob patterns, matched case-insensitively against the whole name
+        :param regex: regular expression, searched in the name
+        :return: the compiled matchers - a name matches if any of them finds it, or None if there are no patterns
+        """
+        matchers = []
+        if globs:  # globs match whole names
+            matchers.append(re.compile('|'.join('(?i:^' + fnmatch.translate(glob) + ')' for glob in globs)))
+        if regex:
+            matchers.append(re.compile(regex))
+        return matchers or None
+
+    @staticmethod
+    def search_patterns(matchers: List[re.Pattern], name: str) -> bool:
+        """
+        Check if a name matches any of the compiled matchers.
+        :param matchers: the matchers from compile_patterns()
+        :param name: the file or folder name
+        :return: True if any of the matchers is found in the name
+        """
+        return any(matcher.search(name) for matcher in matchers)
+
+    def get_extensions(self, name: str) -> Set[str]:
+        """
+        Get all the possible extensions of a file name, up to the longest extension of the filter.
+        :param name: the file name
+        :return: set of extensions, e.g. {'gz', 'tar.gz'} for 'backup.tar.gz'
+        """
+        parts = name.lower().split('.')[1:]
+        return {'.'.join(parts[-i:]) for i in range(1, min(len(parts), self.max_ext_parts) + 1)}
+
+    def accepts_dir(self, name: str) -> bool:
+        """
+        Check the folder filters - checked before the folder is descended into, so excluded subtrees are not walked.
+        :param name: the folder name
+        :return: True if the folder should be walked
+        """
+        return self.exclude_dir is None or not self.search_patterns(self.exclude_dir, name)
+
+    def accepts_name(self, name: str) -> bool:
+        """
+        Check the file name filters - checked before the file is stat-ed.
+        :param name: the file name
+        :return: True if the file name passes the include and extension filters
+        """
+        if self.include is not None and not self.search_patterns(self.include, name):
+            return False
+        if self.whitelist_ext is None and self.blacklist_ext is None:
+            return True
+        extensions = self.get_extensions(name)
+        if self.whitelist_ext is not None and extensions.isdisjoint(self.whitelist_ext):
+            return False
+        return self.blacklist_ext is None or extensions.isdisjoint(self.blacklist_ext)
+
+    def accepts_stats(self, size: int, modified_time: float) -> bool:
+        """
+        Check the file size and modified time filters - checked right after the file is stat-ed.
+        :param size: the file size in bytes
+        :param modified_time: the file modified time, as a timestamp
+        :return: True if the file size and modified time are within the limits
+        """
+        return self.min_size <= size <= self.max_size and self.modified_after <= modified_time <= self.modified_before
+
+    def accepts(self, file_info: Dict, base_dir: str = None) -> bool:
+        """
+        Check all the filters on a file that was already stat-ed, e.g. a file loaded from a manifest.
+        :param file_info: the file information, in the format of FileManager.get_files_and_stats()
+        :param base_dir: if given, the folders of the file path under base_dir are checked with accepts_dir()
+        :return: True if the file passes all the filters
+        """
+        if not (self.accepts_name(file_info['name']) and
+                self.accepts_stats(int(file_info['size']), file_info['modified_time'])):
+            return False
+        if base_dir is None or self.exclude_dir is None:
+            return True
+        relative_folder = os.path.relpath(os.path.dirname(file_info['path']), base_dir)
+        return relative_folder == '.' or all(self.accepts_dir(name) for name in relative_folder.split(os.sep))
@@ -2,10 +2,22 @@ from pathlib import Path
 import shutil
 import os
 import logging
+import errno
+import sys
+import threading
+import concurrent.futures
 from collections import deque
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
 import tqdm
 
+from duplicate_files_in_folders.file_filter import FileFilter
+from duplicate_files_in_folders.metrics import MetricsCollector
+
+try:
+    import fcntl  # not available on Windows
+except ImportError:
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,16 +30,72 @@ class ProtectedPathError(FileManagerError):
         super().__init__(message)
 
 
+class PathMatcher:
+    """
+    Matches paths against a set of directories - a path matches if it is one of the directories or is inside one.
+    The directories are compiled into a trie of their path components, so a check takes O(depth of the path) and
+    doesn't depend on the number of directories. Paths must already be resolved - see FileManager.resolve_path().
+    """
+
+    END = None  # key of the trie node that marks the end of a directory
+
+    def __init__(self, dirs: List[str] = None):
+        self.trie = {}
+        for dir_path in dirs or []:
+            self.add(dir_path)
+
+    @staticmethod
+    def split(path: str) -> List[str]:
+        """ Split a resolved path into its components, e.g. '/a/b' -> ['', 'a', 'b'] and 'C:\\a' -> ['c:', 'a']. """
+        return os.path.normcase(path).rstrip(os.sep).split(os.sep)
+
+    def add(self, dir_path: str):
+        """ Add a resolved directory path. """
+        node = self.trie
+        for part in self.split(dir_path):
+            node = node.setdefault(part, {})
+        node[self.END] = True
+
+    def matches(self, path: str) -> bool:
+        """
+        :param path: resolved path
+        :return: True if the path is one of the directories or inside one of them
+        """
+        node = self.trie
+        for part in self.split(path):
+            node = node.get(part)
+            if node is None:
+                return False
+            if self.END in node:
+                return True
+        return False
+
+
 class FileManager:
     _instance = None
     protected_dirs = set()
     allowed_dirs = set()  # If set, only operations in these directories are allowed. Acts as a whitelist
     run_mode = False
 
+    FICLONE = 0x40049409  # Linux ioctl that clones the content of a file (reflink) - Btrfs, XFS, bcachefs etc.
+    LINK_TYPES = ['auto', 'reflink', 'hardlink']
+    # copy_file() tries these in order - from kernel-side copies (or free, on filesystems that share blocks) to a
+    # plain read/write loop
+    COPY_METHODS = ['copy_file_range', 'reflink', 'sendfile', 'buffered']
+    COPY_BUFFER_SIZE = 1024 * 1024
+    COPY_CHUNK_SIZE = 1024 * 1024 * 1024  # bytes per copy_file_range/sendfile call
+    # errors that mean a copy method is not supported for these files, so the next one is tried
+    COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY,
+                            errno.EBADF, errno.ETXTBSY, errno.EPERM, errno.ENOTSOCK}
+
     def __new__(cls, run_mode, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(FileManager, cls).__new__(cls, *args, **kwargs)
             cls._instance.run_mode = run_mode
+            cls._instance.copy_methods = {}  # number of files copied by each method
+            cls._instance.moved_from_dirs = set()  # resolved folders files were moved out of - they may be empty now
+            cls._instance.protected_matcher = PathMatcher([str(dir_path) for dir_path in cls.protected_dirs])
+            cls._instance.allowed_matcher = PathMatcher([str(dir_path) for dir_path in cls.allowed_dirs])
         return cls._instance
 
     @classmethod
@@ -56,6 +124,7 @@ class FileManager:
 
         if protected_dir not in self.protected_dirs:
             self.protected_dirs.add(protected_dir)
+            self.protected_matcher.add(str(protected_dir))
 
     def add_allowed_dir(self, dir_path: str | Path):
         """
@@ -72,96 +141,239 @@ class FileManager:
 
         if allowed_dir not in self.allowed_dirs:
             self.allowed_dirs.add(allowed_dir)
+            self.allowed_matcher.add(str(allowed_dir))
 
-    def is_protected_path(self, path: str | Path) -> bool:
+    @staticmethod
+    def resolve_path(path: str | Path) -> str:
+        """
+        Resolve a path - make it absolute and resolve symlinks. Same as Path.resolve(), but returns a string.
+        Batches of operations resolve each path once with it, and pass resolved=True to the operations.
+        :param path: the path
+        :return: the resolved path
+        """
+        return os.path.realpath(path)
+
+    def is_protected_path(self, path: str | Path, resolved: bool = False) -> bool:
         """
         Check if a path is in a protected directory or in a subdirectory of a protected directory
         :param path: path to check
+        :param resolved: True if the path is already resolved
         :return: True if the path is in a protected directory or in a subdirectory of a protected directory
         """
-        path = Path(path).resolve()
         if self.protected_dirs is None:  # This should never happen in real life
             raise FileManagerError("Protected directories not set")
+        path = str(path) if resolved else self.resolve_path(path)
 
         # True if the path is in any of the protected directories or if it is not in any of the allowed directories
         # use is_allowed_path instead of the second condition to avoid a circular dependency
-        return any(path == protected_dir or protected_dir in path.parents for protected_dir in self.protected_dirs) \
-            or not self.is_allowed_path(path)
+        return self.protected_matcher.matches(path) or not self.is_allowed_path(path, resolved=True)
 
-    def is_allowed_path(self, path: str | Path) -> bool:
+    def is_allowed_path(self, path: str | Path, resolved: bool = False) -> bool:
         """
         Check if a path is in an allowed directory or in a subdirectory of an allowed directory
         If allowed_dirs is empty, all paths are allowed
         :param path: path to check
+        :param resolved: True if the path is already resolved
         :return: True if the path is in an allowed directory or in a subdirectory of an allowed directory
         """
-        path = Path(path).resolve()
         if not self.allowed_dirs:
             return True  # If allowed_dirs is an empty set, all paths are allowed
 
         # True if the path is in any of the allowed directories
-        return any(path == allowed_dir or allowed_dir in path.parents for allowed_dir in self.allowed_dirs)
+        return self.allowed_matcher.matches(str(path) if resolved else self.resolve_path(path))
 
-    def move_file(self, src: str, dst: str) -> bool:
+    def move_file(self, src: str, dst: str, resolved: bool = False) -> bool:
         """
         Move a file from src to dst
         :param src: path to the source file
         :param dst: path to the destination file
+        :param resolved: True if the paths are already resolved
         :return: True if the file was moved successfully
         :raises: ProtectedPathError if the source or destination path is in a protected directory
         """
-        src_path = Path(src).resolve()
-        dst_path = Path(dst).resolve()
+        src_path = src if resolved else self.resolve_path(src)
+        dst_path = dst if resolved else self.resolve_path(dst)
 
-        if self.is_protected_path(src_path) or self.is_protected_path(dst_path):
+        if self.is_protected_path(src_path, True) or self.is_protected_path(dst_path, True):
             raise ProtectedPathError(
                 f"Operation not allowed: Attempt to move protected file or to protected directory: {src} -> {dst}")
 
         src_to_dst = f"{src_path} to {dst_path}"
         if self.run_mode:
             shutil.move(src_path, dst_path)
+            MetricsCollector.count('file_operations')
+            self.moved_from_dirs.add(os.path.dirname(src_path))
             logger.info(f"Moved {src_to_dst}")
         else:
             logger.info(f"Would have moved {src_to_dst}")
 
         return True
 
-    def copy_file(self, src: str, dst: str) -> bool:
+    def copy_file(self, src: str, dst: str, resolved: bool = False) -> bool:
         """
         Copy a file from src to dst
         :param src: path to the source file
         :param dst: path to the destination file
+        :param resolved: True if the paths are already resolved
         :return: True if the file was copied successfully
         :raises: ProtectedPathError if the source or destination path is in a protected directory
         """
-        src_path = Path(src).resolve()
-        dst_path = Path(dst).resolve()
+        src_path = src if resolved else self.resolve_path(src)
+        dst_path = dst if resolved else self.resolve_path(dst)
 
-        if self.is_protected_path(dst_path):
+        if self.is_protected_path(dst_path, True):
             raise ProtectedPathError(
                 f"Operation not allowed: Attempt to copy file to protected directory: {src} -> {dst}")
-        if not self.is_allowed_path(src_path):
+        if not self.is_allowed_path(src_path, True):
             raise ProtectedPathError(
                 f"Operation not allowed: Attempt to copy file from disallowed directory: {src} -> {dst}")
 
         src_to_dst = f"{src_path} to {dst_path}"
         if self.run_mode:
-            shutil.copy2(src_path, dst_path)
-            logger.info(f"Copied {src_to_dst}")
+            method = self.copy_file_data(src_path, dst_path)
+            shutil.copystat(src_path, dst_path)  # permissions, times and extended attributes - same as shutil.copy2
+            self.copy_methods[method] = self.copy_methods.get(method, 0) + 1
+            MetricsCollector.count('file_operations')
+            logger.info(f"Copied {src_to_dst} ({method})")
         else:
             logger.info(f"Would have copied {src_to_dst}")
         return True
 
+    @staticmethod
+    def copy_file_data(src: str | Path, dst: str | Path) -> str:
+        """
+        Copy the content of a file with the fastest method the platform and the filesystems support - see
+        COPY_METHODS. copy_file_range copies inside the kernel, and on filesystems like Btrfs, XFS and NFS 4.2 it
+        shares the blocks or copies them on the server, so large copies on the same device are nearly free.
+        A method that fails as unsupported is skipped, and the destination is truncated before the next one.
+        Metadata is not copied.
+        :param src: path to the source file
+        :param dst: path to the destination file - created or overwritten
+        :return: the method that copied the file
+        :raises: OSError if the file cannot be copied
+        """
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            src_fd, dst_fd = src_file.fileno(), dst_file.fileno()
+            size = os.fstat(src_fd).st_size
+            for method in FileManager.COPY_METHODS:
+                try:
+                    if FileManager._copy_with(method, src_fd, dst_fd, size):
+                        return method
+                except OSError as e:
+                    if e.errno not in FileManager.COPY_FALLBACK_ERRNOS:
+                        raise
+                    logger.debug(f"Copy method {method} is not supported for {src} -> {dst}: {e}")
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+        raise OSError(errno.EIO, f"Failed to copy {src} to {dst}")  # the buffered method doesn't fall back
+
+    @staticmethod
+    def _copy_with(method: str, src_fd: int, dst_fd: int, size: int) -> bool:
+        """
+        Copy the content of a file with a single method.
+        :param method: one of COPY_METHODS
+        :param src_fd: file descriptor of the source file, at offset 0
+        :param dst_fd: file descriptor of the empty destination file
+        :param size: size of the source file
+        :return: True if the file was copied, False if the method is not available or copied less than size bytes
+        :raises: OSError if the copy failed
+        """
+        if method == 'reflink':
+            if fcntl is None:
+                return False
+            fcntl.ioctl(dst_fd, FileManager.FICLONE, src_fd)
+            return True
+        if method == 'buffered':
+            while chunk := os.read(src_fd, FileManager.COPY_BUFFER_SIZE):
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(dst_fd, view):]
+            return True
+        if not hasattr(os, method):  # copy_file_range is Linux only, sendfile is not available on Windows
+            return False
+        if method == 'sendfile' and not sys.platform.startswith('linux'):  # macOS and BSD only send to sockets
+            return False
+        copied = 0
+        while copied < size:
+            count = min(size - copied, FileManager.COPY_CHUNK_SIZE)
+            if method == 'copy_file_range':
+                copied_now = os.copy_file_range(src_fd, dst_fd, count)
+            else:
+                copied_now = os.sendfile(dst_fd, src_fd, copied, count)
+            if copied_now == 0:  # some filesystems (e.g. procfs, some FUSE) report end of file too early
+                return False
+            copied += copied_now
+        return True
+
+    @staticmethod
+    def _reflink(src: Path, dst: Path):
+        """
+        Create dst as a reflink (copy-on-write clone) of src. The new file shares the data blocks of src.
+        :param src: path to the source file
+        :param dst: path to the new file - must not exist
+        :raises: OSError if the platform or the filesystem doesn't support reflinks
+        """
+        if fcntl is None:
+            raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+        with open(src, 'rb') as src_file, open(dst, 'xb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FileManager.FICLONE, src_file.fileno())
+
+    def link_file(self, target: str, link_path: str, link_type: str = 'auto') -> str:
+        """
+        Atomically replace a file with a link to another file with the same content - a reflink (a copy-on-write
+        clone) or a hardlink. The link is created under a temporary name in the same folder and renamed over the file,
+        so the file is never missing. A reflink keeps the permissions and times of the replaced file, a hardlink
+        shares them with the target.
+        :param target: path to the file to link to
+        :param link_path: path to the file to replace
+        :param link_type: 'reflink', 'hardlink' or 'auto' - a reflink if the filesystem supports it, else a hardlink
+        :return: the type of the created link - 'reflink' or 'hardlink', or link_type in test mode
+        :raises: ProtectedPathError if the file to replace is in a protected directory
+        :raises: OSError if the link cannot be created, e.g. if the files are on different filesystems
+        """
+        target_path = self.resolve_path(target)
+        file_path = Path(self.resolve_path(link_path))
+
+        if self.is_protected_path(file_path, True):
+            raise ProtectedPathError(
+                f"Operation not allowed: Attempt to replace protected file with a link: {link_path} -> {target}")
+        if link_type not in self.LINK_TYPES:
+            raise ValueError(f"Invalid link type: {link_type}")
+
+        if not self.run_mode:
+            logger.info(f"Would have replaced {file_path} with a {link_type} link to {target_path}")
+            return link_type
+
+        temp_path = file_path.with_name(f".{file_path.name}.{os.getpid()}.link_tmp")
+        error = None
+        for current_type in (['reflink', 'hardlink'] if link_type == 'auto' else [link_type]):
+            try:
+                if current_type == 'reflink':
+                    self._reflink(target_path, temp_path)
+                    shutil.copystat(file_path, temp_path)
+                else:
+                    os.link(target_path, temp_path)
+                os.replace(temp_path, file_path)
+                MetricsCollector.count('file_operations')
+                logger.info(f"Replaced {file_path} with a {current_type} to {target_path}")
+                return current_type
+            except OSError as e:
+                error = e
+                if os.path.lexists(temp_path):
+                    os.remove(temp_path)
+        raise error
+
     def _perform_single_file_operation(self, path: str | Path, operation: str, operation_text: str):
         """
         Perform a single file operation (delete, make_dirs, rmdir) with error handling for protected paths.
 
         :param operation: The operation to perform ('delete', 'make_dirs', 'rmdir').
-        :param path: Path to the file or directory.
+        :param path: Resolved path to the file or directory.
         :raises: ProtectedPathError if the path is in a protected directory.
         :raises: ValueError if the operation is invalid.
         """
-        if self.is_protected_path(path):
+        if self.is_protected_path(path, True):
             raise ProtectedPathError(f"Operation not allowed: Attempt to {operation} protected path: {path}")
 
         if self.run_mode:
@@ -173,38 +385,42 @@ class FileManager:
                 shutil.rmtree(path)
             else:
                 raise ValueError(f"Invalid operation: {operation}")
+            MetricsCollector.count('file_operations')
             logger.info(f"{operation_text.capitalize()} {path}")
         else:
             logger.info(f"Would have {operation_text} {path}")
 
-    def delete_file(self, file_path: str):
+    def delete_file(self, file_path: str, resolved: bool = False):
         """
         Delete a file.
 
         :param file_path: Path to the file.
+        :param resolved: True if the path is already resolved.
         :raises: ProtectedPathError if the file path is in a protected directory.
         """
-        file_path = Path(file_path).resolve()
+        file_path = file_path if resolved else self.resolve_path(file_path)
         self._perform_single_file_operation(file_path, 'delete', 'deleted')
 
-    def make_dirs(self, dir_path: str):
+    def make_dirs(self, dir_path: str, resolved: bool = False):
         """
         Create a directory.
 
         :param dir_path: Path to the directory(s) to create.
+        :param resolved: True if the path is already resolved.
         :raises: ProtectedPathError if the directory path is in a protected directory.
         """
-        dir_path = Path(dir_path).resolve()
+        dir_path = dir_path if resolved else self.resolve_path(dir_path)
         self._perform_single_file_operation(dir_path, 'make_dirs', 'created directory')
 
-    def rmdir(self, dir_path: str):
+    def rmdir(self, dir_path: str, resolved: bool = False):
         """
         Delete a directory.
 
         :param dir_path: Path to the directory(s) to delete.
+        :param resolved: True if the path is already resolved.
         :raises: ProtectedPathError if the directory path is in a protected directory.
         """
-        dir_path = Path(dir_path).resolve()
+        dir_path = dir_path if resolved else self.resolve_path(dir_path)
         self._perform_single_file_operation(dir_path, 'rmdir', 'deleted directory')
 
     @staticmethod
@@ -217,14 +433,57 @@ class FileManager:
         file_path = Path(file_path).resolve()
 
         stats = os.stat(file_path)
+        MetricsCollector.count('stat_calls')
         return {
             'path': str(file_path),
             'name': file_path.name,
             'size': stats.st_size,
             'modified_time': stats.st_mtime,
-            'created_time': stats.st_ctime
+            'created_time': stats.st_ctime,
+            'dev': stats.st_dev,
+            'ino': stats.st_ino
         }
 
+    @staticmethod
+    def get_inode(file_info: Dict) -> Tuple[int, int] | None:
+        """
+        Get the inode of a file - hardlinks of the same file share it.
+        :param file_info: file information, as returned by get_file_info() or get_files_and_stats()
+        :return: tuple of (device, inode), or None if it is not known - e.g. files loaded from a manifest, or on
+                 Windows, where os.scandir() doesn't fill the inode number
+        """
+        inode = file_info.get('ino')
+        return (file_info['dev'], inode) if inode else None
+
+    @staticmethod
+    def get_hardlink_id(file_info: Dict) -> Tuple | None:
+        """
+        Get an id shared by all the hardlinks of the same file content. Inode numbers are reused after files are
+        deleted, so the size and modified time are part of the id.
+        :param file_info: file information, as returned by get_file_info() or get_files_and_stats()
+        :return: tuple of (device, inode, size, modified time), or None if the inode is not known
+        """
+        inode = FileManager.get_inode(file_info)
+        return inode + (file_info['size'], file_info['modified_time']) if inode else None
+
+    @staticmethod
+    def split_hardlinks(file_infos: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Split files into the first hardlink of every file and the other hardlinks, so every file is read only once.
+        Files with an unknown inode are always first links.
+        :param file_infos: list of file information
+        :return: the first hardlinks and the other hardlinks
+        """
+        first_links, other_links, seen_ids = [], [], set()
+        for file_info in file_infos:
+            hardlink_id = FileManager.get_hardlink_id(file_info)
+            if hardlink_id is not None and hardlink_id in seen_ids:
+                other_links.append(file_info)
+            else:
+                first_links.append(file_info)
+                seen_ids.add(hardlink_id)
+        return first_links, other_links
+
     @staticmethod
     def list_tree_os_scandir_bfs(directory: str | Path, raise_on_permission_error: bool = False):
         """
@@ -251,36 +510,184 @@ class FileManager:
                     continue
 
     @staticmethod
-    def get_files_and_stats(directory: str | Path, raise_on_permission_error: bool = False) -> List[Dict]:
+    def get_walk_root(directory: str | Path) -> str:
+        """
+        Get the path a walk starts from - the walked paths are under it. The directory as given, made absolute:
+        symlinks are not resolved, so the paths are under the folder the user gave, e.g. for os.path.relpath(path,
+        args.scan_dir). All the walks of the FileManager use it, so they return the same paths for the same directory.
+        :param directory: the directory to walk, as given
+        :return: the absolute path of the directory, as a string to avoid issues
+        """
+        return os.path.abspath(directory)
+
+    @staticmethod
+    def _scan_directory(current_dir: str, files_stats: List[Dict], file_filter: FileFilter = None) -> List[str]:
+        """
+        Scan a single directory, append the stats of its files to files_stats and return its subdirectories.
+        :param current_dir: path to the directory
+        :param files_stats: list to append the file information to
+        :param file_filter: if given, only files accepted by the filter are added, and only subdirectories accepted
+                            by it are returned. The file name is checked before the file is stat-ed, and the size and
+                            modified time right after it.
+        :return: list of subdirectory paths
+        :raises: PermissionError if the directory cannot be accessed
+        """
+        subdirs = []
+        stat_calls = 0
+        with os.scandir(current_dir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if file_filter is None or file_filter.accepts_dir(entry.name):
+                        subdirs.append(entry.path)
+                elif file_filter is None:
+                    stats = entry.stat()
+                    stat_calls += 1
+                    files_stats.append(
+                        {'path': entry.path, 'size': stats.st_size, 'name': entry.name,
+                         'modified_time': stats.st_mtime, 'created_time': stats.st_ctime,
+                         'dev': stats.st_dev, 'ino': stats.st_ino})
+                elif file_filter.accepts_name(entry.name):
+                    stats = entry.stat()
+                    stat_calls += 1
+                    if not file_filter.accepts_stats(stats.st_size, stats.st_mtime):
+                        continue
+                    files_stats.append(
+                        {'path': entry.path, 'size': stats.st_size, 'name': entry.name,
+                         'modified_time': stats.st_mtime, 'created_time': stats.st_ctime,
+                         'dev': stats.st_dev, 'ino': stats.st_ino})
+        MetricsCollector.count('scandir_calls')
+        MetricsCollector.count('stat_calls', stat_calls)
+        return subdirs
+
+    @staticmethod
+    def get_files_and_stats(directory: str | Path, raise_on_permission_error: bool = False,
+                            file_filter: FileFilter = None) -> List[Dict]:
         """
         Get file information for all files in a directory and its subdirectories. Optimized for speed by not using
         generators and returning a list of dictionaries with file information.
         :param directory: path to the directory
         :param raise_on_permission_error: if True, raise a PermissionError if a directory cannot be accessed
+        :param file_filter: if given, only files accepted by the filter are returned
         :return: list of dictionaries with file information
         :raises: PermissionError if a directory cannot be accessed and raise_on_permission_error is True
         """
         files_stats = []
-        directory = str(Path(directory).resolve())  # use the absolute path, but convert it to a string to avoid issues
-        queue = deque([directory])
+        queue = deque([FileManager.get_walk_root(directory)])
         while queue:
             current_dir = queue.popleft()
             try:
-                with os.scandir(current_dir) as it:
-                    for entry in it:
-                        if entry.is_dir(follow_symlinks=False):
-                            queue.append(entry.path)
-                        else:
-                            stats = entry.stat()
-                            files_stats.append(
-                                {'path': entry.path, 'size': stats.st_size, 'name': entry.name,
-                                 'modified_time': stats.st_mtime, 'created_time': stats.st_ctime})
+                queue.extend(FileManager._scan_directory(current_dir, files_stats, file_filter))
             except PermissionError:
                 if raise_on_permission_error:
                     raise
                 continue
         return files_stats
 
+    @staticmethod
+    def iter_files_and_stats(directory: str | Path, raise_on_permission_error: bool = False,
+                             file_filter: FileFilter = None) -> Iterator[Dict]:
+        """
+        Generator version of get_files_and_stats() - yields the file information of one directory at a time, so the
+        stats of the whole tree are never held in memory. Same breadth-first order as get_files_and_stats().
+        :param directory: path to the directory
+        :param raise_on_permission_error: if True, raise a PermissionError if a directory cannot be accessed
+        :param file_filter: if given, only files accepted by the filter are yielded
+        :return: generator of dictionaries with file information
+        :raises: PermissionError if a directory cannot be accessed and raise_on_permission_error is True
+        """
+        queue = deque([FileManager.get_walk_root(directory)])
+        while queue:
+            current_dir = queue.popleft()
+            dir_stats = []
+            try:
+                queue.extend(FileManager._scan_directory(current_dir, dir_stats, file_filter))
+            except PermissionError:
+                if raise_on_permission_error:
+                    raise
+                continue
+            yield from dir_stats
+
+    @staticmethod
+    def get_files_and_stats_parallel(directories: List[str | Path], max_workers: int = 8,
+                                     raise_on_permission_error: bool = False,
+                                     file_filter: FileFilter = None) -> List[List[Dict]]:
+        """
+        Get file information for all files in several directory trees, walking all the trees concurrently.
+        Every worker thread owns a deque of directories: it pushes the subdirectories it finds to its own deque and
+        pops from its tail, and when its deque is empty it steals from the head of another worker's deque. This keeps
+        all the workers busy on high-latency filesystems, where each scandir/stat round-trip is slow. A worker that
+        finds no work waits until another worker queues subdirectories, or the walk ends.
+        The paths are the same as the ones of get_files_and_stats() - see get_walk_root().
+        :param directories: list of directories to walk
+        :param max_workers: number of worker threads
+        :param raise_on_permission_error: if True, raise a PermissionError if a directory cannot be accessed
+        :param file_filter: if given, only files accepted by the filter are returned
+        :return: list of file information lists, one per directory, in the same format as get_files_and_stats()
+        :raises: PermissionError if a directory cannot be accessed and raise_on_permission_error is True
+        """
+        max_workers = max(1, max_workers)
+        roots = [FileManager.get_walk_root(directory) for directory in directories]
+        results = [[] for _ in roots]
+        queues = [deque() for _ in range(max_workers)]
+        for i, root in enumerate(roots):
+            queues[i % max_workers].append((i, root))
+
+        condition = threading.Condition()
+        # pending: directories queued but not scanned yet, pushes: number of times subdirectories were queued
+        state = {'pending': len(roots), 'pushes': 0, 'error': None}
+
+        def get_work(worker_id: int):
+            own_queue = queues[worker_id]
+            while True:
+                with condition:
+                    pushes = state['pushes']
+                try:
+                    return own_queue.pop()
+                except IndexError:
+                    pass
+                for offset in range(1, max_workers):  # try to steal from the other workers
+                    try:
+                        return queues[(worker_id + offset) % max_workers].popleft()
+                    except IndexError:
+                        continue
+                with condition:  # wait for work queued after the deques were checked
+                    while state['pushes'] == pushes and state['pending'] > 0 and state['error'] is None:
+                        condition.wait()
+                    if state['pending'] == 0 or state['error'] is not None:
+                        return None
+
+        def worker(worker_id: int):
+            files_stats = [[] for _ in roots]  # per-worker lists, merged at the end to avoid locking
+            while (work := get_work(worker_id)) is not None:
+                root_index, current_dir = work
+                subdirs = []
+                try:
+                    subdirs = FileManager._scan_directory(current_dir, files_stats[root_index], file_filter)
+                except Exception as e:
+                    if not isinstance(e, PermissionError) or raise_on_permission_error:
+                        with condition:  # stop all the workers and raise the error in the calling thread
+                            state['error'] = e
+                            condition.notify_all()
+                        break
+                queues[worker_id].extend((root_index, subdir) for subdir in subdirs)
+                with condition:
+                    state['pending'] += len(subdirs) - 1
+                    if subdirs:
+                        state['pushes'] += 1
+                    if subdirs or state['pending'] == 0:
+                        condition.notify_all()
+            return files_stats
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(worker, worker_id) for worker_id in range(max_workers)]
+            for future in futures:
+                for i, files_stats in enumerate(future.result()):
+                    results[i].extend(files_stats)
+
+        if state['error'] is not None:
+            raise state['error']
+        return results
+
     def delete_empty_folders_in_tree(self, base_path: str, show_progress: bool = False,
                                      progress_desc: str = "Looking for empty folders") -> int:
         """
@@ -330,6 +737,56 @@ class FileManager:
 
         return deleted_folders
 
+    def delete_empty_folders(self, base_path: str, folders: Iterable[str], show_progress: bool = False,
+                             progress_desc: str = "Deleting empty folders") -> int:
+        """
+        Delete the given folders if they are empty, then their parents that became empty, up to base_path (excluded).
+        Only these folders are checked, deepest first, so it is much faster than delete_empty_folders_in_tree() after
+        moving a few files out of a large tree. Each folder costs a single rmdir - it fails if the folder is not empty.
+        :param base_path: path to the base directory - only folders inside it are deleted
+        :param folders: folders that may be empty, e.g. moved_from_dirs - the folders files were moved out of
+        :param show_progress: if True, display a progress bar
+        :param progress_desc: description for the progress bar
+        :return: number of deleted folders
+        :raises: ProtectedPathError if the base_path is in a protected directory
+        """
+        base_path = self.resolve_path(base_path)
+        if self.is_protected_path(base_path, True):
+            raise ProtectedPathError(f"Operation not allowed: Attempt to delete empty folders in protected path: "
+                                     f"{base_path}")
+        if not self.run_mode:
+            logger.info(f"Would have deleted empty folders in {base_path}")
+            return 0
+
+        base_prefix = base_path.rstrip(os.sep) + os.sep
+        folders_by_depth = {}
+
+        def add_folder(folder: str):
+            if folder.startswith(base_prefix) and folder != base_path:
+                folders_by_depth.setdefault(folder.count(os.sep), set()).add(folder)
+
+        for folder in folders:
+            add_folder(self.resolve_path(folder))
+
+        deleted_folders = 0
+        with tqdm.tqdm(desc=progress_desc, unit=' folders', disable=not show_progress) as progress_bar:
+            while folders_by_depth:
+                for folder in sorted(folders_by_depth.pop(max(folders_by_depth))):
+                    progress_bar.update(1)
+                    try:
+                        os.rmdir(folder)
+                    except FileNotFoundError:
+                        continue
+                    except OSError as e:
+                        if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                            logger.error(f"Error deleting folder {folder}: {e}")
+                        continue
+                    deleted_folders += 1
+                    logger.info(f"Deleted empty folder {folder}")
+                    add_folder(os.path.dirname(folder))  # the parent may be empty now
+
+        return deleted_folders
+
     @staticmethod
     def any_is_subfolder_of(folders: List[str]) -> Tuple[bool, List[Tuple[str, str]]]:
         """
@@ -347,9 +804,13 @@ class FileManager:
         return bool(subfolder_pairs), subfolder_pairs
 
     def reset_all(self):
-        """Reset the protected_dirs and allowed_dirs to empty sets."""
+        """Reset the protected_dirs and allowed_dirs to empty sets, the copy statistics and the moved from folders."""
         self.protected_dirs = set()
         self.allowed_dirs = set()
+        self.protected_matcher = PathMatcher()
+        self.allowed_matcher = PathMatcher()
+        self.copy_methods = {}
+        self.moved_from_dirs = set()
         return self
 
     @staticmethod
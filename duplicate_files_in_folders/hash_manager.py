@@ -5,6 +5,8 @@ from datetime import datetime, timedelta
 import logging
 from threading import Lock
 
+from duplicate_files_in_folders.metrics import MetricsCollector
+
 logger = logging.getLogger(__name__)
 
 
@@ -48,6 +50,7 @@ class HashManager:
         self.persistent_data = self.load_data()
         self.temporary_data = pd.DataFrame(columns=['file_path', 'hash_value', 'last_update'])
         self.unsaved_changes = 0
+        self.inode_hashes = {}  # hashes by hardlink id (device, inode, size, modified time) - hardlinks are read once
 
         # attributes for cache hits and requests
         self.persistent_cache_hits = 0
@@ -134,8 +137,43 @@ class HashManager:
             else:
                 self.temporary_data = new_entry
 
-    def get_hash(self, file_path: str) -> str:
-        """Get the hash of a file, computing and storing it if necessary."""
+    def add_hashes(self, hashes: dict) -> None:
+        """
+        Add many hashes at once, e.g. hashes imported from a checksum file. Much faster than calling add_hash() for each
+        file, as the DataFrames are rebuilt only once.
+        :param hashes: dictionary of file paths to hash values
+        """
+        if not hashes:
+            return
+        current_time = datetime.now()
+        new_entries = pd.DataFrame({'file_path': list(hashes.keys()), 'hash_value': list(hashes.values()),
+                                    'last_update': [current_time] * len(hashes)})
+        is_persistent = new_entries.file_path.str.startswith(self.reference_dir + os.sep) \
+            if self.reference_dir else pd.Series(False, index=new_entries.index)
+
+        persistent_entries = new_entries[is_persistent]
+        if not persistent_entries.empty:
+            self.persistent_data = self.persistent_data[~self.persistent_data.file_path.isin(new_entries.file_path)]
+            self.persistent_data = pd.concat([self.persistent_data, persistent_entries], ignore_index=True) \
+                if not self.persistent_data.empty else persistent_entries.reset_index(drop=True)
+            self.unsaved_changes += len(persistent_entries)
+            if self.unsaved_changes >= self.AUTO_SAVE_THRESHOLD:
+                self.save_data()
+
+        temporary_entries = new_entries[~is_persistent]
+        if not temporary_entries.empty:
+            self.temporary_data = self.temporary_data[~self.temporary_data.file_path.isin(new_entries.file_path)]
+            self.temporary_data = pd.concat([self.temporary_data, temporary_entries], ignore_index=True) \
+                if not self.temporary_data.empty else temporary_entries.reset_index(drop=True)
+
+    def get_hash(self, file_path: str, hardlink_id: tuple = None) -> str:
+        """
+        Get the hash of a file, computing and storing it if necessary.
+        :param file_path: path to the file
+        :param hardlink_id: the (device, inode, size, modified time) of the file, if known. The file is not read if a
+                            hardlink of it was already hashed. The size and modified time guard against reused inodes.
+        :return: the hash of the file
+        """
         if self.reference_dir and file_path.startswith(self.reference_dir + os.sep):
             self.persistent_cache_requests += 1  # Increment persistent cache requests
             result = self.persistent_data[self.persistent_data.file_path == file_path]
@@ -143,6 +181,7 @@ class HashManager:
             self.temporary_cache_requests += 1  # Increment temporary cache requests
             result = self.temporary_data[self.temporary_data.file_path == file_path]
 
+        MetricsCollector.count('cache_requests')
         # Check if the hash is already stored and not expired
         if not result.empty:
             current_time = datetime.now()
@@ -152,8 +191,16 @@ class HashManager:
                     self.persistent_cache_hits += 1  # Increment persistent cache hits
                 else:
                     self.temporary_cache_hits += 1  # Increment temporary cache hits
-                return result['hash_value'].values[0]
-        hash_value = self.compute_hash(file_path)
+                MetricsCollector.count('cache_hits')
+                hash_value = result['hash_value'].values[0]
+                if hardlink_id is not None:
+                    self.inode_hashes[hardlink_id] = hash_value
+                return hash_value
+        hash_value = self.inode_hashes.get(hardlink_id) if hardlink_id is not None else None
+        if hash_value is None:
+            hash_value = self.compute_hash(file_path)
+            if hardlink_id is not None:
+                self.inode_hashes[hardlink_id] = hash_value
         self.add_hash(file_path, hash_value)
         return hash_value
 
@@ -165,16 +212,18 @@ class HashManager:
         """
         persistent_result = self.persistent_data[self.persistent_data.file_path.str.startswith(folder_path + os.sep)]
         temporary_result = self.temporary_data[self.temporary_data.file_path.str.startswith(folder_path + os.sep)]
-        if persistent_result.empty and temporary_result.empty:
+        results = [result for result in [persistent_result, temporary_result] if not result.empty]
+        if not results:
             result = pd.DataFrame(columns=['file_path', 'hash_value'])
         else:
-            result = pd.concat([persistent_result, temporary_result])
+            result = pd.concat(results) if len(results) > 1 else results[0]
         return result[['file_path', 'hash_value']].to_dict(orient='records')
 
     def clear_cache(self) -> None:
         """Clean all cache files."""
         self.persistent_data = pd.DataFrame(columns=['file_path', 'hash_value', 'last_update'])
         self.temporary_data = pd.DataFrame(columns=['file_path', 'hash_value', 'last_update'])
+        self.inode_hashes = {}
         logger.info("Cache cleaned. All data removed.")
 
     def clean_expired_cache(self) -> None:
@@ -202,11 +251,15 @@ class HashManager:
             return HashManager.compute_partial_hash(file_path)
         try:
             hasher = hashlib.sha256()
+            bytes_read = 0
             with open(file_path, 'rb') as file:
                 buffer = file.read(buffer_size)
                 while buffer:
                     hasher.update(buffer)
+                    bytes_read += len(buffer)
                     buffer = file.read(buffer_size)
+            MetricsCollector.count('files_opened')
+            MetricsCollector.count('bytes_read', bytes_read)
             file_hash = hasher.hexdigest()
             return file_hash
         except Exception as e:
@@ -226,12 +279,67 @@ class HashManager:
             with open(file_path, 'rb') as file:
                 buffer = file.read(initial_bytes)
                 hasher.update(buffer)
+            MetricsCollector.count('files_opened')
+            MetricsCollector.count('bytes_read', len(buffer))
             file_hash = hasher.hexdigest()
             return file_hash
         except Exception as e:
             logger.error(f"Error hashing {file_path}: {e}")
             raise
 
+    @staticmethod
+    def compute_checksum(file_path: str, algorithm: str, buffer_size=8 * 1024 * 1024) -> str:
+        """
+        Compute the checksum of the full file content with the given algorithm, to compare files with checksum files
+        created by other tools (sha256sum, md5deep, hashdeep etc.).
+        :param file_path: path to the file
+        :param algorithm: name of a hashlib algorithm - md5, sha1 or sha256
+        :param buffer_size: size of the buffer to read the file
+        :return: the checksum of the file as a lowercase hex string
+        """
+        try:
+            hasher = hashlib.new(algorithm)
+            bytes_read = 0
+            with open(file_path, 'rb') as file:
+                buffer = file.read(buffer_size)
+                while buffer:
+                    hasher.update(buffer)
+                    bytes_read += len(buffer)
+                    buffer = file.read(buffer_size)
+            MetricsCollector.count('files_opened')
+            MetricsCollector.count('bytes_read', bytes_read)
+            return hasher.hexdigest()
+        except Exception as e:
+            logger.error(f"Error hashing {file_path}: {e}")
+            raise
+
+    @staticmethod
+    def compute_digests(file_path: str, initial_bytes=2 * 1024 * 1024, buffer_size=8 * 1024 * 1024) -> dict:
+        """
+        Compute both the partial and the full hash of a file, reading it only once.
+        :param file_path: path to the file
+        :param initial_bytes: number of bytes used for the partial hash, same as in compute_partial_hash()
+        :param buffer_size: size of the buffer to read the rest of the file
+        :return: dictionary with the 'partial' and 'full' hashes of the file
+        """
+        try:
+            partial_hasher = hashlib.sha256()
+            full_hasher = hashlib.sha256()
+            with open(file_path, 'rb') as file:
+                buffer = file.read(initial_bytes)
+                partial_hasher.update(buffer)
+                bytes_read = 0
+                while buffer:
+                    full_hasher.update(buffer)
+                    bytes_read += len(buffer)
+                    buffer = file.read(buffer_size)
+            MetricsCollector.count('files_opened')
+            MetricsCollector.count('bytes_read', bytes_read)
+            return {'partial': partial_hasher.hexdigest(), 'full': full_hasher.hexdigest()}
+        except Exception as e:
+            logger.error(f"Error hashing {file_path}: {e}")
+            raise
+
     def print_state(self):
         """Print the state of the HashManager. For debugging purposes."""
         logger.info(f"Persistent data:\n{self.persistent_data}")
@@ -0,0 +1,287 @@
+import hashlib
+import logging
+import os
+import time
+from argparse import Namespace
+from typing import Dict, List, Set
+
+from duplicate_files_in_folders.file_manager import FileManager
+from duplicate_files_in_folders.hash_manager import HashManager
+from duplicate_files_in_folders.metrics import MetricsCollector
+
+logger = logging.getLogger(__name__)
+
+PARTIAL_HASH_BYTES = 2 * 1024 * 1024  # bytes read for a partial hash, same as HashManager.compute_partial_hash()
+SAMPLE_FILES = 3  # number of files read on each side to measure the device
+SAMPLE_BYTES = 4 * 1024 * 1024  # maximum bytes read from each sample file
+DEFAULT_LATENCY = 0.001  # in seconds - time to open a file and read its first block, if it can't be measured
+DEFAULT_THROUGHPUT = 100 * 1024 * 1024  # in bytes per second - device read speed, if it can't be measured
+DEFAULT_HASH_THROUGHPUT = 500 * 1024 * 1024  # in bytes per second - sha256 speed of a single core
+CACHE_LOOKUP_SECONDS = 0.0005  # time to get a cached hash - holds the GIL, so it doesn't scale with threads
+THREAD_OVERHEAD_SECONDS = 0.001  # time to start a worker thread
+WORKER_OPTIONS = [1, 2, 4, 8, 16, 32]
+PREFILTER_MIN_SIZE_RATIO = 8  # prefilter by partial hash if uncached files are on average this many times larger
+
+device_profiles: Dict[int, Dict] = {}  # the measured devices by device id - each device is measured once per run
+
+
+def measure_device(file_infos: List[Dict], cached_paths: Set[str]) -> Dict:
+    """
+    Measure the read latency and throughput of the device a side is on, and the hashing throughput, by reading the
+    beginning of a few uncached candidates. The files stay in the OS page cache, so hashing them later is not slowed
+    down by the measurement.
+    :param file_infos: the candidates of the side
+    :param cached_paths: paths of the candidates whose hash is already cached
+    :return: dictionary with the 'latency' (seconds per file), 'throughput' and 'hash_throughput' (bytes per second),
+             and the 'sample_bytes' read to measure them
+    """
+    latencies, read_bytes, read_seconds, hash_seconds, sample_bytes = [], 0, 0.0, 0.0, 0
+    samples = [file_info for file_info in file_infos if file_info['path'] not in cached_paths][:SAMPLE_FILES]
+    for file_info in samples:
+        try:
+            start = time.perf_counter()
+            with open(file_info['path'], 'rb') as file:
+                first_block = file.read(4096)
+                opened = time.perf_counter()
+                rest = file.read(SAMPLE_BYTES - len(first_block))
+            end = time.perf_counter()
+        except OSError:
+            continue
+        latencies.append(opened - start)
+        sample_bytes += len(first_block) + len(rest)
+        MetricsCollector.count('files_opened')
+        MetricsCollector.count('bytes_read', len(first_block) + len(rest))
+        read_bytes += len(rest)
+        read_seconds += end - opened
+        start = time.perf_counter()
+        hashlib.sha256(first_block + rest).digest()
+        hash_seconds += time.perf_counter() - start
+
+    big_enough = read_bytes >= 1024 * 1024  # throughput of small reads is dominated by the latency
+    return {
+        'latency': sum(latencies) / len(latencies) if latencies else DEFAULT_LATENCY,
+        'throughput': read_bytes / read_seconds if big_enough and read_seconds > 0 else DEFAULT_THROUGHPUT,
+        'hash_throughput': read_bytes / hash_seconds if big_enough and hash_seconds > 0 else DEFAULT_HASH_THROUGHPUT,
+        'sample_bytes': sample_bytes,
+    }
+
+
+def get_device_profile(folder: str, file_infos: List[Dict], cached_paths: Set[str]) -> (Dict, int):
+    """
+    Get the measured device of a side - measured by the first batch with uncached candidates on the device, and
+    reused by the next batches.
+    :param folder: the folder of the side
+    :param file_infos: the candidates of the side
+    :param cached_paths: paths of the candidates whose hash is already cached
+    :return: the device (see measure_device()), and the bytes read to measure it now - 0 if it was measured before
+    """
+    device_id = get_device_id(folder)
+    if device_id in device_profiles:
+        return device_profiles[device_id], 0
+    device = measure_device(file_infos, cached_paths)
+    if device_id is not None:
+        device_profiles[device_id] = device
+    return device, device['sample_bytes']
+
+
+def reset_device_profiles():
+    """ Forget the measured devices, so they are measured again. """
+    device_profiles.clear()
+
+
+def estimate_seconds(side_plan: Dict, device: Dict, workers: int) -> float:
+    """
+    Estimate the time to generate the keys of a side with a number of worker threads.
+    Opening files is latency bound and scales with the number of workers. Reading is bound by the device throughput,
+    and hashing scales with the number of cores. Cached hashes are looked up one at a time.
+    :param side_plan: the plan of the side, with the number of uncached files and bytes to read
+    :param device: the measured device of the side
+    :param workers: number of worker threads
+    :return: estimated time in seconds
+    """
+    hash_throughput = device['hash_throughput'] * min(workers, os.cpu_count() or 1)
+    return (side_plan['uncached_files'] * device['latency'] / workers +
+            side_plan['bytes_to_read'] / min(device['throughput'], hash_throughput) +
+            side_plan['cached_files'] * CACHE_LOOKUP_SECONDS +
+            (workers * THREAD_OVERHEAD_SECONDS if workers > 1 else 0))
+
+
+def plan_side(args: Namespace, side: str, file_infos: List[Dict], folder: str) -> Dict:
+    """
+    Plan the hashing of one side: count the candidates, the bytes to read and the cache hits, measure the device and
+    choose the executor and the number of workers with the lowest estimated time.
+    :param args: parsed arguments
+    :param side: 'scan' or 'ref'
+    :param file_infos: the candidates of the side
+    :param folder: the folder of the side
+    :return: the plan of the side
+    """
+    hash_manager = HashManager.get_instance()
+    if side == 'ref' and args.reference_manifest:  # the manifest has the hashes, nothing is read
+        key_source = 'manifest'
+        cached_paths = {file_info['path'] for file_info in file_infos}
+    elif args.reference_checksums:  # files loaded from the checksum file have their checksum
+        key_source = 'checksums'
+        cached_paths = {file_info['path'] for file_info in file_infos if file_info.get('checksum')}
+    else:
+        key_source = 'hash'
+        cached_paths = {item['file_path'] for item in hash_manager.get_hashes_by_folder(folder)}
+        cached_paths.intersection_update(file_info['path'] for file_info in file_infos)
+
+    full_read = bool(args.reference_checksums) or hash_manager.full_hash
+    first_links, _ = FileManager.split_hardlinks(file_infos)  # hardlinks of the same file are read once
+    uncached = [file_info for file_info in first_links if file_info['path'] not in cached_paths]
+    side_plan = {
+        'key_source': key_source,
+        'files': len(file_infos),
+        'unique_files': len(first_links),
+        'bytes': sum(int(file_info['size']) for file_info in file_infos),
+        'cached_files': len(first_links) - len(uncached),
+        'uncached_files': len(uncached),
+        'bytes_to_read': sum(int(file_info['size']) if full_read else min(int(file_info['size']), PARTIAL_HASH_BYTES)
+                             for file_info in uncached),
+        'uncached_bytes': sum(int(file_info['size']) for file_info in uncached),
+    }
+    side_plan['cache_hit_ratio'] = side_plan['cached_files'] / len(first_links) if first_links else 1.0
+
+    device, side_plan['sample_bytes'] = get_device_profile(folder, file_infos, cached_paths) if uncached else \
+        ({'latency': DEFAULT_LATENCY, 'throughput': DEFAULT_THROUGHPUT, 'hash_throughput': DEFAULT_HASH_THROUGHPUT,
+          'sample_bytes': 0}, 0)
+    worker_options = [workers for workers in WORKER_OPTIONS if workers == 1 or workers <= len(uncached)]
+    estimates = {workers: estimate_seconds(side_plan, device, workers) for workers in worker_options}
+    workers = min(estimates, key=lambda option: (estimates[option], option))
+    side_plan.update({'device': device, 'workers': workers, 'executor': 'threads' if workers > 1 else 'serial',
+                      'estimated_seconds': estimates[workers], 'cached_paths': cached_paths})
+    return side_plan
+
+
+def get_device_id(path: str) -> int | None:
+    """
+    Get the id of the device a path is on.
+    :param path: the path
+    :return: the device id, or None if the path doesn't exist
+    """
+    try:
+        return os.stat(path).st_dev
+    except (OSError, TypeError):
+        return None
+
+
+def plan_hashing(args: Namespace, scan_dir: str, ref_dir: str, scan_candidates: List[Dict],
+                 ref_candidates: List[Dict], scan_first: bool = False) -> Dict:
+    """
+    Plan the hashing stage of finding duplicates: estimate the cost of each side from its number of candidates, the
+    bytes to read, the cache hit ratio and the measured device throughput, then choose:
+    - the executor and number of workers of each side
+    - the stage order - whether to prefilter the candidates by their partial hash before reading them in full
+    - the side order - which side to hash first, or both at once if they are on different devices
+    :param args: parsed arguments
+    :param scan_dir: the scan directory
+    :param ref_dir: the reference directory
+    :param scan_candidates: the scan candidates
+    :param ref_candidates: the reference candidates
+    :param scan_first: if True, the scan side must be hashed before the reference side
+    :return: the plan - {'scan': side plan, 'ref': side plan, 'prefilter': bool, 'prefilter_bytes': int,
+             'order': [sides], 'concurrent': bool}
+    """
+    plan = {'scan': plan_side(args, 'scan', scan_candidates, scan_dir),
+            'ref': plan_side(args, 'ref', ref_candidates, ref_dir)}
+
+    # Reading the first 2MB of large files is cheap compared to reading them in full, and drops the candidates whose
+    # beginning has no match on the other side. Only for full hashes, when both sides are hashed by the HashManager.
+    uncached_files = plan['scan']['uncached_files'] + plan['ref']['uncached_files']
+    uncached_bytes = plan['scan']['uncached_bytes'] + plan['ref']['uncached_bytes']
+    plan['prefilter'] = bool(HashManager.get_instance().full_hash and
+                             plan['scan']['key_source'] == plan['ref']['key_source'] == 'hash' and uncached_files and
+                             uncached_bytes / uncached_files >= PREFILTER_MIN_SIZE_RATIO * PARTIAL_HASH_BYTES)
+    # the partial hashes the prefilter reads - at most, as the groups with a cached hash are not prefiltered
+    plan['prefilter_bytes'] = sum(min(int(file_info['size']), PARTIAL_HASH_BYTES)
+                                  for file_info in scan_candidates + ref_candidates
+                                  if file_info['path'] not in plan['scan']['cached_paths'] and
+                                  file_info['path'] not in plan['ref']['cached_paths']) if plan['prefilter'] else 0
+
+    scan_device, ref_device = get_device_id(scan_dir), get_device_id(ref_dir)
+    plan['concurrent'] = not scan_first and scan_device is not None and ref_device is not None and \
+        scan_device != ref_device and plan['scan']['uncached_files'] > 0 and plan['ref']['uncached_files'] > 0
+    cheaper_first = sorted(['scan', 'ref'], key=lambda side: plan[side]['estimated_seconds'])
+    plan['order'] = ['scan', 'ref'] if scan_first else cheaper_first
+    return plan
+
+
+def format_plan(plan: Dict) -> str:
+    """
+    Format a hashing plan for logging.
+    :param plan: the plan returned by plan_hashing()
+    :return: the plan as a readable string
+    """
+    sides = []
+    for side in ['scan', 'ref']:
+        side_plan = plan[side]
+        sides.append(f"{side}: {side_plan['files']:,} files, {side_plan['bytes_to_read']:,} bytes to read, "
+                     f"{side_plan['cache_hit_ratio']:.0%} cached, {side_plan['executor']} "
+                     f"({side_plan['workers']} workers), estimated {side_plan['estimated_seconds']:.2f}s")
+    order = 'concurrently' if plan['concurrent'] else ' then '.join(plan['order'])
+    prefilter = 'partial hash prefilter, ' if plan['prefilter'] else ''
+    return f"Hashing plan: {prefilter}{order}; " + '; '.join(sides)
+
+
+def is_budgeted(args: Namespace) -> bool:
+    """ Check if the run has a time or read budget - see HashingBudget. """
+    return args.max_runtime is not None or args.max_bytes_read is not None
+
+
+class HashingBudget:
+    """
+    Time and read budget of a run, for time-boxed runs (--max_runtime, --max_bytes_read). Each batch is checked
+    against the budget after it is planned and before it is hashed: it is hashed only if the time elapsed since the
+    budget was created plus the estimated time of its plan fits --max_runtime, and the bytes read so far plus the
+    bytes to read of its plan fit --max_bytes_read. The first batch that doesn't fit exhausts the budget - it and
+    all the batches after it are deferred, so the run stops cleanly between batches.
+    The bytes to read of a plan are an upper bound - a side may stop hashing early, see resolve_early. They include
+    the partial hashes read by the prefilter, and the samples read to measure the devices are charged when the batch
+    is checked, as they are read by then.
+    """
+
+    def __init__(self, max_runtime: float = None, max_bytes_read: int = None):
+        """
+        :param max_runtime: maximum run time in seconds, or None
+        :param max_bytes_read: maximum number of bytes to read for hashing, or None
+        """
+        self.max_runtime = max_runtime
+        self.max_bytes_read = max_bytes_read
+        self.start_time = time.monotonic()
+        self.bytes_read = 0
+        self.exhausted_by = None  # the option whose budget was spent - 'max_runtime' or 'max_bytes_read'
+
+    @staticmethod
+    def get_plan_cost(plan: Dict) -> (float, int):
+        """
+        Get the estimated time and the bytes to read of a hashing plan.
+        :param plan: the plan returned by plan_hashing()
+        :return: estimated seconds, bytes to read - with the partial hashes of the prefilter
+        """
+        seconds = [plan[side]['estimated_seconds'] for side in ['scan', 'ref']]
+        return max(seconds) if plan['concurrent'] else sum(seconds), \
+            plan['scan']['bytes_to_read'] + plan['ref']['bytes_to_read'] + plan['prefilter_bytes']
+
+    def allows(self, plan: Dict) -> bool:
+        """
+        Check if a batch fits the remaining budget. If it doesn't, the budget is exhausted. The samples read to plan
+        the batch are charged first.
+        :param plan: the hashing plan of the batch
+        :return: True if the batch can be hashed
+        """
+        self.bytes_read += plan['scan']['sample_bytes'] + plan['ref']['sample_bytes']
+        if self.exhausted_by is None:
+            seconds, bytes_to_read = self.get_plan_cost(plan)
+            if self.max_runtime is not None and time.monotonic() - self.start_time + seconds > self.max_runtime:
+                self.exhausted_by = 'max_runtime'
+            elif self.max_bytes_read is not None and self.bytes_read + bytes_to_read > self.max_bytes_read:
+                self.exhausted_by = 'max_bytes_read'
+            if self.exhausted_by is not None:
+                logger.info(f"The --{self.exhausted_by} budget is spent - the remaining batches are deferred")
+        return self.exhausted_by is None
+
+    def charge(self, plan: Dict):
+        """ Charge the bytes to read of a hashed batch to the budget. """
+        self.bytes_read += self.get_plan_cost(plan)[1]
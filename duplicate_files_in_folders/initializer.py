@@ -5,6 +5,10 @@ from datetime import datetime
 
 from duplicate_files_in_folders.file_manager import FileManager
 from duplicate_files_in_folders.hash_manager import HashManager
+from duplicate_files_in_folders.job_state import JobState
+from duplicate_files_in_folders.metrics import MetricsCollector
+from duplicate_files_in_folders.profiler import RunProfiler
+from duplicate_files_in_folders.tree_snapshot import TreeSnapshot
 from duplicate_files_in_folders.utils import detect_pytest
 
 
@@ -37,6 +41,29 @@ def setup_logging():
         logger.addHandler(file_handler)
 
 
+def setup_metrics(args: Namespace):
+    """
+    Setup the metrics collector of the run, if --metrics_json is given. Metrics of a previous run are dropped.
+    :param args: the parsed arguments
+    :return: the metrics collector, or None if the metrics are not collected
+    """
+    MetricsCollector.reset_instance()
+    return MetricsCollector() if args.metrics_json else None
+
+
+def setup_profiler(args: Namespace):
+    """
+    Setup the profiler of the run, if --profile is given. The profile folder is created if it doesn't exist.
+    :param args: the parsed arguments
+    :return: the profiler, or None if the run is not profiled
+    """
+    RunProfiler.reset_instance()
+    if not args.profile:
+        return None
+    os.makedirs(args.profile, exist_ok=True)
+    return RunProfiler(args.profile, trace_memory=args.profile_memory)
+
+
 def setup_hash_manager(reference_dir: str = None, full_hash: bool = False, clear_cache: bool = False):
     """
     Setup the hash manager with the given reference directory and full hash setting.
@@ -53,11 +80,38 @@ def setup_hash_manager(reference_dir: str = None, full_hash: bool = False, clear
     return hash_manager
 
 
+def setup_tree_snapshot(args: Namespace):
+    """
+    Setup the snapshot of the reference folder tree, used to re-scan only the folders that changed since the last run.
+    Only with --ref_snapshot, as the snapshot keeps the whole reference tree in memory - by default the reference
+    folder is streamed.
+    :param args: the parsed arguments
+    :return: the tree snapshot instance, or None if there is no --ref_snapshot
+    """
+    if not args.ref_snapshot:
+        return None
+    return TreeSnapshot(reference_dir=args.reference_dir, filename='ref_snapshot.pkl' if not detect_pytest() else None)
+
+
+def setup_job_state(args: Namespace):
+    """
+    Setup the state of a job started with --job or resumed with --resume.
+    :param args: the parsed arguments
+    :return: the job state instance, or None if the run is not a job
+    """
+    if not args.job and not args.resume:
+        return None
+    job_dir = args.job or args.resume
+    os.makedirs(job_dir, exist_ok=True)
+    return JobState(job_dir, args, resume=bool(args.resume))
+
+
 def setup_file_manager(args: Namespace):
     """
     Setup the file manager with the reference and scan directories and the move to directory from the arguments.
     :param args: the parsed arguments
     :return: the file manager instance
     """
-    fm = FileManager.reset_file_manager([args.reference_dir], [args.scan_dir, args.move_to], args.run)
+    allowed_dirs = [folder for folder in [args.scan_dir, args.move_to] if folder]  # no scan_dir in export_manifest
+    fm = FileManager.reset_file_manager([args.reference_dir], allowed_dirs, args.run)
     return fm
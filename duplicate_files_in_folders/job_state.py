@@ -0,0 +1,284 @@
+import json
+import logging
+import os
+import pickle
+from argparse import Namespace
+from collections import deque
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Tuple
+
+from duplicate_files_in_folders.hash_manager import HashManager
+from duplicate_files_in_folders.hashing_planner import is_budgeted
+
+logger = logging.getLogger(__name__)
+
+
+class JobStateError(Exception):
+    pass
+
+
+class JobState:
+    """
+    Manages the state directory of a long-running job, so an interrupted run can be resumed with --resume:
+    - job.json: the arguments the job was started with - a resumed job must use the same arguments
+    - candidates.pkl: the candidate groups found by walking both folders, so a resumed job doesn't walk them again
+    - progress.jsonl: checkpoints, appended as they happen - the candidates were saved, and each batch of duplicates
+      whose files were all moved
+    - actions.jsonl: journal of the file operations - a line when an operation starts and another when it is done
+    The logs are append-only and flushed on every line, so a crash loses at most the line being written. On resume,
+    completed batches are skipped, and operations of the interrupted batch that are already done are not repeated.
+    """
+    _instance = None
+    _lock = Lock()
+
+    JOB_VERSION = 3  # Jobs saved with a different version can't be resumed
+    # arguments that change the result of the job - a job can only be resumed with the same values. --run is not one
+    # of them, so a job can be tested first.
+    JOB_ARGS = ['scan_dir', 'reference_dir', 'move_to', 'action', 'ignore_diff', 'copy_to_all', 'keep_structure',
+                'full_hash', 'whitelist_ext', 'blacklist_ext', 'min_size', 'max_size', 'exclude_dir',
+                'exclude_dir_regex', 'include', 'include_regex', 'batch_files', 'reference_manifest',
+                'reference_checksums']
+    # the modified time window is compared as given - an age like 30d is a different point in time in every run, so
+    # a resumed job uses the cutoffs saved when it was started
+    TIME_LIMIT_ARGS = ['modified_after', 'modified_before']
+
+    def __new__(cls, *args, **kwargs):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance.__initialized = False
+        return cls._instance
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            raise Exception("JobState has not been initialized. Please initialize it first.")
+        return cls._instance
+
+    @classmethod
+    def is_initialized(cls) -> bool:
+        return cls._instance is not None
+
+    @classmethod
+    def reset_instance(cls):
+        with cls._lock:
+            if cls._instance is not None and cls._instance.__initialized:
+                cls._instance.close()
+            cls._instance = None
+
+    def __init__(self, job_dir: str, args: Namespace, resume: bool = False):
+        """
+        :param job_dir: the job state directory - it must exist
+        :param args: parsed arguments
+        :param resume: True to resume the job in job_dir, False to start a new job in it
+        :raises: JobStateError if the job can't be started or resumed
+        """
+        if self.__initialized:
+            return
+        self.__initialized = True
+
+        self.job_dir = job_dir
+        self.job_file = os.path.join(job_dir, 'job.json')
+        self.candidates_file = os.path.join(job_dir, 'candidates.pkl')
+        self.progress_file = os.path.join(job_dir, 'progress.jsonl')
+        self.actions_file = os.path.join(job_dir, 'actions.jsonl')
+        self.write_lock = Lock()
+
+        job_args = self.get_job_args(args)
+        if resume:
+            saved_job = self.load_job(job_args)
+            for name in self.TIME_LIMIT_ARGS:
+                setattr(args, name, saved_job['time_limits'][name])
+        else:
+            if os.path.exists(self.job_file):
+                raise JobStateError(f"A job already exists in {job_dir} - use --resume to resume it")
+            time_limits = {name: getattr(args, name, None) for name in self.TIME_LIMIT_ARGS}
+            with open(self.job_file, 'w', encoding='utf-8') as f:
+                json.dump({'version': self.JOB_VERSION, 'created': datetime.now().isoformat(), 'args': job_args,
+                           'time_limits': time_limits}, f, indent=2)
+
+        progress = self.load_log(self.progress_file)
+        self.candidates_saved = any(entry['event'] == 'candidates' for entry in progress)
+        self.completed_batches = {entry['index'] for entry in progress if entry['event'] == 'batch'}
+        self.actions: Dict[Tuple, Dict] = {}  # (operation, source, requested destination) -> last journal entry
+        for entry in self.load_log(self.actions_file):
+            self.actions[self.get_action_key(entry)] = entry
+        # sources a previous run of the job moved away - they are not candidates anymore
+        self.moved_sources = {entry['src'] for entry in self.actions.values()
+                              if entry['operation'] == 'move' and entry['status'] == 'done'}
+        self.pending_batches = deque()  # batches yielded by the finder and not completed yet, in order
+        self.skipped_actions = 0
+
+        self.progress_log = open(self.progress_file, 'a', encoding='utf-8')
+        self.actions_log = open(self.actions_file, 'a', encoding='utf-8')
+        if resume:
+            logger.info(f"Resuming job {job_dir}: {len(self.completed_batches)} batches completed, "
+                        f"{sum(entry['status'] == 'done' for entry in self.actions.values())} file operations done")
+
+    @classmethod
+    def get_job_args(cls, args: Namespace) -> Dict:
+        """ Get the arguments that identify a job, as JSON values. """
+        job_args = {}
+        for name in cls.JOB_ARGS:
+            value = getattr(args, name, None)
+            job_args[name] = sorted(value) if isinstance(value, (set, list, tuple)) else value
+        for name in cls.TIME_LIMIT_ARGS:  # the option as given, see validate_arguments()
+            job_args[name] = getattr(args, f'{name}_arg', getattr(args, name, None))
+        # the batches of a budgeted run are in another order - the budgets themselves may change between runs
+        job_args['budgeted'] = is_budgeted(args)
+        return job_args
+
+    def load_job(self, job_args: Dict) -> Dict:
+        """
+        Load the job to resume, and check it was started with the same arguments.
+        :param job_args: the arguments of this run, returned by get_job_args()
+        :return: the saved job
+        :raises: JobStateError if there is no job, it was saved by another version or with other arguments
+        """
+        return self.check_job(self.job_dir, job_args)
+
+    @classmethod
+    def check_job(cls, job_dir: str, job_args: Dict) -> Dict:
+        """
+        Check that the job saved in a folder can be resumed with the given arguments - used to validate --resume.
+        :param job_dir: the job state directory
+        :param job_args: the arguments of this run, returned by get_job_args()
+        :return: the saved job
+        :raises: JobStateError if there is no job, it was saved by another version or with other arguments
+        """
+        try:
+            with open(os.path.join(job_dir, 'job.json'), encoding='utf-8') as f:
+                saved_job = json.load(f)
+        except (OSError, ValueError) as e:
+            raise JobStateError(f"No job to resume in {job_dir}: {e}")
+        if saved_job.get('version') != cls.JOB_VERSION:
+            raise JobStateError(f"The job in {job_dir} was saved by a different version and can't be resumed")
+        different = [name for name in job_args if saved_job['args'].get(name) != job_args[name]]
+        if different:
+            raise JobStateError(f"The job in {job_dir} was started with different arguments: "
+                                f"{', '.join(different)}")
+        return saved_job
+
+    @staticmethod
+    def load_log(path: str) -> list:
+        """ Load the entries of an append-only log. A partial last line, written during a crash, is ignored. """
+        if not os.path.exists(path):
+            return []
+        entries = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"Ignoring a partial line in {path}")
+        return entries
+
+    def append(self, log, entry: Dict):
+        """ Append an entry to a log and flush it, so it survives a crash of the process. """
+        with self.write_lock:
+            log.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            log.flush()
+
+    def close(self):
+        """ Close the logs. """
+        for log in [getattr(self, 'progress_log', None), getattr(self, 'actions_log', None)]:
+            if log is not None and not log.closed:
+                log.close()
+
+    def load_candidates(self) -> Tuple[Dict, Dict] | None:
+        """
+        Load the candidate groups saved by a previous run of the job.
+        :return: the candidate groups and the file counts, or None if they were not saved
+        """
+        if not self.candidates_saved:
+            return None
+        with open(self.candidates_file, 'rb') as f:
+            saved = pickle.load(f)
+        logger.info(f"Loaded {len(saved['groups'])} candidate groups of job {self.job_dir}, without walking")
+        return saved['groups'], saved['counts']
+
+    def save_candidates(self, groups: Dict, counts: Dict):
+        """
+        Save the candidate groups, then checkpoint them - a partially written file is not used.
+        :param groups: the candidate groups, returned by join_candidate_groups()
+        :param counts: the file counts of the walk
+        """
+        with open(self.candidates_file, 'wb') as f:
+            pickle.dump({'groups': groups, 'counts': counts}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.append(self.progress_log, {'event': 'candidates'})
+        self.candidates_saved = True
+
+    def is_batch_completed(self, index: int) -> bool:
+        """ Check if the files of a batch were all moved by a previous run of the job. """
+        return index in self.completed_batches
+
+    def batch_yielded(self, index: int):
+        """ Record a batch the finder yielded to the consumer - it is completed by complete_batch(). """
+        with self.write_lock:
+            self.pending_batches.append(index)
+
+    def complete_batch(self):
+        """
+        Checkpoint the oldest pending batch - its files were all moved. The batches are consumed in the order they
+        are yielded. The hashes computed so far are saved, so the hashes of the next batches are not lost either.
+        """
+        with self.write_lock:
+            index = self.pending_batches.popleft()
+        self.append(self.progress_log, {'event': 'batch', 'index': index})
+        self.completed_batches.add(index)
+        HashManager.get_instance().save_data()
+
+    @staticmethod
+    def get_action_key(entry: Dict) -> Tuple:
+        return entry['operation'], entry['src'], entry['requested']
+
+    def is_action_done(self, operation: str, src: str, requested: str) -> bool:
+        """
+        Check if a file operation was done by a previous run of the job, so it must not be repeated. A move that
+        started and didn't finish in the journal is done if its source is gone and its destination exists - the
+        process stopped right after moving the file.
+        :param operation: 'move' or 'copy'
+        :param src: the source path
+        :param requested: the requested destination path, before it was renamed to a free name
+        :return: True if the operation is done
+        """
+        entry = self.actions.get((operation, src, requested))
+        if entry is None:
+            return False
+        if entry['status'] == 'started':
+            if operation != 'move' or os.path.exists(src) or not os.path.exists(entry['dst']):
+                return False
+            self.action_done(entry)
+        self.skipped_actions += 1
+        return True
+
+    def is_moved_away(self, src: str) -> bool:
+        """
+        Check if a previous run of the job moved a file away, so it must not be hashed again.
+        :param src: the resolved path of the file
+        :return: True if a move of the file is journaled as done
+        """
+        return src in self.moved_sources
+
+    def get_action_destination(self, operation: str, src: str, requested: str) -> str:
+        """ Get the final destination of a journaled operation. """
+        return self.actions[(operation, src, requested)]['dst']
+
+    def action_started(self, op: Dict):
+        """ Journal an operation before it is executed. """
+        self.record_action(op, 'started')
+
+    def action_done(self, op: Dict):
+        """ Journal an operation after it is executed. """
+        self.record_action(op, 'done')
+
+    def record_action(self, op: Dict, status: str):
+        entry = {'status': status, 'operation': op['operation'], 'src': op['src'], 'requested': op['requested'],
+                 'dst': op['dst'], 'size': op.get('size')}
+        self.append(self.actions_log, entry)
+        self.actions[self.get_action_key(entry)] = entry
+
+    def finish(self):
+        """ Record that the job finished. A finished job can still be resumed - all its batches are skipped. """
+        self.append(self.progress_log, {'event': 'finished', 'time': datetime.now().isoformat()})
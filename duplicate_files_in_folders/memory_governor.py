@@ -0,0 +1,176 @@
+import itertools
+import logging
+import os
+import pickle
+import sqlite3
+import tempfile
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from duplicate_files_in_folders.file_manager import FileManager
+
+try:  # optional - only needed for --max_memory on platforms without /proc
+    import psutil
+except ImportError:
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+SPILL_THRESHOLD = 0.8  # spill when the RSS reaches this share of --max_memory
+MEMORY_CHECK_FILES = 10000  # number of files between two checks of the RSS
+
+
+def get_rss() -> int | None:
+    """
+    Get the current resident set size of the process - from /proc/self/status on Linux, else from psutil if it is
+    installed. The peak RSS of the resource module is not used, as it never goes down once the budget is crossed.
+    :return: the RSS in bytes, or None if it can't be measured on this platform
+    """
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+class MemoryGovernor:
+    """
+    Watches the memory of the process against a budget (--max_memory). The stages that index files call tick() for
+    each file, and spill their index to disk when it returns True - see CandidateSpill. The RSS is checked once every
+    check_every files, so watching costs almost nothing.
+    """
+
+    def __init__(self, max_memory: int, threshold: float = SPILL_THRESHOLD, check_every: int = None):
+        """
+        :param max_memory: the memory budget in bytes
+        :param threshold: the share of the budget at which the memory is near the limit
+        :param check_every: number of files between two checks of the RSS - MEMORY_CHECK_FILES by default
+        """
+        self.max_memory = max_memory
+        self.threshold = threshold
+        self.check_every = check_every or MEMORY_CHECK_FILES
+        self.files = 0
+        self.spills = 0
+
+    def tick(self) -> bool:
+        """
+        Count a file, and check the memory every check_every files.
+        :return: True if the memory was checked and is near the limit
+        """
+        self.files += 1
+        return self.files % self.check_every == 0 and self.is_near_limit()
+
+    def is_near_limit(self) -> bool:
+        """ Check if the RSS of the process is near the memory budget. """
+        rss = get_rss()
+        return rss is not None and rss >= self.max_memory * self.threshold
+
+
+class CandidateSpill:
+    """
+    Candidate groups spilled to a temporary SQLite database, when the candidate join is near the memory budget.
+    Each row is a candidate file - its candidate group (size, name, modified time), its side, its inode (to count
+    hardlinks once) and its pickled file stats. Rows are read back partitioned by candidate group, in the order of the
+    groups, and the files of each group in the order they were added - so the groups are the same as the ones of the
+    in-memory join.
+    Only groups with files on both sides are candidates - scan files spilled before their group was matched stay in
+    the database, and are skipped when reading.
+    The database is deleted by close().
+    """
+
+    def __init__(self, directory: str = None):
+        """
+        :param directory: the folder to create the temporary database in - the system temporary folder by default
+        """
+        self.temp_dir = tempfile.TemporaryDirectory(prefix='dff_spill_', dir=directory)
+        self.db_path = os.path.join(self.temp_dir.name, 'candidates.sqlite')
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)  # read by the background pipeline
+        self.connection.execute('PRAGMA journal_mode = OFF')  # a temporary database, not recovered after a crash
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE candidates (id INTEGER PRIMARY KEY, size INTEGER, name TEXT, '
+                                'mtime REAL, side TEXT, inode TEXT, data BLOB)')
+        self.connection.execute('CREATE INDEX candidates_group ON candidates (size, name, mtime, side)')
+        self.sizes = set()  # sizes of the spilled groups - most lookups of unspilled groups stop here
+        self.rows = 0
+
+    def add(self, side: str, group: tuple, file_infos: Iterable[Dict]):
+        """
+        Spill files of a candidate group.
+        :param side: 'scan' or 'ref'
+        :param group: the candidate group - see get_candidate_group()
+        :param file_infos: the files
+        """
+        rows = []
+        for file_info in file_infos:
+            inode = FileManager.get_inode(file_info)
+            rows.append((group[0], group[1], group[2], side, f'{inode[0]}:{inode[1]}' if inode else None,
+                         pickle.dumps(file_info, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.connection.executemany('INSERT INTO candidates (size, name, mtime, side, inode, data) '
+                                    'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.sizes.add(group[0])
+        self.rows += len(rows)
+
+    def has_scan_files(self, group: tuple) -> bool:
+        """ Check if scan files of a candidate group were spilled. """
+        if group[0] not in self.sizes:
+            return False
+        return self.connection.execute(
+            "SELECT 1 FROM candidates WHERE size = ? AND name IS ? AND mtime IS ? AND side = 'scan' LIMIT 1",
+            group).fetchone() is not None
+
+    def get_counts(self) -> Tuple[int, int, int]:
+        """
+        Count the candidates of the groups with files on both sides. The hardlinks of a reference file are counted once,
+        as in count_candidates().
+        :return: number of scan candidates, number of reference candidates, potential bytes reclaimed
+        """
+        row = self.connection.execute(
+            "SELECT SUM(scan), SUM(ref), SUM(size * scan) FROM (SELECT size, SUM(side = 'scan') AS scan, "
+            "COUNT(DISTINCT CASE WHEN side = 'ref' THEN inode END) + SUM(side = 'ref' AND inode IS NULL) AS ref "
+            "FROM candidates GROUP BY size, name, mtime HAVING scan > 0 AND ref > 0)"
+        ).fetchone()
+        return row[0] or 0, row[1] or 0, row[2] or 0
+
+    def iter_groups(self, most_valuable_first: bool = False) -> Iterator[Tuple[tuple, Dict[str, List[Dict]]]]:
+        """
+        Read the candidate groups back, one group at a time.
+        :param most_valuable_first: if True, from the group that may reclaim the most bytes to the least, else in the
+                                    order of the groups (by size) - see iter_candidate_batches()
+        :return: generator of (group, {'scan': [...], 'ref': [...]})
+        """
+        self.connection.commit()
+        if most_valuable_first:
+            groups = self.connection.execute(
+                "SELECT size, name, mtime FROM candidates GROUP BY size, name, mtime "
+                "HAVING SUM(side = 'scan') > 0 AND SUM(side = 'ref') > 0 "
+                "ORDER BY size * SUM(side = 'scan') DESC, size, name, mtime").fetchall()
+            for group in groups:
+                rows = self.connection.execute('SELECT side, data FROM candidates WHERE size = ? AND name IS ? AND '
+                                               'mtime IS ? ORDER BY id', group).fetchall()
+                yield tuple(group), self.get_files(rows)
+            return
+
+        # the rows of each group are next to each other in the index, so the groups are read in a single pass
+        rows = self.connection.execute('SELECT size, name, mtime, side, data FROM candidates '
+                                       'ORDER BY size, name, mtime, id')
+        for group, group_rows in itertools.groupby(rows, key=lambda row: row[:3]):
+            files = self.get_files(row[3:] for row in group_rows)
+            if files['scan'] and files['ref']:
+                yield tuple(group), files
+
+    @staticmethod
+    def get_files(rows: Iterable[Tuple[str, bytes]]) -> Dict[str, List[Dict]]:
+        """ Unpickle the (side, data) rows of a group. """
+        files = {'scan': [], 'ref': []}
+        for side, data in rows:
+            files[side].append(pickle.loads(data))
+        return files
+
+    def close(self):
+        """ Close and delete the database. """
+        self.connection.close()
+        self.temp_dir.cleanup()
@@ -0,0 +1,304 @@
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List
+
+from duplicate_files_in_folders.profiler import RunProfiler
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['walk', 'filter', 'candidate_join', 'keys_prefilter', 'keys_scan', 'keys_ref', 'actions', 'save']
+COUNTERS = ['files_opened', 'bytes_read', 'stat_calls', 'scandir_calls', 'file_operations', 'cache_hits',
+            'cache_requests']
+IO_FIELDS = {'rchar': 'io_read_bytes', 'read_bytes': 'io_disk_read_bytes', 'syscr': 'io_read_syscalls',
+             'syscw': 'io_write_syscalls'}
+ITER_CHUNK_SIZE = 1000  # items pulled from a lazy stage at a time, see MetricsCollector.iter_stage()
+
+
+def get_peak_rss() -> int | None:
+    """
+    Get the peak resident set size of the process, from the resource module.
+    :return: the peak RSS in bytes, or None if it can't be measured on this platform (Windows)
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, kilobytes elsewhere
+
+
+class MetricsCollector:
+    """
+    Collects the metrics of each stage of a run (--metrics_json): wall time, CPU time, bytes read and files opened to
+    hash files, stat and scandir calls, file operations, the I/O of the process from /proc/self/io (Linux), the hash
+    cache hit ratio and the peak RSS.
+    A stage is measured by the difference of the process counters when it starts and ends. Stages are exclusive in
+    the thread that runs them - a stage entered inside another one is subtracted from it. The CPU time and the
+    counters are those of the whole process, so stages that run at the same time in different threads (the
+    background pipeline, --overlap) share them.
+    Code calls the class methods stage(), iter_stage() and count(), which do nothing until a collector is created.
+    The stages are profiled too when a RunProfiler is set up (--profile).
+    """
+    _instance = None
+    _lock = Lock()
+
+    def __new__(cls, *args, **kwargs):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance.__initialized = False
+        return cls._instance
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            raise Exception("MetricsCollector not initialized")
+        return cls._instance
+
+    @classmethod
+    def is_initialized(cls) -> bool:
+        return cls._instance is not None
+
+    @classmethod
+    def reset_instance(cls):
+        with cls._lock:
+            if cls._instance is not None:
+                cls._instance.close()
+            cls._instance = None
+
+    def __init__(self):
+        if self.__initialized:
+            return
+        self.__initialized = True
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.counters_lock = Lock()
+        self.stages: Dict[str, Dict] = {}
+        self.stages_lock = Lock()
+        self.local = threading.local()  # the stack of stages entered in each thread
+        # the I/O counters are kept open and read again at every snapshot, as opening the file costs more than reading
+        # it. The reads of the collector itself are not counted.
+        try:
+            self.io_fd = os.open('/proc/self/io', os.O_RDONLY)
+        except (OSError, AttributeError):
+            self.io_fd = None
+        self.own_reads = {'io_read_syscalls': 0, 'io_read_bytes': 0}
+        self.started = datetime.now()
+        self.start_snapshot = self.snapshot()
+
+    def close(self):
+        """ Close the I/O counters file. """
+        if self.io_fd is not None:
+            os.close(self.io_fd)
+            self.io_fd = None
+
+    @classmethod
+    def count(cls, name: str, n: int = 1):
+        """
+        Add to a counter of the collector, if there is one.
+        :param name: one of COUNTERS
+        :param n: the amount to add
+        """
+        instance = cls._instance
+        if instance is None:
+            return
+        with instance.counters_lock:
+            instance.counters[name] += n
+
+    @classmethod
+    def stage(cls, name: str):
+        """
+        Measure a stage of the run, if there is a collector, and profile it if there is a RunProfiler.
+        :param name: the name of the stage, one of STAGES
+        :return: a context manager
+        """
+        instance = cls._instance
+        profiler = RunProfiler._instance
+        if instance is None and profiler is None:
+            return contextlib.nullcontext()
+        return _Stage(instance, profiler, name)
+
+    @classmethod
+    def iter_stage(cls, name: str, items: Iterable, chunk_size: int = ITER_CHUNK_SIZE) -> Iterable:
+        """
+        Measure a lazy stage - the time spent producing the items of a generator, e.g. the walk in the candidate
+        join. The items are pulled chunk_size at a time inside the stage, so the stage is not measured per item.
+        :param name: the name of the stage, one of STAGES
+        :param items: the items
+        :param chunk_size: number of items pulled at a time
+        :return: the same items - items itself if there is no collector or profiler
+        """
+        if cls._instance is None and RunProfiler._instance is None:
+            return items
+        return cls._iter_chunks(name, iter(items), chunk_size)
+
+    @classmethod
+    def _iter_chunks(cls, name: str, items: Iterator, chunk_size: int) -> Iterator:
+        while True:
+            with cls.stage(name):
+                chunk = [item for _, item in zip(range(chunk_size), items)]
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+
+    def enter_stage(self):
+        """ Start measuring a stage in the current thread - see stage(). """
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append({'start': self.snapshot(), 'nested': {}})
+
+    def exit_stage(self, name: str):
+        """ Stop measuring the last stage entered in the current thread, and add its metrics. """
+        stack = self.local.stack
+        frame = stack.pop()
+        total = self.subtract(self.snapshot(), frame['start'])
+        exclusive = self.subtract(total, frame['nested'])
+        if stack:  # the parent stage excludes this one
+            parent = stack[-1]['nested']
+            for key, value in total.items():
+                parent[key] = parent.get(key, 0) + value
+        self.add_to_stage(name, exclusive)
+
+    def snapshot(self) -> Dict[str, float]:
+        """ Get the current values of the process counters. """
+        snapshot = {'wall_seconds': time.perf_counter(), 'cpu_seconds': time.process_time()}
+        with self.counters_lock:
+            snapshot.update(self.counters)
+        snapshot.update(self.read_io())
+        return snapshot
+
+    def read_io(self) -> Dict[str, int]:
+        """ Read the I/O counters of the process from /proc/self/io - empty if not available. """
+        if self.io_fd is None:
+            return {}
+        try:
+            data = os.pread(self.io_fd, 4096, 0)
+        except OSError:
+            return {}
+        io = {}
+        for line in data.decode('ascii').splitlines():
+            key, _, value = line.partition(':')
+            if key in IO_FIELDS:
+                io[IO_FIELDS[key]] = int(value)
+        with self.counters_lock:  # the counters are read before this read is added to them
+            for key, value in self.own_reads.items():
+                io[key] = io.get(key, 0) - value
+            self.own_reads['io_read_syscalls'] += 1
+            self.own_reads['io_read_bytes'] += len(data)
+        return io
+
+    @staticmethod
+    def subtract(end: Dict[str, float], start: Dict[str, float]) -> Dict[str, float]:
+        return {key: value - start.get(key, 0) for key, value in end.items()}
+
+    def add_to_stage(self, name: str, values: Dict[str, float]):
+        with self.stages_lock:
+            stage = self.stages.setdefault(name, {'calls': 0})
+            stage['calls'] += 1
+            for key, value in values.items():
+                stage[key] = stage.get(key, 0) + value
+            peak_rss = get_peak_rss()
+            if peak_rss is not None:  # the high-water mark of the process when the stage ended
+                stage['peak_rss'] = max(stage.get('peak_rss', 0), peak_rss)
+
+    @staticmethod
+    def finish_values(values: Dict[str, float]) -> Dict[str, float]:
+        """ Round the times and add the cache hit ratio. """
+        values = dict(values)
+        for key in ['wall_seconds', 'cpu_seconds']:
+            if key in values:
+                values[key] = round(values[key], 6)
+        if values.get('cache_requests'):
+            values['cache_hit_ratio'] = round(values['cache_hits'] / values['cache_requests'], 4)
+        return values
+
+    def get_report(self) -> Dict:
+        """
+        Get the metrics of the run.
+        :return: dictionary with the 'stages' in the order of STAGES, and the 'total' of the process since the
+                 collector was created
+        """
+        with self.stages_lock:
+            names = [name for name in STAGES if name in self.stages] + \
+                    [name for name in self.stages if name not in STAGES]
+            stages = {name: self.finish_values(self.stages[name]) for name in names}
+        total = self.finish_values(self.subtract(self.snapshot(), self.start_snapshot))
+        peak_rss = get_peak_rss()
+        if peak_rss is not None:
+            total['peak_rss'] = peak_rss
+        return {'started': self.started.isoformat(), 'stages': stages, 'total': total}
+
+    def write_json(self, path: str) -> Dict:
+        """
+        Write the metrics of the run to a JSON file.
+        :param path: the path of the file
+        :return: the metrics written, see get_report()
+        """
+        report = self.get_report()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    @staticmethod
+    def format_table(report: Dict) -> List[str]:
+        """
+        Format the metrics of a run as a table, a line per stage and a line for the total.
+        :param report: the metrics, see get_report()
+        :return: the lines of the table
+        """
+        columns = [('Stage', 16), ('Wall s', 9), ('CPU s', 9), ('Read MB', 10), ('Opened', 9), ('Stats', 10),
+                   ('Syscalls', 10), ('Cache %', 8), ('Peak RSS MB', 12)]
+
+        def row(name: str, values: Dict) -> str:
+            cache = f"{values['cache_hit_ratio'] * 100:.1f}" if 'cache_hit_ratio' in values else '-'
+            syscalls = values.get('io_read_syscalls', 0) + values.get('io_write_syscalls', 0) \
+                if 'io_read_syscalls' in values else '-'
+            peak_rss = f"{values['peak_rss'] / (1024 * 1024):.1f}" if 'peak_rss' in values else '-'
+            cells = [name, f"{values['wall_seconds']:.2f}", f"{values['cpu_seconds']:.2f}",
+                     f"{values.get('bytes_read', 0) / (1024 * 1024):.1f}", values.get('files_opened', 0),
+                     values.get('stat_calls', 0), syscalls, cache, peak_rss]
+            return ' '.join(str(cell).ljust(width) if index == 0 else str(cell).rjust(width)
+                            for index, (cell, (_, width)) in enumerate(zip(cells, columns)))
+
+        header = ' '.join(title.ljust(width) if index == 0 else title.rjust(width)
+                          for index, (title, width) in enumerate(columns))
+        lines = [header, '-' * len(header)]
+        lines += [row(name, values) for name, values in report['stages'].items()]
+        lines += ['-' * len(header), row('total', report['total'])]
+        return lines
+
+
+class _Stage:
+    """
+    Context manager measuring and profiling a stage - see MetricsCollector.stage(). A class rather than a generator,
+    so the profile of the stage has no frames of contextlib. The profile is inside the measure.
+    """
+
+    def __init__(self, collector: MetricsCollector | None, profiler: RunProfiler | None, name: str):
+        self.collector = collector
+        self.profile = profiler.profile(name) if profiler is not None else None
+        self.name = name
+
+    def __enter__(self):
+        if self.collector is not None:
+            self.collector.enter_stage()
+        if self.profile is not None:
+            self.profile.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if self.profile is not None:
+                self.profile.__exit__(exc_type, exc_val, exc_tb)
+        finally:
+            if self.collector is not None:
+                self.collector.exit_stage(self.name)
+        return False
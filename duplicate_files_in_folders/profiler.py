@@ -0,0 +1,310 @@
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+MEMORY_SNAPSHOT_GROWTH = 1.1  # a new tracemalloc snapshot of a stage is taken when its peak grows by this factor
+MEMORY_TOP_LINES = 10  # lines of each stage snapshot listed in memory.txt
+MAX_STACK_DEPTH = 100  # deeper stacks are cut in the collapsed stacks
+MIN_STACK_SHARE = 0.0001  # stacks with less than this share of the time of their stage are left out
+# the stage hooks run while the profiler of a stage is enabled - their frames are removed from the profiles
+HOOK_FILES = {'profiler.py', 'metrics.py'}
+
+
+def get_frame_label(func: tuple) -> str:
+    """
+    Get the label of a function of a pstats profile in a collapsed stack.
+    :param func: the (file name, line number, function name) of the function
+    :return: the label - function name (file:line), without the ';' that separates the frames of a stack
+    """
+    filename, line, name = func
+    label = name if filename == '~' else f"{name} ({os.path.basename(filename)}:{line})"
+    return label.replace(';', ',')
+
+
+def remove_hook_frames(stats: pstats.Stats):
+    """
+    Remove the frames of the stage hooks from a profile - the functions of HOOK_FILES, and the built-in functions
+    only they call (e.g. the disable() of the profiler).
+    :param stats: the profile, changed in place
+    """
+    def is_hook(func: tuple) -> bool:
+        return os.path.basename(func[0]) in HOOK_FILES and os.path.dirname(func[0]) == os.path.dirname(__file__)
+
+    removed = {func for func in stats.stats if is_hook(func)}
+    removed |= {func for func, entry in stats.stats.items()
+                if func[0] == '~' and entry[4] and all(is_hook(caller) for caller in entry[4])}
+    for func in removed:
+        del stats.stats[func]
+    for func, (cc, nc, tt, ct, callers) in list(stats.stats.items()):
+        if any(caller in removed for caller in callers):
+            stats.stats[func] = (cc, nc, tt, ct,
+                                 {caller: edge for caller, edge in callers.items() if caller not in removed})
+
+
+def get_collapsed_stacks(stats: pstats.Stats) -> Dict[str, int]:
+    """
+    Rebuild the call stacks of a profile in the collapsed format of flamegraph tools (flamegraph.pl, speedscope,
+    inferno) - 'frame;frame;frame' to the time spent in the last frame, in microseconds.
+    cProfile records the callers of each function, not whole stacks, so the stacks are rebuilt from the roots down:
+    the time of a function is split between its callers in proportion to the time of each call edge. Recursive calls
+    are cut, and so are stacks deeper than MAX_STACK_DEPTH or with less than MIN_STACK_SHARE of the time.
+    :param stats: the profile
+    :return: dictionary of collapsed stack to microseconds
+    """
+    entries = stats.stats  # func -> (primitive calls, calls, own time, cumulative time, callers)
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3] if isinstance(edge, tuple) else 0  # the cumulative time of the edge
+    # the roots are the functions called from outside the profile - e.g. by the code that entered the stage. These
+    # calls have no caller, so their share is the time left when the time of the calls from the callers is removed.
+    roots = {}
+    for func, (_, _, _, cumulative_time, callers) in entries.items():
+        called_time = sum(callees[caller][func] for caller in callers if caller != func)
+        if not callers:
+            roots[func] = 1.0
+        elif cumulative_time and called_time < cumulative_time * (1 - MIN_STACK_SHARE):
+            roots[func] = 1.0 - called_time / cumulative_time
+    total = sum(entries[func][3] * share for func, share in roots.items())
+    min_time = total * MIN_STACK_SHARE
+    stacks = defaultdict(float)
+
+    def visit(func: tuple, path: List[tuple], share: float):
+        _, _, own_time, cumulative_time, _ = entries[func]
+        path = path + [func]
+        if own_time * share > 0:
+            stacks[';'.join(get_frame_label(frame) for frame in path)] += own_time * share * 1000000
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_time in callees.get(func, {}).items():
+            callee_time = entries[callee][3] if callee in entries else 0
+            if callee in path or not callee_time or edge_time * share < min_time:
+                continue
+            visit(callee, path, share * min(edge_time / callee_time, 1.0))
+
+    for root, share in roots.items():
+        visit(root, [], share)
+    return {stack: round(value) for stack, value in stacks.items() if round(value) > 0}
+
+
+class RunProfiler:
+    """
+    Profiles the stages of a run (--profile) - the same stages as the MetricsCollector, which calls profile() when a
+    stage is entered. Each stage has a cProfile profiler in each thread that runs it, enabled only while the stage
+    runs - a stage entered inside another one pauses it. With trace_memory (--profile_memory), tracemalloc traces the
+    allocations, and a snapshot is taken at the end of a stage whenever its peak grows.
+    save() writes to the profile folder, for each stage and for the whole run ('run'):
+    - <stage>.pstats: the profile, for pstats, snakeviz, gprof2dot etc.
+    - <stage>.collapsed.txt: the collapsed stacks, for flamegraph tools - see get_collapsed_stacks(). The stacks of
+      run.collapsed.txt start with the name of their stage.
+    - <stage>.tracemalloc and memory.txt: the last snapshot of each stage, and the peak and top allocations of each
+    From Python 3.12, a single profiler can be active at a time in the process - stages entered while another thread
+    profiles a stage are not profiled, and are counted in skipped.
+    """
+    _instance = None
+    _lock = Lock()
+
+    def __new__(cls, *args, **kwargs):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance.__initialized = False
+        return cls._instance
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            raise Exception("RunProfiler not initialized")
+        return cls._instance
+
+    @classmethod
+    def is_initialized(cls) -> bool:
+        return cls._instance is not None
+
+    @classmethod
+    def reset_instance(cls):
+        with cls._lock:
+            if cls._instance is not None:
+                cls._instance.stop()
+            cls._instance = None
+
+    def __init__(self, profile_dir: str = None, trace_memory: bool = False):
+        """
+        :param profile_dir: the folder to save the profiles to
+        :param trace_memory: if True, trace the allocations of each stage with tracemalloc
+        """
+        if self.__initialized:
+            return
+        self.__initialized = True
+        self.profile_dir = profile_dir
+        self.profiles: Dict[tuple, cProfile.Profile] = {}  # (stage, thread id) -> profiler
+        self.profiles_lock = Lock()
+        self.local = threading.local()  # the stack of profilers of the stages entered in each thread
+        self.skipped = defaultdict(int)
+        self.trace_memory = trace_memory
+        self.memory_peaks: Dict[str, int] = {}
+        self.memory_snapshots: Dict[str, tracemalloc.Snapshot] = {}
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        """ Stop tracing the allocations. """
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def get_profiler(self, name: str) -> cProfile.Profile:
+        key = (name, threading.get_ident())
+        with self.profiles_lock:
+            if key not in self.profiles:
+                self.profiles[key] = cProfile.Profile()
+            return self.profiles[key]
+
+    @staticmethod
+    def enable(profiler: cProfile.Profile | None) -> bool:
+        """ Enable a profiler - False if another profiler is active (Python 3.12+). """
+        if profiler is None:
+            return False
+        try:
+            profiler.enable()
+        except ValueError:
+            return False
+        return True
+
+    def profile(self, name: str):
+        """
+        Profile a stage - see MetricsCollector.stage().
+        :param name: the name of the stage
+        :return: a context manager
+        """
+        return _StageProfile(self, name)
+
+    def check_memory(self, name: str):
+        """ Record the peak of the traced memory since the previous stage ended, and snapshot it if it grew. """
+        if not tracemalloc.is_tracing():
+            return
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        with self.profiles_lock:
+            if peak < self.memory_peaks.get(name, 0) * MEMORY_SNAPSHOT_GROWTH and name in self.memory_snapshots:
+                self.memory_peaks[name] = max(self.memory_peaks[name], peak)
+                return
+            self.memory_peaks[name] = max(self.memory_peaks.get(name, 0), peak)
+        snapshot = tracemalloc.take_snapshot()
+        with self.profiles_lock:
+            self.memory_snapshots[name] = snapshot
+
+    def get_stage_stats(self) -> Dict[str, pstats.Stats]:
+        """
+        Merge the profilers of each stage.
+        :return: dictionary of stage name to its profile, in the order the stages were first entered
+        """
+        stage_profiles = defaultdict(list)
+        with self.profiles_lock:
+            for (name, _), profiler in self.profiles.items():
+                stage_profiles[name].append(profiler)
+        stage_stats = {}
+        for name, profilers in stage_profiles.items():
+            stats = None
+            for profiler in profilers:
+                profiler.create_stats()
+                if not profiler.stats:
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+            if stats is not None:
+                remove_hook_frames(stats)
+                stage_stats[name] = stats
+        return stage_stats
+
+    def save(self) -> List[str]:
+        """
+        Save the profiles to the profile folder, and stop tracing the allocations.
+        :return: the paths of the files written
+        """
+        paths = []
+        stage_stats = self.get_stage_stats()
+        run_stacks = {}
+        run_stats = pstats.Stats()  # merges the profiles of all the stages
+        for name, stats in stage_stats.items():
+            paths.append(self.write_stats(name, stats))
+            stacks = get_collapsed_stacks(stats)
+            paths.append(self.write_stacks(name, stacks))
+            run_stacks.update({f"{name};{stack}": value for stack, value in stacks.items()})
+            run_stats.add(stats)
+        if stage_stats:
+            paths.append(self.write_stats('run', run_stats))
+            paths.append(self.write_stacks('run', run_stacks))
+        if self.memory_snapshots:
+            paths += self.write_memory()
+        for name, count in self.skipped.items():
+            logger.warning(f"Stage {name} was not profiled {count} times - another thread was being profiled")
+        self.stop()
+        return paths
+
+    def write_stats(self, name: str, stats: pstats.Stats) -> str:
+        path = os.path.join(self.profile_dir, f"{name}.pstats")
+        stats.dump_stats(path)
+        return path
+
+    def write_stacks(self, name: str, stacks: Dict[str, int]) -> str:
+        path = os.path.join(self.profile_dir, f"{name}.collapsed.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, value in sorted(stacks.items()):
+                f.write(f"{stack} {value}\n")
+        return path
+
+    def write_memory(self) -> List[str]:
+        """ Write the tracemalloc snapshot of each stage, and a summary of the peaks and top allocations. """
+        paths = []
+        summary_path = os.path.join(self.profile_dir, 'memory.txt')
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            for name, snapshot in self.memory_snapshots.items():
+                path = os.path.join(self.profile_dir, f"{name}.tracemalloc")
+                snapshot.dump(path)
+                paths.append(path)
+                f.write(f"{name}: peak {self.memory_peaks.get(name, 0) / (1024 * 1024):.1f} MB\n")
+                for stat in snapshot.statistics('lineno')[:MEMORY_TOP_LINES]:
+                    f.write(f"    {stat}\n")
+                f.write("\n")
+        paths.append(summary_path)
+        return paths
+
+
+class _StageProfile:
+    """ Context manager profiling a stage in the current thread - see RunProfiler.profile(). """
+
+    def __init__(self, run_profiler: RunProfiler, name: str):
+        self.run_profiler = run_profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.run_profiler.local.__dict__.setdefault('stack', [])
+        if stack and stack[-1] is not None:
+            stack[-1].disable()  # the parent stage is paused
+        profiler = self.run_profiler.get_profiler(self.name)
+        stack.append(profiler)
+        if not self.run_profiler.enable(profiler):
+            self.run_profiler.skipped[self.name] += 1
+            stack[-1] = None
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        stack = self.run_profiler.local.stack
+        profiler = stack.pop()
+        if profiler is not None:
+            profiler.disable()
+        if self.run_profiler.trace_memory:
+            self.run_profiler.check_memory(self.name)
+        if stack and stack[-1] is not None and not self.run_profiler.enable(stack[-1]):
+            stack[-1] = None  # another thread took the profiler over - the rest of the parent stage is not profiled
+        return False
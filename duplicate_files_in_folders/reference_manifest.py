@@ -0,0 +1,238 @@
+import concurrent.futures
+import gzip
+import json
+import logging
+import os
+import re
+from argparse import Namespace
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+
+import tqdm
+
+from duplicate_files_in_folders.file_manager import FileManager
+from duplicate_files_in_folders.hash_manager import HashManager
+from duplicate_files_in_folders.tree_snapshot import TreeSnapshot
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+CHECKSUM_ALGORITHMS = {32: 'md5', 40: 'sha1', 64: 'sha256'}  # hex digest length to algorithm
+PREFERRED_CHECKSUM_ALGORITHMS = ['sha256', 'sha1', 'md5']  # used when a hashdeep file has several algorithms
+BSD_CHECKSUM_LINE = re.compile(r'^(MD5|SHA1|SHA256) \((.*)\) = ([0-9a-fA-F]+)$')
+HEX_DIGEST = re.compile(r'^[0-9a-fA-F]+$')
+
+
+def get_manifest_file_path(args: Namespace) -> str:
+    """
+    Get the path of the reference manifest file to export.
+    :param args: parsed arguments
+    :return: the path of the manifest file
+    """
+    return str(os.path.join(args.move_to, os.path.basename(args.reference_dir) + "_manifest.jsonl.gz"))
+
+
+def export_reference_manifest(args: Namespace, ref_dir: str, manifest_file: str, output_progress=False) -> int:
+    """
+    Export a manifest of the reference directory: the relative path, size, modified time and the partial and full
+    hashes of every file. The manifest can replace the reference directory in later runs (see --reference_manifest),
+    so the reference directory doesn't need to be available or read again.
+    The manifest is a gzip compressed JSON lines file - a header line followed by a line per file.
+    :param args: parsed arguments
+    :param ref_dir: the reference directory
+    :param manifest_file: path of the manifest file to create
+    :param output_progress: whether to output progress
+    :return: number of files in the manifest
+    """
+    ref_dir = os.path.abspath(ref_dir)
+    if TreeSnapshot.is_initialized():
+        ref_stats = TreeSnapshot.get_instance().get_files_and_stats(ref_dir, args.full_rescan)
+    else:
+        ref_stats = FileManager.get_files_and_stats(ref_dir)
+    ref_stats = sorted(ref_stats, key=lambda x: x['path'])
+
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        FileManager.get_instance().make_dirs(manifest_dir)
+
+    header = {'version': MANIFEST_VERSION, 'root': ref_dir, 'created': datetime.now().isoformat()}
+    with gzip.open(manifest_file, 'wt', encoding='utf-8') as f, \
+            concurrent.futures.ThreadPoolExecutor() as executor:
+        f.write(json.dumps(header) + '\n')
+        # executor.map keeps the order of the files, so the manifest is written sorted by path
+        digests = executor.map(lambda file_info: HashManager.compute_digests(file_info['path']), ref_stats)
+        for file_info, file_digests in tqdm.tqdm(zip(ref_stats, digests), total=len(ref_stats),
+                                                 desc='Exporting reference manifest', disable=not output_progress):
+            record = {'p': os.path.relpath(file_info['path'], ref_dir).replace(os.sep, '/'),
+                      's': file_info['size'], 'm': file_info['modified_time'], 'c': file_info['created_time'],
+                      'h': file_digests['partial'], 'f': file_digests['full']}
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    logger.info(f"Exported manifest of {len(ref_stats)} files in {ref_dir} to {manifest_file}")
+    return len(ref_stats)
+
+
+def read_manifest_header(manifest_file: str) -> Dict:
+    """
+    Read the header of a reference manifest file.
+    :param manifest_file: path of the manifest file
+    :return: the header dictionary, with the 'version' and 'root' of the manifest
+    :raises: ValueError if the file is not a valid manifest
+    """
+    try:
+        with gzip.open(manifest_file, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Invalid manifest file {manifest_file}: {e}")
+    if not isinstance(header, dict) or header.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"Invalid manifest file {manifest_file}: unsupported version")
+    return header
+
+
+def load_reference_manifest(manifest_file: str, root: str = None) -> Tuple[str, List[Dict]]:
+    """
+    Load the file records of a reference manifest.
+    :param manifest_file: path of the manifest file
+    :param root: the reference directory the paths are relative to. Default is the directory the manifest was
+                 exported from.
+    :return: the reference directory and a list of file stats, in the same format as FileManager.get_files_and_stats()
+             with the 'partial_hash' and 'full_hash' of each file
+    :raises: ValueError if the file is not a valid manifest
+    """
+    header = read_manifest_header(manifest_file)
+    root = root if root else header['root']
+    files_stats = []
+    with gzip.open(manifest_file, 'rt', encoding='utf-8') as f:
+        f.readline()  # skip the header
+        for line in f:
+            record = json.loads(line)
+            relative_parts = record['p'].split('/')
+            files_stats.append({'path': os.path.join(root, *relative_parts), 'size': record['s'],
+                                'name': relative_parts[-1], 'modified_time': record['m'],
+                                'created_time': record['c'], 'partial_hash': record['h'], 'full_hash': record['f']})
+    return root, files_stats
+
+
+def parse_checksum_line(line: str, hashdeep_columns: List[str] | None) -> Tuple[str, str, str, int | None] | None:
+    """
+    Parse a single line of a checksum file.
+    Supported formats: sha256sum/sha1sum/md5sum (text, binary, escaped and BSD style), md5deep/sha256deep (with or
+    without the -z size column) and hashdeep.
+    :param line: the line to parse, without the line break
+    :param hashdeep_columns: the columns of a hashdeep file, or None if it is not a hashdeep file
+    :return: tuple of (algorithm, hex digest, file path, file size or None), or None if the line is not valid
+    """
+    if hashdeep_columns:
+        record = dict(zip(hashdeep_columns, line.split(',', len(hashdeep_columns) - 1)))
+        algorithm = next((name for name in PREFERRED_CHECKSUM_ALGORITHMS if name in record), None)
+        if algorithm is None or 'filename' not in record or not HEX_DIGEST.match(record[algorithm]):
+            return None
+        size = int(record['size']) if record.get('size', '').isdigit() else None
+        return algorithm, record[algorithm].lower(), record['filename'], size
+
+    match = BSD_CHECKSUM_LINE.match(line)
+    if match:
+        return match.group(1).lower(), match.group(3).lower(), match.group(2), None
+
+    escaped = line.startswith('\\')  # sha256sum escapes file names with backslashes or new lines
+    if escaped:
+        line = line[1:]
+    size = None
+    tokens = line.lstrip().split(' ', 1)
+    if len(tokens) == 2 and tokens[0].isdigit() and len(tokens[0]) not in CHECKSUM_ALGORITHMS:  # md5deep -z
+        size = int(tokens[0])
+        tokens = tokens[1].lstrip().split(' ', 1)
+    if len(tokens) != 2 or len(tokens[0]) not in CHECKSUM_ALGORITHMS or not HEX_DIGEST.match(tokens[0]):
+        return None
+    digest, file_path = tokens
+    if file_path[:1] in (' ', '*'):  # text or binary mode marker of sha256sum, or the second space of md5deep
+        file_path = file_path[1:]
+    if escaped:
+        file_path = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), file_path)
+    return CHECKSUM_ALGORITHMS[len(digest)], digest.lower(), file_path, size
+
+
+def iter_checksum_file(checksum_file: str) -> Iterator[Tuple[str, str, str, int | None]]:
+    """
+    Stream the entries of a checksum file created by sha256sum, md5sum, md5deep, hashdeep or similar tools.
+    :param checksum_file: path of the checksum file
+    :return: generator of (algorithm, hex digest, file path, file size or None) tuples
+    """
+    hashdeep_columns = None
+    with open(checksum_file, 'r', encoding='utf-8', errors='surrogateescape') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('%%%%'):  # hashdeep header, e.g. "%%%% size,md5,sha256,filename"
+                header = line[4:].strip()
+                if ',' in header:
+                    hashdeep_columns = header.split(',')
+                continue
+            entry = parse_checksum_line(line, hashdeep_columns)
+            if entry is None:
+                logger.warning(f"Skipping invalid line {line_number} in checksum file {checksum_file}")
+                continue
+            yield entry
+
+
+def detect_checksum_algorithm(checksum_file: str) -> str:
+    """
+    Detect the checksum algorithm of a checksum file by its first valid entry.
+    :param checksum_file: path of the checksum file
+    :return: the algorithm name - md5, sha1 or sha256
+    :raises: ValueError if the file has no valid entries
+    """
+    for algorithm, _, _, _ in iter_checksum_file(checksum_file):
+        return algorithm
+    raise ValueError(f"No valid entries found in checksum file {checksum_file}")
+
+
+def load_checksum_file(checksum_file: str, root: str = None) -> Tuple[str, List[Dict]]:
+    """
+    Load a checksum file as an index of the reference directory. Each listed file is validated with a single stat:
+    its checksum is used only if the file size matches (when the checksum file has sizes) and the file wasn't
+    modified after the checksum file was created. Otherwise, the checksum is computed again when it is needed.
+    If the algorithm is sha256 and the HashManager uses full hashes, the valid checksums are also added to the hash
+    cache, so later runs without the checksum file don't need to read the reference files either.
+    :param checksum_file: path of the checksum file
+    :param root: the reference directory. Relative paths in the checksum file are relative to it, and files outside
+                 of it are ignored. Default is the folder of the checksum file.
+    :return: the checksum algorithm and a list of file stats, in the same format as FileManager.get_files_and_stats()
+             with the 'checksum' of each file (None if the checksum cannot be trusted)
+    :raises: ValueError if the file has no valid entries
+    """
+    algorithm = detect_checksum_algorithm(checksum_file)
+    root = os.path.abspath(root if root else os.path.dirname(os.path.abspath(checksum_file)))
+    checksum_file_mtime = os.stat(checksum_file).st_mtime
+    files_stats = {}
+    skipped = {'other algorithm': 0, 'outside reference folder': 0, 'missing': 0, 'changed': 0}
+
+    for entry_algorithm, digest, file_path, size in iter_checksum_file(checksum_file):
+        if entry_algorithm != algorithm:
+            skipped['other algorithm'] += 1
+            continue
+        file_path = os.path.normpath(os.path.join(root, file_path))  # absolute paths are kept as they are
+        if not file_path.startswith(root + os.sep):
+            skipped['outside reference folder'] += 1
+            continue
+        try:
+            stats = os.stat(file_path)
+        except OSError:
+            skipped['missing'] += 1
+            continue
+        is_valid = (size is None or size == stats.st_size) and stats.st_mtime <= checksum_file_mtime
+        if not is_valid:
+            skipped['changed'] += 1
+        files_stats[file_path] = {'path': file_path, 'size': stats.st_size, 'name': os.path.basename(file_path),
+                                  'modified_time': stats.st_mtime, 'created_time': stats.st_ctime,
+                                  'dev': stats.st_dev, 'ino': stats.st_ino, 'checksum': digest if is_valid else None}
+
+    hash_manager = HashManager.get_instance()
+    if algorithm == 'sha256' and hash_manager.full_hash:
+        hash_manager.add_hashes({file_path: file_info['checksum'] for file_path, file_info in files_stats.items()
+                                 if file_info['checksum']})
+
+    logger.info(f"Loaded {len(files_stats)} {algorithm} checksums from {checksum_file}. Skipped: {skipped}")
+    return algorithm, list(files_stats.values())
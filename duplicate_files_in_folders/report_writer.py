@@ -0,0 +1,217 @@
+import csv
+import gzip
+import json
+import logging
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+try:  # optional - only needed for Parquet reports
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+REPORT_FORMATS = ['csv', 'jsonl', 'parquet']
+REPORT_COLUMNS = ['key', 'path', 'size', 'modified_time']
+PARQUET_BATCH_ROWS = 100_000  # rows buffered before they are written as a Parquet row group
+
+
+@lru_cache(maxsize=65536)
+def format_modified_time(modified_time: float) -> str:
+    """
+    Format a modified time for a report. Duplicates usually share their modified time, so the result is cached.
+    :param modified_time: timestamp
+    :return: the local date and time, e.g. '2024-05-01 10:20:30.123456'
+    """
+    return str(datetime.fromtimestamp(modified_time))
+
+
+def is_parquet_available() -> bool:
+    """ Check if pyarrow is installed, so Parquet reports can be written. """
+    return pyarrow is not None
+
+
+def get_report_extension(report_format: str, compress: bool = False) -> str:
+    """
+    Get the file extension of a report.
+    :param report_format: one of REPORT_FORMATS
+    :param compress: True if the report is gzip compressed - Parquet files are compressed internally
+    :return: the extension, e.g. '.csv.gz'
+    """
+    extension = '.' + report_format
+    return extension + '.gz' if compress and report_format != 'parquet' else extension
+
+
+class ReportSink:
+    """
+    Writes the duplicate groups to a report as they are confirmed, instead of building the whole report in memory.
+    Each file of a group is a row - the group number, path, size and modified time. A group is never split between
+    shards: if shard_rows is given, a new file ('<name>_part0002.csv' etc.) is started before the first group that
+    comes after shard_rows rows.
+    Subclasses implement the format - open_shard(), write_rows() and close_shard().
+    """
+    FORMAT = None  # one of REPORT_FORMATS
+
+    def __init__(self, path: str, compress: bool = False, shard_rows: int = None):
+        """
+        :param path: path of the report - without sharding - including its extension, see get_report_extension()
+        :param compress: compress the report with gzip
+        :param shard_rows: maximum number of rows in a file, or None to write a single file
+        """
+        self.path = path
+        self.compress = compress
+        self.shard_rows = shard_rows
+        self.paths: List[str] = []  # the files written so far
+        self.groups = self.rows = self.rows_in_shard = 0
+        self.is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_shard_path(self, index: int) -> str:
+        """ Get the path of a shard - the report path if it is not sharded. """
+        if not self.shard_rows:
+            return self.path
+        extension = get_report_extension(self.__class__.FORMAT, self.compress)
+        return f"{self.path[:-len(extension)]}_part{index:04d}{extension}"
+
+    def open_text(self, path: str):
+        """ Open a text file for writing, compressed if needed. """
+        if self.compress:
+            return gzip.open(path, 'wt', encoding='utf-8', newline='')
+        return open(path, 'w', encoding='utf-8', newline='')
+
+    def next_shard(self):
+        """ Close the current shard, if any, and open the next one. """
+        if self.is_open:
+            self.close_shard()
+        path = self.get_shard_path(len(self.paths) + 1)
+        self.open_shard(path)
+        self.paths.append(path)
+        self.is_open = True
+        self.rows_in_shard = 0
+
+    def write_group(self, locations: Dict[str, List[Dict]]):
+        """
+        Write a group of duplicates.
+        :param locations: the locations of the group - {'scan': [file infos], 'ref': [file infos]}
+        """
+        if not self.is_open or (self.shard_rows and self.rows_in_shard >= self.shard_rows):
+            self.next_shard()
+        self.groups += 1
+        rows = [(self.groups, file_info['path'], file_info['size'], file_info['modified_time'])
+                for files in locations.values() for file_info in files]
+        self.write_rows(rows)
+        self.rows += len(rows)
+        self.rows_in_shard += len(rows)
+
+    def close(self):
+        """ Close the report. An empty report is still written, with its header if the format has one. """
+        if not self.is_open and not self.paths:
+            self.next_shard()
+        if self.is_open:
+            self.close_shard()
+            self.is_open = False
+        logger.info(f"Wrote {self.groups} duplicate groups ({self.rows} files) to {', '.join(self.paths)}")
+
+    def open_shard(self, path: str):
+        raise NotImplementedError
+
+    def write_rows(self, rows: List[Tuple]):
+        raise NotImplementedError
+
+    def close_shard(self):
+        raise NotImplementedError
+
+
+class CsvReportSink(ReportSink):
+    FORMAT = 'csv'
+
+    def open_shard(self, path: str):
+        self.file = self.open_text(path)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(REPORT_COLUMNS)
+
+    def write_rows(self, rows: List[Tuple]):
+        self.writer.writerows((key, path, size, format_modified_time(modified_time))
+                              for key, path, size, modified_time in rows)
+
+    def close_shard(self):
+        self.file.close()
+
+
+class JsonlReportSink(ReportSink):
+    FORMAT = 'jsonl'
+
+    def open_shard(self, path: str):
+        self.file = self.open_text(path)
+
+    def write_rows(self, rows: List[Tuple]):
+        self.file.writelines(json.dumps({'key': key, 'path': path, 'size': size,
+                                         'modified_time': format_modified_time(modified_time)},
+                                        ensure_ascii=False) + '\n'
+                             for key, path, size, modified_time in rows)
+
+    def close_shard(self):
+        self.file.close()
+
+
+class ParquetReportSink(ReportSink):
+    """ Parquet report - the modified time is stored as a timestamp. Requires pyarrow. """
+    FORMAT = 'parquet'
+
+    def __init__(self, path: str, compress: bool = False, shard_rows: int = None):
+        if pyarrow is None:
+            raise ImportError("Parquet reports require pyarrow - install it with 'pip install pyarrow'")
+        super().__init__(path, compress, shard_rows)
+        self.schema = pyarrow.schema([('key', pyarrow.int64()), ('path', pyarrow.string()),
+                                      ('size', pyarrow.int64()), ('modified_time', pyarrow.timestamp('us'))])
+        self.buffer: List[Tuple] = []
+
+    def open_shard(self, path: str):
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema,
+                                                    compression='gzip' if self.compress else 'snappy')
+
+    def write_rows(self, rows: List[Tuple]):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= PARQUET_BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        keys, paths, sizes, modified_times = zip(*self.buffer)
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(keys, pyarrow.int64()), pyarrow.array(paths, pyarrow.string()),
+             pyarrow.array(sizes, pyarrow.int64()),
+             pyarrow.array([datetime.fromtimestamp(modified_time) for modified_time in modified_times],
+                           pyarrow.timestamp('us'))], schema=self.schema))
+        self.buffer = []
+
+    def close_shard(self):
+        self.flush()
+        self.writer.close()
+
+
+REPORT_SINKS = {'csv': CsvReportSink, 'jsonl': JsonlReportSink, 'parquet': ParquetReportSink}
+
+
+def create_report_sink(report_format: str, path: str, compress: bool = False, shard_rows: int = None) -> ReportSink:
+    """
+    Create a report sink.
+    :param report_format: one of REPORT_FORMATS
+    :param path: path of the report, including its extension - see get_report_extension()
+    :param compress: compress the report with gzip
+    :param shard_rows: maximum number of rows in a file, or None to write a single file
+    :return: the report sink - use it as a context manager, or call close() when done
+    :raises: ImportError if the format needs a package that is not installed
+    """
+    if report_format not in REPORT_SINKS:
+        raise ValueError(f"Invalid report format: {report_format}")
+    return REPORT_SINKS[report_format](path, compress, shard_rows)
@@ -0,0 +1,151 @@
+import os
+import pickle
+import logging
+import time
+from collections import deque
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List
+
+from duplicate_files_in_folders.file_filter import FileFilter
+from duplicate_files_in_folders.file_manager import FileManager
+
+logger = logging.getLogger(__name__)
+
+
+class TreeSnapshot:
+    """
+    Manages a persisted snapshot of the reference folder tree: the modification time and subfolders of every folder,
+    and the file records found in it. Walking the tree with the snapshot only re-scans folders whose modification time
+    changed, and reuses the saved file records for all the other folders.
+    A folder's modification time changes when files are added, removed or renamed in it, but not when an existing
+    file is modified in place - use a full rescan if files in the reference folder are edited in place.
+    """
+    _instance = None
+    _lock = Lock()
+
+    SNAPSHOT_VERSION = 2  # Saved snapshots with a different version are ignored
+    RACY_WINDOW = 2  # in seconds - folders modified that close to the scan are re-scanned on the next run
+
+    def __new__(cls, *args, **kwargs):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance.__initialized = False
+        return cls._instance
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            raise Exception("TreeSnapshot has not been initialized. Please initialize it first.")
+        return cls._instance
+
+    @classmethod
+    def is_initialized(cls) -> bool:
+        return cls._instance is not None
+
+    @classmethod
+    def reset_instance(cls):
+        with cls._lock:
+            cls._instance = None
+
+    def __init__(self, reference_dir: str = None, filename='ref_snapshot.pkl'):
+        if self.__initialized:
+            return
+        self.__initialized = True
+
+        self.filename = filename
+        self.reference_dir = FileManager.get_walk_root(reference_dir) if reference_dir else None
+        self.directories = self.load_data()
+
+        # statistics of the last walk
+        self.rescanned_dirs = 0
+        self.reused_dirs = 0
+
+    def load_data(self) -> Dict[str, Dict]:
+        """Load the snapshot of the reference folder from the file, or return an empty snapshot if there is none."""
+        if self.filename is None or not os.path.exists(self.filename):  # filename is None for testing purposes
+            return {}
+        try:
+            with open(self.filename, 'rb') as f:
+                all_data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning(f"Could not load the folder snapshot from {self.filename}: {e}")
+            return {}
+        if all_data.get('version') != self.SNAPSHOT_VERSION:
+            logger.info(f"Ignoring folder snapshot {self.filename} saved by a different version")
+            return {}
+        return all_data['trees'].get(self.reference_dir, {})
+
+    def save_data(self) -> None:
+        """Save the snapshot of the reference folder, keeping the snapshots of other reference folders in the file."""
+        if self.filename is None or self.reference_dir is None:  # for testing purposes
+            return
+        all_data = {'version': self.SNAPSHOT_VERSION, 'trees': {}}
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'rb') as f:
+                    saved_data = pickle.load(f)
+                if saved_data.get('version') == self.SNAPSHOT_VERSION:
+                    all_data = saved_data
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+        all_data['trees'][self.reference_dir] = self.directories
+        with open(self.filename, 'wb') as f:
+            pickle.dump(all_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get_files_and_stats(self, directory: str | Path, full_rescan: bool = False,
+                            raise_on_permission_error: bool = False, file_filter: FileFilter = None) -> List[Dict]:
+        """
+        Get file information for all files in a directory and its subdirectories, re-scanning only the folders that
+        changed since the snapshot was taken. The snapshot is updated with the result.
+        :param directory: path to the directory
+        :param full_rescan: if True, ignore the saved snapshot and scan all the folders
+        :param raise_on_permission_error: if True, raise a PermissionError if a directory cannot be accessed
+        :param file_filter: if given, only files accepted by the filter are returned and excluded folders are not
+                            walked. The file filters are not pushed down into the walk: every file of the walked
+                            folders is stat-ed and kept in the snapshot, so it can be reused with other filters.
+        :return: list of dictionaries with file information, in the same format as FileManager.get_files_and_stats()
+        :raises: PermissionError if a directory cannot be accessed and raise_on_permission_error is True
+        """
+        directory = FileManager.get_walk_root(directory)  # the same paths as the walks of the FileManager
+        previous = {} if full_rescan else self.directories
+        current = {}
+        files_stats = []
+        racy_time_ns = (time.time() - self.RACY_WINDOW) * 1e9
+        self.rescanned_dirs = self.reused_dirs = 0
+
+        queue = deque([directory])
+        while queue:
+            current_dir = queue.popleft()
+            try:
+                mtime = os.stat(current_dir).st_mtime_ns  # taken before scanning, so later changes are detected
+                record = previous.get(current_dir)
+                if record is None or record['mtime'] is None or record['mtime'] != mtime:
+                    files = []
+                    subdirs = FileManager._scan_directory(current_dir, files)
+                    # don't trust a modification time that is too recent, the folder may still change within the
+                    # same timestamp tick
+                    record = {'mtime': mtime if mtime < racy_time_ns else None, 'subdirs': subdirs, 'files': files}
+                    self.rescanned_dirs += 1
+                else:
+                    self.reused_dirs += 1
+            except PermissionError:
+                if raise_on_permission_error:
+                    raise
+                continue
+            current[current_dir] = record
+            if file_filter is None:
+                files_stats.extend(record['files'])
+            else:
+                files_stats.extend(file_info for file_info in record['files'] if file_filter.accepts(file_info))
+            if file_filter is None:
+                queue.extend(record['subdirs'])
+            else:  # excluded subtrees are not walked, and are dropped from the snapshot
+                queue.extend(subdir for subdir in record['subdirs']
+                             if file_filter.accepts_dir(os.path.basename(subdir)))
+
+        self.directories = current
+        logger.info(f"Folder snapshot of {directory}: {self.rescanned_dirs} folders scanned, "
+                    f"{self.reused_dirs} folders reused")
+        return files_stats
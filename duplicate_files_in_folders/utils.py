@@ -1,11 +1,19 @@
 import argparse
 import logging
 import os
+import re
 import time
 from argparse import Namespace
+from datetime import datetime
+from pathlib import Path
 
+from duplicate_files_in_folders.action_plan import ActionPlanError, read_action_plan_header
 from duplicate_files_in_folders.file_manager import FileManager
 from duplicate_files_in_folders.hash_manager import HashManager
+from duplicate_files_in_folders.job_state import JobState, JobStateError
+from duplicate_files_in_folders.memory_governor import get_rss
+from duplicate_files_in_folders.reference_manifest import read_manifest_header
+from duplicate_files_in_folders.report_writer import REPORT_FORMATS, is_parquet_available
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +48,45 @@ def parse_size(size_str: str | int) -> int:
     return int_value
 
 
+def parse_time_limit(time_str: str) -> float:
+    """
+    Parse a point in time given as a date, a date and time, or an age relative to now with units (m, h, d, w).
+    Examples: '2024-01-31', '2024-01-31T12:00', '30d' (30 days ago), '12h' (12 hours ago).
+    :param time_str: the time string
+    :return: the point in time as a timestamp
+    :raises ValueError: if the time string is invalid
+    """
+    units = {"M": 60, "H": 60 * 60, "D": 24 * 60 * 60, "W": 7 * 24 * 60 * 60}
+    time_str = time_str.strip()
+    unit = time_str[-1:].upper()
+    if unit in units and time_str[:-1].isdigit():
+        return time.time() - int(time_str[:-1]) * units[unit]
+    try:
+        return datetime.fromisoformat(time_str).timestamp()
+    except ValueError:
+        raise ValueError("Invalid time format - use a date (YYYY-MM-DD[THH:MM]) or an age (e.g. 30d, 12h)")
+
+
+def parse_duration(duration_str: str) -> float:
+    """
+    Parse a duration with units (s, m, h) to seconds. A number without a unit is in seconds.
+    Examples: '90', '45m', '2h'.
+    :param duration_str: the duration string
+    :return: the duration in seconds
+    :raises ValueError: if the duration string is invalid or not positive
+    """
+    units = {"S": 1, "M": 60, "H": 60 * 60}
+    duration_str = duration_str.strip().upper()
+    multiplier = units.get(duration_str[-1:], None)
+    try:
+        value = float(duration_str[:-1] if multiplier else duration_str) * (multiplier or 1)
+    except ValueError:
+        raise ValueError("Invalid duration format - use seconds or units (e.g. 90, 45m, 2h)")
+    if value <= 0:
+        raise ValueError("Duration must be positive")
+    return value
+
+
 def initialize_arguments():
     """
     Initialize and return the argument parser.
@@ -63,25 +110,116 @@ def initialize_arguments():
                                                      '(B, KB, MB).', default=None)
     parser.add_argument('--max_size', type=str, help='Maximum file size to check. Specify with units '
                                                      '(B, KB, MB).', default=None)
+    parser.add_argument('--exclude_dir', type=str,
+                        help='Comma-separated list of folder name patterns to skip, e.g. .git,node_modules,@eaDir. '
+                             'Excluded folders are not walked at all.')
+    parser.add_argument('--exclude_dir_regex', type=str,
+                        help='Regular expression - skip folders whose name matches it.')
+    parser.add_argument('--include', type=str,
+                        help='Comma-separated list of file name patterns to check, e.g. IMG_*,*.raw. '
+                             'Only matching files will be checked.')
+    parser.add_argument('--include_regex', type=str,
+                        help='Regular expression - only files whose name matches it will be checked.')
+    parser.add_argument('--modified_after', type=str,
+                        help='Only check files modified after this date (YYYY-MM-DD[THH:MM]) or age (e.g. 30d, 12h).')
+    parser.add_argument('--modified_before', type=str,
+                        help='Only check files modified before this date (YYYY-MM-DD[THH:MM]) or age (e.g. 30d, 12h).')
     parser.add_argument('--keep_empty_folders', dest='delete_empty_folders', action='store_false',
                         help='Do not delete empty folders in the scan_dir folder. Default is to delete.')
+    parser.add_argument('--full_cleanup', action='store_true',
+                        help='Delete all the empty folders in the scan_dir folder, by walking all of it. Default is to '
+                             'check only the folders files were moved out of, and their parents.')
     parser.add_argument('--full_hash', action='store_true',
                         help='Use full file hash for comparison. Default is partial.')
     parser.add_argument('--keep_structure', action='store_true',
                         help='Keep the original scan folder structure in the destination folder.')
+    parser.add_argument('--walk_workers', type=int, default=1,
+                        help='Number of threads used to walk the scan and reference folders concurrently. '
+                             'Useful on network drives and slow disks. Default is 1 (single-threaded walk).')
+    parser.add_argument('--move_workers', type=int, default=4,
+                        help='Maximum number of threads that move or copy files to another device. Moves on the same '
+                             'device are renames and run one after the other. Default is 4.')
+    parser.add_argument('--batch_files', type=int, default=20000,
+                        help='Number of candidate files hashed in each batch. Duplicates are found batch by batch, '
+                             'from the smallest files to the largest, and files are moved or reported while the next '
+                             'batch is hashed. Default is 20000.')
+    parser.add_argument('--overlap', action='store_true',
+                        help='Walk the scan and reference folders at the same time, and hash the scan files that have '
+                             'a possible match while still walking. Faster on large folders, but the reference '
+                             'folder files are kept in memory until the walk ends.')
+    parser.add_argument('--job', type=str,
+                        help='Folder to save the state of a long job in - the candidates found by the walk, the '
+                             'batches done and a journal of the files moved - so it can be resumed with --resume.')
+    parser.add_argument('--resume', type=str,
+                        help='Resume the job saved in this folder by --job. Use the same arguments as the job.')
+    parser.add_argument('--max_memory', type=str,
+                        help='Memory budget, with units (MB, GB). When the memory of the process gets near it, the '
+                             'candidate files are spilled to a temporary SQLite database and read back group by group. '
+                             'Default is no limit.')
+    parser.add_argument('--max_runtime', type=str,
+                        help='Time budget of the run, e.g. 45m or 2h. The most valuable batches - the candidates that '
+                             'may reclaim the most bytes - are hashed first, and the run stops cleanly before a batch '
+                             'that would not finish in time. Use with --job to continue in the next run.')
+    parser.add_argument('--max_bytes_read', type=str,
+                        help='Read budget of the run, with units (B, KB, MB, GB). Like --max_runtime, for the bytes '
+                             'read to hash the files.')
+    parser.add_argument('--save_plan', type=str,
+                        help='Path - file to write the action plan of a test run of move_duplicates to - the files it '
+                             'would move or copy, with their size, modified time and hash. See --apply_plan.')
+    parser.add_argument('--apply_plan', type=str,
+                        help='Path - action plan written by --save_plan. Execute its operations '
+                             'without finding the duplicates again - files that changed since are skipped.')
+    parser.add_argument('--undo_plan', type=str,
+                        help='Path - action plan applied by --apply_plan. Move the files back to the scan folder and '
+                             'delete the copies.')
+    parser.add_argument('--metrics_json', type=str,
+                        help='Path - file to write the metrics of each stage of the run to, as JSON - wall and CPU '
+                             'time, bytes read, files opened, system calls, cache hit ratio and peak memory. A summary '
+                             'table is printed at the end of the run.')
+    parser.add_argument('--profile', type=str,
+                        help='Path - folder to write a profile of each stage of the run to - cProfile pstats files '
+                             'and collapsed stacks for flamegraph tools. Created if it does not exist.')
+    parser.add_argument('--profile_memory', action='store_true',
+                        help='With --profile, trace the memory allocations of each stage with tracemalloc too.')
+    parser.add_argument('--ref_snapshot', action='store_true',
+                        help='Save a snapshot of the reference folder, and only rescan the folders that changed since '
+                             'the last run. The snapshot of the whole reference folder is kept in memory.')
+    parser.add_argument('--full_rescan', action='store_true',
+                        help='With --ref_snapshot, rescan the whole reference folder instead of only the folders that '
+                             'changed since the last run.')
     parser.set_defaults(delete_empty_folders=True)
     parser.add_argument('--clear_cache', action='store_true', help=argparse.SUPPRESS)  # for testing
     parser.add_argument('--extra_logging', action='store_true', help=argparse.SUPPRESS)  # for testing
 
-    parser.add_argument('--action', type=str, choices=['move_duplicates', 'create_csv'],
-                        help='Action to perform: move_duplicates, create_csv', default='move_duplicates')
+    parser.add_argument('--action', type=str,
+                        choices=['move_duplicates', 'create_csv', 'export_manifest', 'link_duplicates'],
+                        help='Action to perform: move_duplicates, create_csv, export_manifest, link_duplicates',
+                        default='move_duplicates')
+    parser.add_argument('--report_format', type=str, choices=REPORT_FORMATS, default='csv',
+                        help='Format of the create_csv report: csv, jsonl or parquet (requires pyarrow). '
+                             'Default is csv.')
+    parser.add_argument('--report_gzip', action='store_true', help='Compress the create_csv report with gzip.')
+    parser.add_argument('--report_shard_rows', type=int,
+                        help='Split the create_csv report into files of about this many rows. Groups of duplicates '
+                             'are never split. Default is a single file.')
+    parser.add_argument('--link_type', type=str, choices=FileManager.LINK_TYPES, default='auto',
+                        help='Link type of the link_duplicates action: reflink, hardlink or auto - a reflink if the '
+                             'filesystem supports it, else a hardlink. Default is auto.')
 
-    parser.add_argument('--scan_dir', '--scan', '--s', dest='scan_dir', required=True,
+    # scan_dir, reference_dir and move_to are required - validate_arguments() checks them according to the action
+    parser.add_argument('--scan_dir', '--scan', '--s', dest='scan_dir',
                         help='Path - folder to scan for duplicates.')
-    parser.add_argument('--reference_dir', '--reference', '--r', required=True,
+    parser.add_argument('--reference_dir', '--reference', '--r',
                         help='Path - folder to compare with scan_dir.')
-    parser.add_argument('--move_to', '--to', required=True, type=str,
+    parser.add_argument('--move_to', '--to', type=str,
                         help='Path - duplicate files from scan_dir will be moved to this folder.')
+    parser.add_argument('--reference_manifest', type=str,
+                        help='Path - manifest file created by the export_manifest action. Used instead of reading '
+                             'the reference folder.')
+    parser.add_argument('--reference_checksums', type=str,
+                        help='Path - checksum file of the reference folder, created by sha256sum, md5sum, md5deep, '
+                             'hashdeep or similar tools. Only the listed files are used as reference, and their '
+                             'checksums are used instead of reading them.')
     return parser
 
 
@@ -92,16 +230,52 @@ def validate_arguments(args, parser, check_folders=True):
     :param parser: the argument parser
     :param check_folders: for testing - if False, skip folder validation
     """
+    # Validate the required arguments - the scan folder is not needed to export a reference manifest, and the
+    # reference folder is taken from the manifest if one is given
+    if args.action == 'export_manifest' and (args.reference_manifest or args.reference_checksums):
+        parser.error("--reference_manifest and --reference_checksums cannot be used with the export_manifest action.")
+    if args.reference_manifest and args.reference_checksums:
+        parser.error("You cannot specify both --reference_manifest and --reference_checksums at the same time.")
+    if args.action == 'link_duplicates' and args.reference_manifest:
+        parser.error("--reference_manifest cannot be used with the link_duplicates action - the reference files "
+                     "must be available to link to.")
+    if args.reference_checksums:
+        if check_folders and not os.path.isfile(args.reference_checksums):
+            parser.error("Reference checksums file does not exist.")
+        if not args.reference_dir:  # paths in checksum files are usually relative to the folder of the file
+            args.reference_dir = os.path.dirname(os.path.abspath(args.reference_checksums))
+    if args.reference_manifest:
+        if check_folders and not os.path.isfile(args.reference_manifest):
+            parser.error("Reference manifest file does not exist.")
+        if not args.reference_dir:
+            try:
+                args.reference_dir = read_manifest_header(args.reference_manifest)['root']
+            except ValueError as e:
+                parser.error(str(e))
+    required_arguments = [(args.reference_dir, "--reference_dir")]
+    if args.action != 'link_duplicates':  # duplicates are replaced by links in place
+        required_arguments.append((args.move_to, "--move_to"))
+    if args.action != 'export_manifest':
+        required_arguments.insert(0, (args.scan_dir, "--scan_dir"))
+    for value, name in required_arguments:
+        if not value:
+            parser.error(f"the following argument is required: {name}")
+
     # Validate the folders given in the arguments
     if check_folders:
-        folders = [(args.scan_dir, "Scan Folder"), (args.reference_dir, "Reference Folder")]
+        folders = []
+        if args.action != 'export_manifest':
+            folders.append((args.scan_dir, "Scan Folder"))
+        if not args.reference_manifest:
+            folders.append((args.reference_dir, "Reference Folder"))
         for folder, name in folders:
             if not os.path.exists(folder) or not os.path.isdir(folder):
                 parser.error(f"{name} folder does not exist.")
-            if not os.listdir(folder):
+            if not os.listdir(folder) and not args.undo_plan:  # undo moves the files back to an empty scan folder
                 parser.error(f"{name} folder is empty.")
 
-    is_subfolder, relationships = FileManager.any_is_subfolder_of([args.scan_dir, args.reference_dir, args.move_to])
+    is_subfolder, relationships = FileManager.any_is_subfolder_of(
+        [folder for folder in [args.scan_dir, args.reference_dir, args.move_to] if folder])
     if is_subfolder:
         for subfolder, parent in relationships:
             if subfolder != parent:
@@ -128,6 +302,117 @@ def validate_arguments(args, parser, check_folders=True):
     if args.whitelist_ext and args.blacklist_ext:
         parser.error("You cannot specify both --whitelist_ext and --blacklist_ext at the same time.")
 
+    # Convert the folder and file name patterns to lists and validate the regular expressions
+    args.exclude_dir = str(args.exclude_dir).split(',') if args.exclude_dir else None
+    args.include = str(args.include).split(',') if args.include else None
+    for regex_arg in ['exclude_dir_regex', 'include_regex']:
+        try:
+            if getattr(args, regex_arg):
+                re.compile(getattr(args, regex_arg))
+        except re.error as e:
+            parser.error(f"Invalid regular expression for --{regex_arg}: {e}")
+
+    # Validate the modified time window
+    for time_arg in ['modified_after', 'modified_before']:
+        setattr(args, f'{time_arg}_arg', getattr(args, time_arg))  # as given - a job compares it, see JobState
+        if getattr(args, time_arg):
+            try:
+                setattr(args, time_arg, parse_time_limit(getattr(args, time_arg)))
+            except ValueError as e:
+                parser.error(f"Invalid value for --{time_arg}: {e}")
+    if args.modified_after and args.modified_before and args.modified_after > args.modified_before:
+        parser.error("--modified_after must be earlier than --modified_before.")
+
+    if args.walk_workers < 1:
+        parser.error("Invalid value for --walk_workers: must be at least 1.")
+    if args.report_shard_rows is not None and args.report_shard_rows < 1:
+        parser.error("Invalid value for --report_shard_rows: must be at least 1.")
+    if args.report_format == 'parquet' and not is_parquet_available():
+        parser.error("--report_format parquet requires pyarrow - install it with 'pip install pyarrow'.")
+    if args.overlap and args.reference_checksums:
+        parser.error("--overlap can't be used with --reference_checksums - the files are compared by their checksums.")
+    if args.job and args.resume:
+        parser.error("--job and --resume can't be used together.")
+    if (args.job or args.resume) and args.action == 'export_manifest':
+        parser.error("--job and --resume can't be used with export_manifest.")
+    if args.resume and not os.path.isfile(os.path.join(args.resume, 'job.json')):
+        parser.error(f"No job to resume in {args.resume}.")
+    if args.job and os.path.isfile(os.path.join(args.job, 'job.json')):
+        parser.error(f"A job already exists in {args.job} - use --resume to resume it.")
+    if args.save_plan:
+        if args.run or args.action != 'move_duplicates':
+            parser.error("--save_plan can only be used in a test run of the move_duplicates action.")
+        if args.apply_plan or args.undo_plan:
+            parser.error("--save_plan can't be used with --apply_plan or --undo_plan.")
+        validate_output_file(args, parser, '--save_plan', args.save_plan, check_folders)
+    if args.metrics_json:
+        validate_output_file(args, parser, '--metrics_json', args.metrics_json, check_folders)
+    if args.profile:
+        profile_dir = Path(args.profile).resolve()
+        if check_folders and not profile_dir.parent.is_dir():
+            parser.error("The parent folder of the --profile folder does not exist.")
+        if any(folder and Path(folder).resolve() in [profile_dir, *profile_dir.parents]
+               for folder in [args.scan_dir, args.reference_dir]):
+            parser.error("The --profile folder can't be in the scan or reference folders.")
+    if args.profile_memory and not args.profile:
+        parser.error("--profile_memory can only be used with --profile.")
+    if args.apply_plan and args.undo_plan:
+        parser.error("--apply_plan and --undo_plan can't be used together.")
+    plan_file = args.apply_plan or args.undo_plan
+    if plan_file:
+        if args.action != 'move_duplicates':
+            parser.error("--apply_plan and --undo_plan can only be used with the move_duplicates action.")
+        if args.job or args.resume:
+            parser.error("--apply_plan and --undo_plan can't be used with --job or --resume.")
+        if check_folders:
+            if not os.path.isfile(plan_file):
+                parser.error("Action plan file does not exist.")
+            try:
+                header = read_action_plan_header(plan_file)
+            except ActionPlanError as e:
+                parser.error(str(e))
+            if header['scan_dir'] != os.path.abspath(args.scan_dir) or \
+                    header['move_to'] != os.path.abspath(args.move_to):
+                parser.error("The action plan was made for other folders - use the same --scan_dir and --move_to.")
+    if args.batch_files < 1:
+        parser.error("Invalid value for --batch_files: must be at least 1.")
+    if args.move_workers < 1:
+        parser.error("Invalid value for --move_workers: must be at least 1.")
+
+    if args.full_rescan and not args.ref_snapshot:
+        parser.error("--full_rescan can only be used with --ref_snapshot.")
+
+    # Validate the budgets
+    if args.max_runtime is not None:
+        try:
+            args.max_runtime = parse_duration(args.max_runtime)
+        except ValueError as e:
+            parser.error(f"Invalid value for --max_runtime: {e}")
+    if args.max_bytes_read is not None:
+        try:
+            args.max_bytes_read = parse_size(args.max_bytes_read)
+        except ValueError as e:
+            parser.error(f"Invalid value for --max_bytes_read: {e}")
+    if args.max_memory is not None:
+        try:
+            args.max_memory = parse_size(args.max_memory)
+        except ValueError as e:
+            parser.error(f"Invalid value for --max_memory: {e}")
+        if args.overlap:
+            parser.error("--max_memory can't be used with --overlap - the overlapped walk keeps both folders in "
+                         "memory.")
+        if args.job or args.resume:
+            parser.error("--max_memory can't be used with --job or --resume - spilled candidates are not saved.")
+        if get_rss() is None:
+            logger.warning("--max_memory is ignored - the current memory of the process can't be read on this "
+                           "platform. Install psutil to use it.")
+            args.max_memory = None
+    if (args.max_runtime is not None or args.max_bytes_read is not None) and (args.apply_plan or args.undo_plan):
+        parser.error("--max_runtime and --max_bytes_read can't be used with --apply_plan or --undo_plan.")
+    if (args.max_runtime is not None or args.max_bytes_read is not None) and args.overlap:
+        parser.error("--max_runtime and --max_bytes_read can't be used with --overlap - the overlapped walk hashes "
+                     "files before the batches are checked against the budget.")
+
     # Validate the size constraints
     if args.min_size:
         try:
@@ -142,6 +427,26 @@ def validate_arguments(args, parser, check_folders=True):
     if args.min_size and args.max_size and args.min_size > args.max_size:
         parser.error("Minimum size must be less than maximum size.")
 
+    # A job is resumed with the arguments it was started with - checked once all of them are parsed
+    if args.resume and check_folders:
+        try:
+            JobState.check_job(args.resume, JobState.get_job_args(args))
+        except JobStateError as e:
+            parser.error(str(e))
+
+
+def validate_output_file(args, parser, option: str, file_path: str, check_folders=True):
+    """
+    Validate the path of a file written by the run, e.g. --save_plan - its folder must exist, and it can't be in the
+    scan or reference folders, where the next run would find it.
+    """
+    file_dir = Path(file_path).resolve().parent
+    if check_folders and not file_dir.is_dir():
+        parser.error(f"The folder of the {option} file does not exist.")
+    if any(folder and Path(folder).resolve() in [file_dir, *file_dir.parents]
+           for folder in [args.scan_dir, args.reference_dir]):
+        parser.error(f"The {option} file can't be in the scan or reference folders.")
+
 
 def parse_arguments(cust_args=None, check_folders=True):
     """
@@ -156,6 +461,27 @@ def parse_arguments(cust_args=None, check_folders=True):
     return args
 
 
+def get_destination_path(scan_file_path: str, destination_base_path: str, ref_file_path: str, base_ref_path: str,
+                         keep_structure: bool = False, scan_base_path: str = None) -> str:
+    """
+    Get the path a scan file is copied or moved to - the path of the reference file, or of the scan file if
+    keep_structure is True, relative to the destination directory.
+    :param scan_file_path: Full path of the file we want to copy/move
+    :param destination_base_path: The base path where the file should be copied or moved to.
+    :param ref_file_path: The full path to the reference file within the base reference directory.
+    :param base_ref_path: The base directory path of the reference files.
+    :param keep_structure: True to keep the original scan folder structure in the destination folder, False otherwise
+    :param scan_base_path: The base path of the scan directory. Required if keep_structure is True.
+    :return: the destination path, before renaming it if it exists
+    """
+    if keep_structure:
+        if scan_base_path is None:
+            raise ValueError("scan_base_path must be provided if keep_structure is True.")
+        sub_path = os.path.relpath(scan_file_path, scan_base_path)
+        return os.path.join(destination_base_path, sub_path)
+    return os.path.join(destination_base_path, os.path.relpath(ref_file_path, base_ref_path))
+
+
 def copy_or_move_file(scan_file_path: str, destination_base_path: str, ref_file_path: str, base_ref_path: str,
                       move: bool = True, keep_structure: bool = False, scan_base_path: str = None) -> str:
     """
@@ -171,13 +497,8 @@ def copy_or_move_file(scan_file_path: str, destination_base_path: str, ref_file_
     :param keep_structure: True to keep the original scan folder structure in the destination folder, False otherwise
     :return: the final destination path
     """
-    if keep_structure:
-        if scan_base_path is None:
-            raise ValueError("scan_base_path must be provided if keep_structure is True.")
-        sub_path = os.path.relpath(scan_file_path, scan_base_path)
-        destination_path = os.path.join(destination_base_path, sub_path)
-    else:
-        destination_path = os.path.join(destination_base_path, os.path.relpath(ref_file_path, base_ref_path))
+    destination_path = get_destination_path(scan_file_path, destination_base_path, ref_file_path, base_ref_path,
+                                            keep_structure, scan_base_path)
     logger.debug(f"Copying {scan_file_path} to {destination_path}")
     destination_dir = os.path.dirname(destination_path)
     file_manager = FileManager.get_instance()
@@ -217,15 +538,46 @@ def check_and_update_filename(original_filename: str, renaming_function=None) ->
     return new_filename
 
 
-def get_file_key(args: Namespace, file_path: str) -> str:
+def get_file_key(args: Namespace, file_path: str, hardlink_id: tuple = None) -> str:
     """
     Generate a unique key for the file based on hash, filename, and modified date. Ignores components based on args.
     Example: 'hash_key_filename_mdate' or 'hash_key_mdate' or 'hash_key_filename' or 'hash_key'
     :param args: the parsed arguments
     :param file_path: the full path of the file
+    :param hardlink_id: the hardlink id of the file, if known - hardlinks of the same file are hashed only once
     :return: the unique key for the file
     """
-    hash_key: str = HashManager.get_instance().get_hash(file_path)
+    hash_key: str = HashManager.get_instance().get_hash(file_path, hardlink_id)
     file_key: str = file_path[file_path.rfind(os.sep) + 1:] if 'filename' not in args.ignore_diff else None
     mdate_key: str = str(os.path.getmtime(file_path)) if 'mdate' not in args.ignore_diff else None
     return '_'.join(filter(None, [hash_key, file_key, mdate_key]))
+
+
+def get_file_key_from_manifest(args: Namespace, file_info: dict) -> str:
+    """
+    Generate the unique key of a file loaded from a reference manifest, without accessing the file itself.
+    The key is the same as the one get_file_key() generates for the file.
+    :param args: the parsed arguments
+    :param file_info: the file information loaded from the manifest
+    :return: the unique key for the file
+    """
+    hash_key: str = file_info['full_hash'] if HashManager.get_instance().full_hash else file_info['partial_hash']
+    file_key: str = file_info['name'] if 'filename' not in args.ignore_diff else None
+    mdate_key: str = str(file_info['modified_time']) if 'mdate' not in args.ignore_diff else None
+    return '_'.join(filter(None, [hash_key, file_key, mdate_key]))
+
+
+def get_file_key_by_checksum(args: Namespace, file_info: dict, algorithm: str, checksum: str = None) -> str:
+    """
+    Generate the unique key of a file based on its full content checksum with the given algorithm, to compare files
+    with a reference checksum file. The checksum loaded from the checksum file is used if the file has one.
+    :param args: the parsed arguments
+    :param file_info: the file information
+    :param algorithm: the checksum algorithm - md5, sha1 or sha256
+    :param checksum: the checksum of the file, if it is already known - e.g. computed for a hardlink of it
+    :return: the unique key for the file
+    """
+    hash_key: str = checksum or file_info.get('checksum') or HashManager.compute_checksum(file_info['path'], algorithm)
+    file_key: str = file_info['name'] if 'filename' not in args.ignore_diff else None
+    mdate_key: str = str(file_info['modified_time']) if 'mdate' not in args.ignore_diff else None
+    return '_'.join(filter(None, [hash_key, file_key, mdate_key]))
@@ -1,9 +1,16 @@
 import logging
+import os
 import sys
 from argparse import Namespace
+from datetime import datetime
 
 from duplicate_files_in_folders.duplicates_finder import get_csv_file_path
+from duplicate_files_in_folders.file_manager import FileManager
 from duplicate_files_in_folders.hash_manager import HashManager
+from duplicate_files_in_folders.hashing_planner import is_budgeted
+from duplicate_files_in_folders.metrics import MetricsCollector
+from duplicate_files_in_folders.profiler import RunProfiler
+from duplicate_files_in_folders.reference_manifest import get_manifest_file_path
 from duplicate_files_in_folders.utils import detect_pytest
 
 logger = logging.getLogger(__name__)
@@ -23,27 +30,64 @@ def display_initial_config(args: Namespace):
     fixed_width = 25
 
     config_items = {
-        "Scan Folder": args.scan_dir,
+        "Scan Folder": args.scan_dir if args.scan_dir else "N/A",
         "Reference Folder": args.reference_dir,
-        "\"Move to\" Folder": args.move_to,
+        "\"Move to\" Folder": args.move_to if args.move_to else "N/A",
         "Ignoring Settings": get_ignore_diff_string(args.ignore_diff),
-        "Files Content": "Full Content Check (Slower)" if args.full_hash else "Partial Content Check (Faster)",
+        "Files Content": "Full Content Check (Checksums File)" if args.reference_checksums else
+                         "Full Content Check (Slower)" if args.full_hash else "Partial Content Check (Faster)",
         "Size Constraints": get_size_constraints_string(min_size=args.min_size, max_size=args.max_size),
     }
+    if args.reference_manifest:
+        config_items["Reference Manifest"] = args.reference_manifest
+    if args.reference_checksums:
+        config_items["Reference Checksums"] = args.reference_checksums
     # args.whitelist_ext is a set
     if args.whitelist_ext:
         config_items["File Types (Whitelist)"] = ', '.join(args.whitelist_ext)
     elif args.blacklist_ext:
         config_items["File Types (Blacklist)"] = ', '.join(args.blacklist_ext)
 
+    if args.exclude_dir or args.exclude_dir_regex:
+        config_items["Excluded Folders"] = ', '.join(filter(None, [', '.join(args.exclude_dir or []),
+                                                                   args.exclude_dir_regex]))
+    if args.include or args.include_regex:
+        config_items["Included Files"] = ', '.join(filter(None, [', '.join(args.include or []), args.include_regex]))
+    if args.modified_after or args.modified_before:
+        config_items["Modified Time"] = get_modified_time_constraints_string(args.modified_after,
+                                                                             args.modified_before)
+
     if not args.delete_empty_folders:
         config_items["Empty Folders"] = "Do not delete empty folders in Scan folder"
 
     if args.copy_to_all:
         config_items["Additional Settings"] = "Copy duplicate files to all folders"
+    if args.job:
+        config_items["Job"] = f"{args.job} (new job)"
+    elif args.resume:
+        config_items["Job"] = f"{args.resume} (resumed)"
+    if args.save_plan:
+        config_items["Action Plan"] = f"{args.save_plan} (save)"
+    elif args.apply_plan:
+        config_items["Action Plan"] = f"{args.apply_plan} (apply)"
+    elif args.undo_plan:
+        config_items["Action Plan"] = f"{args.undo_plan} (undo)"
+    if args.max_memory:
+        config_items["Memory Budget"] = f"{args.max_memory:,} bytes - spill candidates to disk near it"
+    if is_budgeted(args):
+        config_items["Budget"] = ', '.join(filter(None, [
+            f"{args.max_runtime:,.0f} seconds" if args.max_runtime is not None else None,
+            f"{args.max_bytes_read:,} bytes read" if args.max_bytes_read is not None else None]))
+    if args.metrics_json:
+        config_items["Metrics"] = args.metrics_json
+    if args.profile:
+        config_items["Profile"] = args.profile + (" (with memory allocations)" if args.profile_memory else "")
 
     config_items["Script Mode"] = (
         "Create CSV File" if args.action == 'create_csv' else
+        "Export Reference Manifest" if args.action == 'export_manifest' else
+        f"Link Duplicates ({args.link_type}), " + ("Run Mode" if args.run else "Test Mode")
+        if args.action == 'link_duplicates' else
         "Run Mode" if args.run else
         "Test Mode"
     )
@@ -88,6 +132,14 @@ def format_number_with_commas(number: int) -> str:
     return f"{number:,}"
 
 
+def get_modified_time_constraints_string(modified_after=None, modified_before=None) -> str:
+    """ Get the modified time window as a string. """
+    return ', '.join(filter(None, [
+        f"After {datetime.fromtimestamp(modified_after):%Y-%m-%d %H:%M}" if modified_after else None,
+        f"Before {datetime.fromtimestamp(modified_before):%Y-%m-%d %H:%M}" if modified_before else None
+    ]))
+
+
 def get_size_constraints_string(min_size=None, max_size=None) -> str:
     """ Get the size constraints string."""
     size_constraints = [
@@ -98,8 +150,31 @@ def get_size_constraints_string(min_size=None, max_size=None) -> str:
     return f"{', '.join(size_constraints)}." if size_constraints else "No Size Constraints"
 
 
+def get_coverage_string(args: Namespace, counts: dict) -> str | None:
+    """
+    Get the coverage of a run with a budget (--max_runtime, --max_bytes_read) - the share of the candidate files,
+    and of the bytes they may reclaim, that were hashed. Batches done by a previous run of a job are covered.
+    :param args: The parsed arguments
+    :param counts: The counts of the finder - see iter_duplicate_batches()
+    :return: the coverage string, or None if the run has no budget
+    """
+    if not is_budgeted(args):
+        return None
+    candidates = counts.get('scan_candidates', 0) + counts.get('ref_candidates', 0)
+    candidate_bytes = counts.get('candidate_bytes', 0)
+    covered = candidates - counts.get('deferred_candidates', 0)
+    covered_bytes = candidate_bytes - counts.get('deferred_bytes', 0)
+    coverage = (f"{format_number_with_commas(covered)} of {format_number_with_commas(candidates)} candidates "
+                f"({covered / candidates if candidates else 1:.0%}), "
+                f"{covered_bytes / candidate_bytes if candidate_bytes else 1:.0%} of the bytes to reclaim")
+    if counts.get('deferred_batches'):
+        coverage += f" - {counts['deferred_batches']} batches deferred, the budget is spent"
+    return coverage
+
+
 def output_results(args: Namespace, files_moved: int, files_created: int, deleted_scan_folders: int,
-                   duplicate_scan_files_moved: int, scan_stats=None, ref_stats=None):
+                   duplicate_scan_files_moved: int, scan_files: int = None, ref_files: int = None,
+                   plan_file: str = None, coverage: str = None):
     """
     Output the results of the script execution.
     :param args: The parsed arguments
@@ -107,51 +182,162 @@ def output_results(args: Namespace, files_moved: int, files_created: int, delete
     :param files_created: Number of files created
     :param deleted_scan_folders: Number of empty folders deleted
     :param duplicate_scan_files_moved: Number of duplicate files moved from the scan folder
-    :param scan_stats: Output of get_files_and_stats() for the scan folder
-    :param ref_stats: Output of get_files_and_stats() for the reference folder
+    :param scan_files: Number of files in the scan folder
+    :param ref_files: Number of files in the reference folder
+    :param plan_file: The action plan written by the test run, if any
+    :param coverage: The coverage of a run with a budget - see get_coverage_string()
     :return: None
     """
     summary_header = "Summary (Test Mode):" if not args.run else "Summary:"
 
-    files_left = len(scan_stats) - files_moved - duplicate_scan_files_moved
+    files_left = (scan_files or 0) - files_moved - duplicate_scan_files_moved
     # Detailed summary
     summary_lines = {
-        'Scan Folder Files': f"{format_number_with_commas(len(scan_stats)) if scan_stats else 'N/A'} files",
-        'Reference Folder Files': f"{format_number_with_commas(len(ref_stats)) if ref_stats else 'N/A'} files",
+        'Scan Folder Files': f"{format_number_with_commas(scan_files) if scan_files is not None else 'N/A'} files",
+        'Reference Folder Files': f"{format_number_with_commas(ref_files) if ref_files is not None else 'N/A'} files",
         'Files Moved': f"{format_number_with_commas(files_moved)} files",
         'Files Created': f"{format_number_with_commas(files_created)} copies",
         'Left in Scan Folder': f"{format_number_with_commas(files_left)} files",
     }
 
+    copy_methods = FileManager.get_instance().copy_methods
+    if copy_methods:
+        summary_lines['Copy Methods'] = ', '.join(f"{method}: {format_number_with_commas(count)}"
+                                                  for method, count in copy_methods.items())
     if duplicate_scan_files_moved:
         summary_lines['Duplicate Files Moved'] = \
             f"{duplicate_scan_files_moved} duplicate files from the scan folder"
     if deleted_scan_folders:
         summary_lines['Empty Folders Deleted'] = f"{deleted_scan_folders} empty folders in the scan folder"
+    if plan_file:
+        summary_lines['Action Plan'] = f"{plan_file} - apply it with --apply_plan"
+    if coverage:
+        summary_lines['Coverage'] = coverage
 
     common_output_results(summary_header, summary_lines)
 
 
-def output_csv_file_creation_results(args: Namespace, combined_duplicates: dict, scan_stats=None, ref_stats=None):
+def output_plan_results(args: Namespace, results: dict, deleted_scan_folders: int = 0):
+    """ Output the results of applying or undoing an action plan.
+    :param args: The parsed arguments
+    :param results: The results of apply_action_plan() or undo_action_plan()
+    :param deleted_scan_folders: Number of empty folders deleted
+    """
+    title = "Action Plan Applied" if args.apply_plan else "Action Plan Undone"
+    summary_header = f"{title} (Test Mode)" if not args.run else title
+
+    summary_lines = {'Action Plan': args.apply_plan or args.undo_plan}
+    if args.apply_plan:
+        summary_lines['Files Moved'] = f"{format_number_with_commas(results['moved'])} files"
+        summary_lines['Files Created'] = f"{format_number_with_commas(results['copied'])} copies"
+    else:
+        summary_lines['Files Moved Back'] = f"{format_number_with_commas(results['moved'])} files"
+        summary_lines['Copies Deleted'] = f"{format_number_with_commas(results['deleted'])} copies"
+    summary_lines['Skipped'] = f"{format_number_with_commas(results['skipped'])} operations - files changed"
+    if deleted_scan_folders:
+        summary_lines['Empty Folders Deleted'] = f"{deleted_scan_folders} empty folders in the scan folder"
+
+    common_output_results(summary_header, summary_lines)
+
+
+def output_csv_file_creation_results(args: Namespace, duplicate_groups: int, scan_files: int = None,
+                                     ref_files: int = None, report_files=None, coverage: str = None):
     """ Output the results of the CSV file creation.
     :param args: The parsed arguments
-    :param combined_duplicates: The combined duplicates dictionary
-    :param scan_stats: Output of get_files_and_stats() for the scan folder
-    :param ref_stats: Output of get_files_and_stats() for the reference folder
+    :param duplicate_groups: Number of duplicate groups in the report
+    :param scan_files: Number of files in the scan folder
+    :param ref_files: Number of files in the reference folder
+    :param report_files: The files written by create_csv_file(), if the report is sharded
+    :param coverage: The coverage of a run with a budget - see get_coverage_string()
     """
     summary_header = "CSV File Creation Summary:"
 
     # Detailed summary
+    report_path = get_csv_file_path(args)
+    if report_files and len(report_files) > 1:
+        report_path = f"{report_files[0]} ... {os.path.basename(report_files[-1])} ({len(report_files)} files)"
+    elif report_files:
+        report_path = report_files[0]
     summary_lines = {
-        'CSV File Path': get_csv_file_path(args),
-        'Scan Folder Files': f"{format_number_with_commas(len(scan_stats)) if scan_stats else 'N/A'} files",
-        'Reference Folder Files': f"{format_number_with_commas(len(ref_stats)) if ref_stats else 'N/A'} files",
-        'Total Duplicate Files': len(combined_duplicates),
+        'CSV File Path': report_path,
+        'Scan Folder Files': f"{format_number_with_commas(scan_files) if scan_files is not None else 'N/A'} files",
+        'Reference Folder Files': f"{format_number_with_commas(ref_files) if ref_files is not None else 'N/A'} files",
+        'Total Duplicate Files': duplicate_groups,
     }
+    if coverage:
+        summary_lines['Coverage'] = coverage
 
     common_output_results(summary_header, summary_lines)
 
 
+def output_manifest_export_results(args: Namespace, files_exported: int):
+    """ Output the results of the reference manifest export.
+    :param args: The parsed arguments
+    :param files_exported: Number of files in the exported manifest
+    """
+    summary_header = "Reference Manifest Export Summary:"
+
+    summary_lines = {
+        'Manifest File Path': get_manifest_file_path(args),
+        'Reference Folder Files': f"{format_number_with_commas(files_exported)} files",
+    }
+
+    common_output_results(summary_header, summary_lines)
+
+
+def output_link_results(args: Namespace, files_linked: int, bytes_reclaimed: int, scan_files: int = None,
+                        ref_files: int = None, coverage: str = None):
+    """ Output the results of linking the duplicates.
+    :param args: The parsed arguments
+    :param files_linked: Number of scan files replaced with links
+    :param bytes_reclaimed: Number of bytes freed by the links
+    :param scan_files: Number of files in the scan folder
+    :param ref_files: Number of files in the reference folder
+    :param coverage: The coverage of a run with a budget - see get_coverage_string()
+    """
+    summary_header = "Summary (Test Mode)" if not args.run else "Summary"
+    prefix = "Would Be " if not args.run else ""
+
+    summary_lines = {
+        'Scan Folder Files': f"{format_number_with_commas(scan_files) if scan_files is not None else 'N/A'} files",
+        'Reference Folder Files': f"{format_number_with_commas(ref_files) if ref_files is not None else 'N/A'} files",
+        f'Files {prefix}Linked': f"{format_number_with_commas(files_linked)} files ({args.link_type})",
+        f'Space {prefix}Reclaimed': f"{format_number_with_commas(bytes_reclaimed)} bytes",
+    }
+    if coverage:
+        summary_lines['Coverage'] = coverage
+
+    common_output_results(summary_header, summary_lines)
+
+
+def output_metrics_results(args: Namespace, metrics: MetricsCollector):
+    """
+    Write the metrics of the run to the --metrics_json file and output a summary table of the stages.
+    :param args: parsed arguments
+    :param metrics: the metrics collector of the run
+    """
+    report = metrics.write_json(args.metrics_json)
+    summary_header = "Metrics by stage:"
+    log_and_print("")
+    log_and_print(summary_header)
+    for line in MetricsCollector.format_table(report):
+        log_and_print(line)
+    log_and_print(f"Metrics saved to {args.metrics_json}")
+    log_and_print("")
+
+
+def output_profile_results(args: Namespace, profiler: RunProfiler):
+    """
+    Save the profiles of the run to the --profile folder and output where they are.
+    :param args: parsed arguments
+    :param profiler: the profiler of the run
+    """
+    paths = profiler.save()
+    log_and_print(f"Profile saved to {args.profile} - {len(paths)} files. Open the .pstats files with pstats or "
+                  f"snakeviz, and the .collapsed.txt files with a flamegraph tool.")
+    log_and_print("")
+
+
 def common_output_results(title: str, summary_lines: dict):
     """ Output the common results of the script execution.
     :param title: The title of the summary.
@@ -186,8 +372,19 @@ def confirm_script_execution(args: Namespace):
                 print(f"This script will move duplicate files from {args.scan_dir}. "
                       f"No additional confirmation will be asked.")
         elif args.action == 'create_csv':
-            print(f"This script will create a CSV file in {args.move_to}. The folder will be created if it doesn't "
-                  f"exist.")
+            print(f"This script will create a {args.report_format.upper()} report in {args.move_to}. The folder "
+                  f"will be created if it doesn't exist.")
+        elif args.action == 'link_duplicates':
+            if not args.run:
+                print("This script is currently in test mode. No files will be replaced.")
+                print(f"In run mode, duplicate files in {args.scan_dir} will be replaced with links to the files "
+                      f"in {args.reference_dir}.")
+            else:
+                print(f"This script will replace duplicate files in {args.scan_dir} with links to the files in "
+                      f"{args.reference_dir}. No additional confirmation will be asked.")
+        elif args.action == 'export_manifest':
+            print(f"This script will read all the files in {args.reference_dir} and create a manifest file in "
+                  f"{args.move_to}. The folder will be created if it doesn't exist.")
 
         print("Do you want to continue? (y/n): ")
         # while loop until the user enters 'y' or 'n'
@@ -3,8 +3,12 @@ import pytest
 import os
 import shutil
 from duplicate_files_in_folders.hash_manager import HashManager
+from duplicate_files_in_folders.job_state import JobState
+from duplicate_files_in_folders.metrics import MetricsCollector
+from duplicate_files_in_folders.profiler import RunProfiler
+from duplicate_files_in_folders.tree_snapshot import TreeSnapshot
 from duplicate_files_in_folders.initializer import setup_logging
-from duplicate_files_in_folders import file_manager
+from duplicate_files_in_folders import file_manager, hashing_planner
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +69,11 @@ def setup_teardown():
     # Reset the singleton instance
     HashManager.reset_instance()
     HashManager(reference_dir=reference_dir, filename=hash_file)
+    TreeSnapshot.reset_instance()
+    JobState.reset_instance()
+    MetricsCollector.reset_instance()
+    RunProfiler.reset_instance()
+    hashing_planner.reset_device_profiles()
 
     # change file_manager.FileManager.reset_file_manager() to the new arguments
     file_manager.FileManager.reset_file_manager([reference_dir], [scan_dir, move_to_dir], True)
@@ -76,6 +85,9 @@ def setup_teardown():
     yield scan_dir, reference_dir, move_to_dir, common_args
 
     # Teardown: Delete the temporary directories
+    JobState.reset_instance()  # closes the job logs
+    MetricsCollector.reset_instance()
+    RunProfiler.reset_instance()
     shutil.rmtree(TEMP_DIR)
 
 
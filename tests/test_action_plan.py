@@ -0,0 +1,71 @@
+import json
+
+from df_finder3 import main
+from duplicate_files_in_folders.action_plan import iter_action_plan
+from duplicate_files_in_folders.duplicates_finder import iter_duplicates
+from duplicate_files_in_folders.utils import parse_arguments
+from tests.helpers_testing import *
+
+
+def test_apply_plan_of_test_run(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(1, 6))
+    os.makedirs(os.path.join(scan_dir, "sub"))
+    copy_files([6], os.path.join(scan_dir, "sub"))
+    copy_files([6], reference_dir)
+    test_args = [arg for arg in common_args if arg != '--run']
+
+    # the test run doesn't move anything, and writes the plan of the moves
+    plan_file = os.path.join(TEMP_DIR, "plan.jsonl")
+    main(parse_arguments(test_args + ["--save_plan", plan_file]))
+    assert set(os.listdir(scan_dir)) == {f"{i}.jpg" for i in range(1, 6)} | {"sub"}
+    assert not os.listdir(move_to_dir)
+    entries = list(iter_action_plan(plan_file))
+    assert len(entries) == 6
+    assert all(entry['operation'] == 'move' and entry['digest'] for entry in entries)
+    assert {os.path.basename(entry['dst']) for entry in entries} == {f"{i}.jpg" for i in range(1, 7)}
+
+    # a file changed since the test run is skipped when the plan is applied
+    with open(os.path.join(scan_dir, "5.jpg"), 'ab') as f:
+        f.write(b'changed')
+
+    # the plan is applied without finding the duplicates again
+    def fail(*args, **kwargs):
+        raise AssertionError("applying a plan must not walk the folders")
+
+    monkeypatch.setattr(file_manager.FileManager, 'iter_files_and_stats', fail)
+    main(parse_arguments(common_args + ["--apply_plan", plan_file]))
+    assert set(os.listdir(scan_dir)) == {"5.jpg"}  # the emptied sub folder is deleted
+    assert set(os.listdir(move_to_dir)) == {f"{i}.jpg" for i in range(1, 5)} | {"6.jpg"}
+
+    # the plan is an undo journal too - the moved files are moved back
+    main(parse_arguments(common_args + ["--undo_plan", plan_file]))
+    assert set(os.listdir(scan_dir)) == {f"{i}.jpg" for i in range(1, 6)} | {"sub"}
+    assert os.listdir(os.path.join(scan_dir, "sub")) == ["6.jpg"]
+    assert not os.listdir(move_to_dir)
+
+
+def test_apply_plan_validation(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 3), range(1, 3))
+    plan_file = os.path.join(TEMP_DIR, "plan.jsonl")
+    test_args = [arg for arg in common_args if arg != '--run']
+
+    with pytest.raises(SystemExit):  # the plan file must exist
+        parse_arguments(common_args + ["--apply_plan", plan_file])
+    with open(plan_file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'version': 1, 'scan_dir': reference_dir, 'move_to': move_to_dir}) + '\n')
+    with pytest.raises(SystemExit):  # made for other folders
+        parse_arguments(common_args + ["--apply_plan", plan_file])
+    with pytest.raises(SystemExit):
+        parse_arguments(common_args + ["--apply_plan", plan_file, "--undo_plan", plan_file], False)
+    with pytest.raises(SystemExit):
+        parse_arguments(common_args + ["--apply_plan", plan_file, "--action", "create_csv"], False)
+    with pytest.raises(SystemExit):  # a plan is saved by a test run
+        parse_arguments(common_args + ["--save_plan", plan_file], False)
+    with pytest.raises(SystemExit):  # not in the folders that are walked
+        parse_arguments(test_args + ["--save_plan", os.path.join(scan_dir, "plan.jsonl")], False)
+
+    # the duplicates are still found the usual way without a plan
+    args = parse_arguments(common_args)
+    assert len(list(iter_duplicates(args, scan_dir, reference_dir))) == 2
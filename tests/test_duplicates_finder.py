@@ -1,6 +1,12 @@
+import tempfile
+import threading
 import time
+from argparse import Namespace
 
-from duplicate_files_in_folders.duplicates_finder import find_duplicates_files_v3, process_duplicates
+from duplicate_files_in_folders import duplicates_finder, memory_governor
+from duplicate_files_in_folders.duplicates_finder import find_duplicates_files_v3, process_duplicates, \
+    link_duplicates, iter_duplicates, create_csv_file, merge_duplicate_groups, iter_in_background, \
+    iter_duplicate_batches, process_duplicate_batches, for_each_duplicate_group
 from duplicate_files_in_folders.file_manager import FileManager
 from duplicate_files_in_folders.utils import parse_arguments, get_file_key
 from tests.helpers_testing import *
@@ -269,3 +275,335 @@ def test_process_duplicates_keep_structure(setup_teardown):
     assert os.path.exists(os.path.join(move_to_dir, "subfolder", "8.jpg"))
     assert os.path.exists(os.path.join(move_to_dir, "subfolder", "9.jpg"))
     assert os.path.exists(os.path.join(move_to_dir, "subfolder", "10.jpg"))
+
+
+def test_find_duplicate_files_v3_stops_hashing_resolved_groups(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    for sub_folder in ["sub1", "sub2", "sub3"]:
+        os.makedirs(os.path.join(reference_dir, sub_folder))
+        copy_files([1], os.path.join(reference_dir, sub_folder))
+    os.makedirs(os.path.join(scan_dir, "sub2"))
+    copy_files([1], os.path.join(scan_dir, "sub2"))
+
+    hashed_paths = []
+    original_get_hash = HashManager.get_hash
+
+    def get_hash(self, file_path, inode=None):
+        hashed_paths.append(file_path)
+        return original_get_hash(self, file_path, inode)
+
+    monkeypatch.setattr(HashManager, 'get_hash', get_hash)
+
+    # moving needs a single reference file - only the one in the nearest folder is hashed
+    args = parse_arguments(common_args)
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    assert len(duplicates) == 1
+    ref_files = list(duplicates.values())[0]['ref']
+    assert [file_info['path'] for file_info in ref_files] == [os.path.join(reference_dir, "sub2", "1.jpg")]
+    assert len(hashed_paths) == 2
+
+    # copy_to_all needs all the reference files
+    hashed_paths.clear()
+    args = parse_arguments(common_args + ["--copy_to_all"])
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    assert len(list(duplicates.values())[0]['ref']) == 3
+    assert len(hashed_paths) == 4
+
+
+def test_find_duplicate_files_v3_hardlinks(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    os.makedirs(os.path.join(reference_dir, "sub1"))
+    copy_files([1], reference_dir)
+    os.link(os.path.join(reference_dir, "1.jpg"), os.path.join(scan_dir, "1.jpg"))
+    os.link(os.path.join(reference_dir, "1.jpg"), os.path.join(reference_dir, "sub1", "1.jpg"))
+
+    read_paths = []
+    original_compute_hash = HashManager.compute_hash
+
+    def compute_hash(self, file_path, *args, **kwargs):
+        read_paths.append(file_path)
+        return original_compute_hash(self, file_path, *args, **kwargs)
+
+    monkeypatch.setattr(HashManager, 'compute_hash', compute_hash)
+
+    # scan and reference files that are hardlinks of the same file are duplicates without reading them
+    for extra_args in [[], ["--copy_to_all"], ["--action", "create_csv"]]:
+        args = parse_arguments(common_args + extra_args)
+        duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+        assert len(duplicates) == 1
+        assert len(list(duplicates.values())[0]['ref']) == 2
+        assert list(duplicates.keys())[0].startswith("inode_")
+        assert not read_paths
+
+    # a separate copy in the reference folder must be read, but the hardlinks are read only once
+    os.makedirs(os.path.join(reference_dir, "sub2"))
+    copy_files([1], os.path.join(reference_dir, "sub2"))
+    args = parse_arguments(common_args + ["--copy_to_all"])
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    assert len(duplicates) == 1
+    assert len(list(duplicates.values())[0]['ref']) == 3
+    assert len(read_paths) == 2
+
+    # moving needs a single reference file - the hardlink resolves the scan file without reading it
+    read_paths.clear()
+    HashManager.get_instance().clear_cache()
+    args = parse_arguments(common_args)
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    assert len(duplicates) == 1
+    assert not read_paths
+
+
+def test_link_duplicates(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([1, 2, 3], [1, 2, 4])
+    os.link(os.path.join(scan_dir, "2.jpg"), os.path.join(scan_dir, "2_copy.jpg"))
+    scan_size = os.path.getsize(os.path.join(scan_dir, "1.jpg"))
+
+    args = parse_arguments(["--scan", scan_dir, "--reference_dir", reference_dir, "--action", "link_duplicates",
+                            "--link_type", "hardlink", "--ignore_diff", "mdate,filename", "--run"])
+    assert args.move_to is None
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    files_linked, bytes_reclaimed = link_duplicates(args, duplicates)
+    assert files_linked == 3
+    assert bytes_reclaimed == scan_size + os.path.getsize(os.path.join(scan_dir, "2.jpg"))
+    for name in ["1.jpg", "2.jpg", "2_copy.jpg"]:
+        assert os.path.samefile(os.path.join(scan_dir, name), os.path.join(reference_dir, name[0] + ".jpg"))
+    assert os.stat(os.path.join(scan_dir, "3.jpg")).st_nlink == 1  # not a duplicate
+
+    # already linked files are skipped
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    assert link_duplicates(args, duplicates) == (0, 0)
+
+    # a manifest has no reference files to link to
+    with pytest.raises(SystemExit):
+        parse_arguments(["--scan", scan_dir, "--action", "link_duplicates", "--reference_manifest",
+                         os.path.join(move_to_dir, "manifest.jsonl.gz")], False)
+
+
+def test_iter_duplicates(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(2, 6))
+    os.makedirs(os.path.join(reference_dir, "sub"))
+    copy_files(range(3, 7), os.path.join(reference_dir, "sub"))
+
+    args = parse_arguments(common_args + ["--batch_files", "1"], False)
+    expected, scan_stats, ref_stats = find_duplicates_files_v3(parse_arguments(common_args, False), scan_dir,
+                                                               reference_dir)
+
+    # the reference folder is walked lazily, one directory at a time
+    ref_files = FileManager.iter_files_and_stats(reference_dir)
+    assert next(ref_files)['path'].startswith(reference_dir)
+
+    # small batches find the same duplicates, from the smallest files to the largest
+    counts = {}
+    duplicate_groups = list(iter_duplicates(args, scan_dir, reference_dir, counts))
+    assert dict(duplicate_groups) == expected
+    sizes = [locations['scan'][0]['size'] for file_key, locations in duplicate_groups]
+    assert sizes == sorted(sizes)
+    assert counts['scan_files'] == len(scan_stats) == 5
+    assert counts['ref_files'] == len(ref_stats) == 8
+    assert counts['groups'] == len(expected) == 4
+    assert counts['batches'] >= 4  # groups of different sizes are hashed in different batches
+
+    # the report is written from the stream
+    report_files = FileManager.get_instance().with_run_mode(create_csv_file, args,
+                                                            iter_duplicates(args, scan_dir, reference_dir))
+    with open(report_files[0]) as f:
+        assert len(f.readlines()) == 1 + 4 * 2  # header, the scan file and a single reference file of each group
+
+
+def test_iter_duplicates_overlap(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(3, 6))
+    os.makedirs(os.path.join(reference_dir, "sub"))
+    copy_files(range(4, 7), os.path.join(reference_dir, "sub"))
+
+    expected = merge_duplicate_groups(iter_duplicates(parse_arguments(common_args, False), scan_dir, reference_dir))
+    hashed_while_walking = []
+    original_get_file_key = duplicates_finder.get_file_key
+
+    def get_file_key(args, file_path, hardlink_id=None):
+        if threading.current_thread().name.startswith('overlap_hash'):
+            hashed_while_walking.append(file_path)
+        return original_get_file_key(args, file_path, hardlink_id)
+
+    monkeypatch.setattr(duplicates_finder, 'get_file_key', get_file_key)
+
+    # only the scan files with a possible match are hashed while walking - the reference files are hashed by priority
+    args = parse_arguments(common_args + ["--overlap"], False)
+    counts = {}
+    assert merge_duplicate_groups(iter_duplicates(args, scan_dir, reference_dir, counts)) == expected
+    assert sorted(hashed_while_walking) == [os.path.join(scan_dir, f"{i}.jpg") for i in range(3, 6)]
+    assert counts['scan_files'] == 5 and counts['ref_files'] == 6
+
+    # without early termination, the reference files of matched groups are hashed while walking too
+    hashed_while_walking.clear()
+    args = parse_arguments(common_args + ["--overlap", "--action", "create_csv"], False)
+    groups = duplicates_finder.join_candidate_groups_overlapped(
+        args, FileManager.get_files_and_stats(scan_dir), FileManager.get_files_and_stats(reference_dir),
+        {'scan_files': 0, 'ref_files': 0}, hash_ref=True)
+    assert len(groups) == 3
+    assert len(hashed_while_walking) == 3 + 5
+
+    with pytest.raises(SystemExit):
+        parse_arguments(common_args + ["--overlap", "--reference_checksums", "checksums.sha256"], False)
+
+
+def test_iter_in_background():
+    # items are yielded in order, while the producer runs ahead of the consumer by at most queue_size items
+    produced = []
+
+    def produce(count):
+        for i in range(count):
+            produced.append(i)
+            yield i
+
+    items = iter_in_background(produce(10), queue_size=2)
+    assert next(items) == 0
+    time.sleep(0.1)
+    assert len(produced) <= 4  # the item being consumed, 2 queued items and one waiting to be queued
+    assert list(items) == list(range(1, 10))
+
+    # errors are raised in the consumer, after the items produced before them
+    def fail():
+        yield 1
+        raise ValueError("producer error")
+
+    consumed = []
+    with pytest.raises(ValueError):
+        for item in iter_in_background(fail()):
+            consumed.append(item)
+    assert consumed == [1]
+
+    # the producer is stopped when the consumer stops early
+    produced.clear()
+    items = iter_in_background(produce(1000), queue_size=1)
+    assert next(items) == 0
+    items.close()
+    assert len(produced) <= 3
+
+
+def test_process_duplicate_batches(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(1, 6))
+    os.makedirs(os.path.join(scan_dir, "sub"))
+    copy_files(range(1, 3), os.path.join(scan_dir, "sub"))  # second copies, moved to the scan duplicates folder
+
+    args = parse_arguments(common_args + ["--batch_files", "2"], False)
+    counts = {}
+    moved_before_batch = []
+
+    def batches():
+        for batch in iter_duplicate_batches(args, scan_dir, reference_dir, counts):
+            moved_before_batch.append(sum(len(files) for _, _, files in os.walk(move_to_dir)))
+            yield batch
+
+    files_moved, files_created, duplicate_scan_files_moved = process_duplicate_batches(args, batches())
+    assert (files_moved, files_created, duplicate_scan_files_moved) == (5, 0, 2)
+    assert counts['batches'] == 5
+    # each batch is moved before the next one is found
+    assert moved_before_batch[0] == 0
+    assert all(before < after for before, after in zip(moved_before_batch, moved_before_batch[1:]))
+    assert sum(len(files) for _, _, files in os.walk(move_to_dir)) == 7
+    assert sum(len(files) for _, _, files in os.walk(scan_dir)) == 0
+
+    # callback API - the groups are found in the background
+    setup_test_files(range(1, 4), [])
+    sizes = []
+    assert for_each_duplicate_group(args, scan_dir, reference_dir,
+                                    lambda file_key, locations: sizes.append(locations['scan'][0]['size'])) == 3
+    assert sizes == sorted(sizes)  # batches in the order of the file size
+
+
+def test_spilled_candidates_match_in_memory(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 11), range(3, 13))
+    setup_test_files(range(1, 6), range(4, 9), "sub")
+    args = parse_arguments(common_args + ["--batch_files", "3"])
+    expected = list(iter_duplicates(args, scan_dir, reference_dir))
+
+    # the memory is always near the limit - the index is spilled to disk on every file
+    spills = []
+    monkeypatch.setattr(memory_governor, 'MEMORY_CHECK_FILES', 1)
+    monkeypatch.setattr(memory_governor.MemoryGovernor, 'is_near_limit', lambda self: spills.append(1) or True)
+    args = parse_arguments(common_args + ["--batch_files", "3", "--max_memory", "1MB"])
+    counts = {}
+    assert list(iter_duplicates(args, scan_dir, reference_dir, counts)) == expected
+    assert spills and counts['groups'] == len(expected)
+    spill_dirs = [name for name in os.listdir(tempfile.gettempdir()) if name.startswith('dff_spill_')]
+    assert not spill_dirs, "the spilled candidates must be deleted"
+
+    # the most valuable groups first, with a budget
+    budget = ["--max_bytes_read", "1GB", "--ignore_diff", "mdate,filename"]
+    args = parse_arguments(common_args + ["--batch_files", "3"] + budget)
+    expected = list(iter_duplicates(args, scan_dir, reference_dir))
+    args = parse_arguments(common_args + ["--batch_files", "3", "--max_memory", "1MB"] + budget)
+    assert list(iter_duplicates(args, scan_dir, reference_dir)) == expected
+
+    with pytest.raises(SystemExit):
+        parse_arguments(common_args + ["--max_memory", "1MB", "--overlap"])
+    with pytest.raises(SystemExit):
+        parse_arguments(common_args + ["--max_bytes_read", "1GB", "--overlap"])
+
+
+def test_memory_budget_needs_current_rss(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+
+    # without /proc, the current RSS is read with psutil if it is installed
+    def no_proc(*args, **kwargs):
+        raise OSError("no /proc")
+
+    class Process:
+        def memory_info(self):
+            return Namespace(rss=12345)
+
+    monkeypatch.setattr(memory_governor, 'open', no_proc, raising=False)
+    monkeypatch.setattr(memory_governor, 'psutil', Namespace(Process=Process))
+    assert memory_governor.get_rss() == 12345
+    assert parse_arguments(common_args + ["--max_memory", "1MB"], False).max_memory == 1024 * 1024
+
+    # the peak RSS never goes down, so without the current RSS the budget is ignored
+    monkeypatch.setattr(memory_governor, 'psutil', None)
+    assert memory_governor.get_rss() is None
+    assert parse_arguments(common_args + ["--max_memory", "1MB"], False).max_memory is None
+
+
+def test_candidate_counts_hardlinks_once(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    os.makedirs(os.path.join(reference_dir, "sub1"))
+    copy_files([1], reference_dir)
+    copy_files([1], scan_dir)
+    os.link(os.path.join(reference_dir, "1.jpg"), os.path.join(reference_dir, "sub1", "1.jpg"))
+
+    # the reference hardlinks are a single candidate, in memory and spilled to disk
+    args = parse_arguments(common_args + ["--copy_to_all"])
+    counts = {}
+    list(iter_duplicates(args, scan_dir, reference_dir, counts))
+    assert counts['scan_candidates'] == 1 and counts['ref_candidates'] == 1
+
+    monkeypatch.setattr(memory_governor, 'MEMORY_CHECK_FILES', 1)
+    monkeypatch.setattr(memory_governor.MemoryGovernor, 'is_near_limit', lambda self: True)
+    args = parse_arguments(common_args + ["--copy_to_all", "--max_memory", "1MB"])
+    counts = {}
+    list(iter_duplicates(args, scan_dir, reference_dir, counts))
+    assert counts['scan_candidates'] == 1 and counts['ref_candidates'] == 1
+
+
+def test_early_termination_orders_matches_by_path(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    args = parse_arguments(common_args, False)
+
+    def file_info(folder, name, size):
+        return {'path': os.path.join(folder, name), 'name': name, 'size': size, 'modified_time': 1.0}
+
+    # files of different sizes with the same key (same first 2MB) are resolved in different groups
+    scan_files = [file_info(scan_dir, "1.jpg", 10), file_info(scan_dir, "2.jpg", 20)]
+    ref_files = [file_info(os.path.join(reference_dir, "z"), "2.jpg", 20),
+                 file_info(os.path.join(reference_dir, "a"), "1.jpg", 10)]
+    expected = sorted(f['path'] for f in ref_files)
+    for candidates in [ref_files, ref_files[::-1]]:
+        for max_workers in [1, 2]:
+            combined = duplicates_finder.aggregate_ref_candidates_until_resolved(
+                candidates, {'key': {'scan': list(scan_files)}}, args, scan_dir, reference_dir,
+                lambda key_args, f: 'key', max_workers)
+            assert [f['path'] for f in combined['key']['ref']] == expected
@@ -0,0 +1,143 @@
+from duplicate_files_in_folders.file_executor import FileOperationsExecutor, DestinationPlanner
+from duplicate_files_in_folders.file_manager import FileManager
+from tests.helpers_testing import *
+
+
+def test_executor_moves_and_copies(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([1, 2, 3], [])
+    made_dirs = []
+    original_make_dirs = FileManager.make_dirs
+
+    def make_dirs(self, dir_path, resolved=False):
+        made_dirs.append(dir_path)
+        return original_make_dirs(self, dir_path, resolved)
+
+    monkeypatch.setattr(FileManager, 'make_dirs', make_dirs)
+
+    executor = FileOperationsExecutor(max_workers=4)
+    # the copy of 1.jpg is added after its move, but copies run first
+    executor.add('move', os.path.join(scan_dir, "1.jpg"), os.path.join(move_to_dir, "a", "b", "1.jpg"))
+    executor.add('copy', os.path.join(scan_dir, "1.jpg"), os.path.join(move_to_dir, "a", "c", "1.jpg"))
+    executor.add('move', os.path.join(scan_dir, "2.jpg"), os.path.join(move_to_dir, "a", "b", "2.jpg"))
+    # two operations to the same destination - the second is renamed
+    dst = executor.add('move', os.path.join(scan_dir, "3.jpg"), os.path.join(move_to_dir, "a", "b", "2.jpg"))
+    assert dst != os.path.join(move_to_dir, "a", "b", "2.jpg")
+
+    expected_bytes = sum(os.path.getsize(os.path.join(scan_dir, f"{i}.jpg")) for i in [1, 1, 2, 3])
+    results = executor.run()
+    assert results == {'moved': 3, 'copied': 1, 'bytes': expected_bytes}
+    assert sorted(made_dirs) == [os.path.join(move_to_dir, "a", "b"), os.path.join(move_to_dir, "a", "c")]
+    assert os.listdir(scan_dir) == []
+    assert sorted(os.listdir(os.path.join(move_to_dir, "a", "b"))) == sorted(["1.jpg", "2.jpg", os.path.basename(dst)])
+    assert os.listdir(os.path.join(move_to_dir, "a", "c")) == ["1.jpg"]
+    assert FileManager.get_instance().moved_from_dirs == {scan_dir}
+
+
+def test_executor_groups_by_device(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), [])
+    executed_in_pool = []
+    original_execute_parallel = FileOperationsExecutor.execute_parallel
+
+    def execute_parallel(self, operations, progress_bar):
+        executed_in_pool.extend(op['src'] for op in operations)
+        return original_execute_parallel(self, operations, progress_bar)
+
+    monkeypatch.setattr(FileOperationsExecutor, 'execute_parallel', execute_parallel)
+
+    # files 1-2 are on the device of move_to, files 3-5 on another device
+    executor = FileOperationsExecutor(max_workers=2)
+    move_to_dev = os.stat(move_to_dir).st_dev
+    for i in range(1, 6):
+        src = os.path.join(scan_dir, f"{i}.jpg")
+        file_info = FileManager.get_file_info(src)
+        file_info['dev'] = move_to_dev if i <= 2 else move_to_dev + 1
+        executor.add('move', src, os.path.join(move_to_dir, f"{i}.jpg"), file_info)
+    assert executor.run()['moved'] == 5
+    assert sorted(executed_in_pool) == [os.path.join(scan_dir, f"{i}.jpg") for i in range(3, 6)]
+    assert len(os.listdir(move_to_dir)) == 5
+
+
+def test_executor_errors_and_test_mode(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([1, 2], [1])
+
+    # moving to a protected folder fails
+    executor = FileOperationsExecutor(max_workers=2)
+    executor.add('move', os.path.join(scan_dir, "1.jpg"), os.path.join(reference_dir, "sub", "1.jpg"))
+    with pytest.raises(file_manager.ProtectedPathError):
+        executor.run()
+
+    with pytest.raises(ValueError):
+        executor.add('delete', os.path.join(scan_dir, "1.jpg"), os.path.join(move_to_dir, "1.jpg"))
+
+    # test mode - nothing is changed
+    FileManager.reset_file_manager([reference_dir], [scan_dir, move_to_dir], run_mode=False)
+    executor = FileOperationsExecutor(max_workers=2)
+    executor.add('move', os.path.join(scan_dir, "1.jpg"), os.path.join(move_to_dir, "sub", "1.jpg"))
+    executor.add('copy', os.path.join(scan_dir, "2.jpg"), os.path.join(move_to_dir, "sub", "2.jpg"))
+    assert executor.run()['moved'] == 1
+    assert sorted(os.listdir(scan_dir)) == ["1.jpg", "2.jpg"]
+    assert os.listdir(move_to_dir) == []
+
+
+def test_destination_planner(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    os.makedirs(os.path.join(move_to_dir, "sub"))
+    copy_files([1, 2], os.path.join(move_to_dir, "sub"))
+    with open(os.path.join(move_to_dir, "sub", "1_1.jpg"), 'w') as f:
+        f.write("taken")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("destinations must be planned without checking each path on disk")
+
+    # folders are listed lazily, once each, and the root is never walked
+    listed_dirs = []
+    listdir = os.listdir
+
+    def listdir_once(path):
+        assert path not in listed_dirs
+        listed_dirs.append(path)
+        return listdir(path)
+
+    monkeypatch.setattr(os, 'walk', fail)
+    monkeypatch.setattr(os.path, 'exists', fail)
+    monkeypatch.setattr(os, 'listdir', listdir_once)
+    monkeypatch.setattr(os, 'stat', fail)
+
+    planner = DestinationPlanner(move_to_dir)
+    assert listed_dirs == []
+
+    sub = os.path.join(move_to_dir, "sub")
+    assert planner.plan(os.path.join(sub, "3.jpg")) == os.path.join(sub, "3.jpg")
+    # collisions get the first free suffix, in order - 1_1.jpg is taken
+    assert planner.plan(os.path.join(sub, "1.jpg")) == os.path.join(sub, "1_2.jpg")
+    assert planner.plan(os.path.join(sub, "1.jpg")) == os.path.join(sub, "1_3.jpg")
+    assert planner.plan(os.path.join(sub, "3.jpg")) == os.path.join(sub, "3_1.jpg")
+    # new folders don't exist and can't be used as file names
+    new_dir = os.path.join(move_to_dir, "new", "deep")
+    assert planner.plan(os.path.join(new_dir, "1.jpg")) == os.path.join(new_dir, "1.jpg")
+    assert not planner.dir_exists(new_dir)
+    assert planner.dir_exists(sub)
+    assert planner.plan(os.path.join(move_to_dir, "new")) == os.path.join(move_to_dir, "new_1")
+    assert listed_dirs == [sub, move_to_dir, new_dir, os.path.join(move_to_dir, "new")]
+
+
+def test_executors_share_planner(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([1], [])
+    os.makedirs(os.path.join(scan_dir, "sub"))
+    copy_files([1], os.path.join(scan_dir, "sub"))
+    dups_dir = os.path.join(move_to_dir, "dups")
+
+    # two executors with overlapping roots - the second one must not overwrite the files of the first one
+    planner = DestinationPlanner(move_to_dir)
+    executor = FileOperationsExecutor(planner=planner)
+    dups_executor = FileOperationsExecutor(planner=planner)
+    executor.add('move', os.path.join(scan_dir, "1.jpg"), os.path.join(dups_dir, "1.jpg"))
+    executor.run()
+    assert dups_executor.add('move', os.path.join(scan_dir, "sub", "1.jpg"), os.path.join(dups_dir, "1.jpg")) == \
+        os.path.join(dups_dir, "1_1.jpg")
+    dups_executor.run()
+    assert sorted(os.listdir(dups_dir)) == ["1.jpg", "1_1.jpg"]
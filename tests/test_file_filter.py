@@ -0,0 +1,118 @@
+import time
+
+from duplicate_files_in_folders.file_filter import FileFilter
+from duplicate_files_in_folders.file_manager import FileManager
+from duplicate_files_in_folders.tree_snapshot import TreeSnapshot
+from duplicate_files_in_folders.utils import parse_arguments
+from tests.helpers_testing import *
+
+
+def test_extension_filters():
+    file_filter = FileFilter(whitelist_ext={'JPG', '.tar.gz'})
+    assert file_filter.accepts_name('photo.jpg')
+    assert file_filter.accepts_name('PHOTO.Jpg')
+    assert file_filter.accepts_name('backup.2024.TAR.GZ')
+    assert not file_filter.accepts_name('archive.gz')
+    assert not file_filter.accepts_name('jpg')
+    assert not file_filter.accepts_name('photo.jpg.txt')
+
+    file_filter = FileFilter(blacklist_ext={'tmp', 'log.gz'})
+    assert file_filter.accepts_name('photo.jpg')
+    assert file_filter.accepts_name('no_extension')
+    assert not file_filter.accepts_name('file.TMP')
+    assert not file_filter.accepts_name('server.log.gz')
+    assert file_filter.accepts_name('server.tar.gz')
+
+
+def test_size_and_modified_time_filters():
+    file_filter = FileFilter(min_size=10, max_size=20)
+    assert file_filter.accepts_name('anything.tmp')
+    assert not file_filter.accepts_stats(9, 0)
+    assert file_filter.accepts_stats(10, 0)
+    assert file_filter.accepts_stats(20, 0)
+    assert not file_filter.accepts_stats(21, 0)
+    assert file_filter.accepts({'name': 'a.jpg', 'size': 15, 'modified_time': 0})
+
+    file_filter = FileFilter(modified_after=100, modified_before=200)
+    assert not file_filter.accepts_stats(0, 99)
+    assert file_filter.accepts_stats(0, 150)
+    assert not file_filter.accepts_stats(0, 201)
+
+
+def test_folder_and_name_patterns():
+    file_filter = FileFilter(exclude_dir=['.git', 'node_modules', '@eaDir', '*snapshot*'],
+                             exclude_dir_regex=r'^\.trash')
+    assert not file_filter.accepts_dir('.git')
+    assert not file_filter.accepts_dir('Node_Modules')
+    assert not file_filter.accepts_dir('@eaDir')
+    assert not file_filter.accepts_dir('.zfs_snapshot_daily')
+    assert not file_filter.accepts_dir('.trash-1000')
+    assert file_filter.accepts_dir('.github')
+    assert file_filter.accepts_dir('photos')
+    assert file_filter.accepts({'name': 'a.jpg', 'size': 1, 'modified_time': 0,
+                                'path': os.path.join('r', 'a', 'a.jpg')}, 'r')
+    assert not file_filter.accepts({'name': 'a.jpg', 'size': 1, 'modified_time': 0,
+                                    'path': os.path.join('r', '.git', 'x', 'a.jpg')}, 'r')
+
+    file_filter = FileFilter(include=['IMG_*'], include_regex=r'\d{8}\.raw$')
+    assert file_filter.accepts_name('img_0001.jpg')
+    assert file_filter.accepts_name('photo_20240131.raw')
+    assert not file_filter.accepts_name('photo.jpg')
+    assert not file_filter.accepts_name('MY_IMG_0001.jpg')
+
+
+def test_from_args(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    assert FileFilter.from_args(parse_arguments(common_args, False)) is None
+    args = parse_arguments(common_args + ["--blacklist_ext", "tmp", "--exclude_dir", ".git,@eaDir",
+                                          "--modified_after", "30d", "--modified_before", "2100-01-01"], False)
+    file_filter = FileFilter.from_args(args)
+    assert file_filter.blacklist_ext == {'tmp'}
+    assert not file_filter.accepts_dir('@eaDir')
+    assert file_filter.accepts_stats(0, time.time())
+    assert not file_filter.accepts_stats(0, time.time() - 31 * 24 * 60 * 60)
+
+    # a regular expression with global flags is compiled apart from the globs
+    args = parse_arguments(common_args + ["--include", "*.jpg", "--include_regex", "(?i)^tmp"], False)
+    file_filter = FileFilter.from_args(args)
+    assert file_filter.accepts_name('TMP_notes.txt')
+    assert file_filter.accepts_name('photo.JPG')
+    assert not file_filter.accepts_name('notes_tmp.txt')
+
+    for invalid_args in [["--exclude_dir_regex", "("], ["--modified_after", "yesterday"],
+                         ["--modified_after", "1d", "--modified_before", "2d"]]:
+        with pytest.raises(SystemExit):
+            parse_arguments(common_args + invalid_args, False)
+
+
+def test_walkers_apply_filter(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    os.makedirs(os.path.join(scan_dir, "sub1"))
+    copy_files([1, 2], scan_dir)
+    copy_files([3], os.path.join(scan_dir, "sub1"))
+    for name in ["a.tmp", "b.TMP", os.path.join("sub1", "c.tmp")]:
+        with open(os.path.join(scan_dir, name), 'w') as f:
+            f.write("temporary")
+
+    args = parse_arguments(common_args + ["--blacklist_ext", "tmp"], False)
+    file_filter = FileFilter.from_args(args)
+    expected = {"1.jpg", "2.jpg", "3.jpg"}
+    assert {f['name'] for f in FileManager.get_files_and_stats(scan_dir, file_filter=file_filter)} == expected
+    assert {f['name'] for f in FileManager.get_files_and_stats_parallel([scan_dir], 4, file_filter=file_filter)[0]} \
+        == expected
+    assert {f['name'] for f in TreeSnapshot(None, None).get_files_and_stats(scan_dir, file_filter=file_filter)} \
+        == expected
+    # the snapshot keeps all the files, so it can be reused without the filter
+    assert len(TreeSnapshot.get_instance().get_files_and_stats(scan_dir)) == 6
+
+    os.makedirs(os.path.join(scan_dir, "@eaDir"))
+    copy_files([4], os.path.join(scan_dir, "@eaDir"))
+    file_filter = FileFilter(exclude_dir=['@eaDir'])
+    assert len(FileManager.get_files_and_stats(scan_dir, file_filter=file_filter)) == 6
+    assert len(FileManager.get_files_and_stats_parallel([scan_dir], 4, file_filter=file_filter)[0]) == 6
+    assert len(TreeSnapshot.get_instance().get_files_and_stats(scan_dir, file_filter=file_filter)) == 6
+    assert len(FileManager.get_files_and_stats(scan_dir)) == 7
+
+    args = parse_arguments(common_args + ["--max_size", "10B"], False)
+    assert {f['name'] for f in FileManager.get_files_and_stats(scan_dir, file_filter=FileFilter.from_args(args))} \
+        == {"a.tmp", "b.TMP", "c.tmp"}
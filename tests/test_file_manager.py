@@ -1,6 +1,8 @@
+import errno
+
 from tests.helpers_testing import *
 from pathlib import Path
-from duplicate_files_in_folders.file_manager import FileManager
+from duplicate_files_in_folders.file_manager import FileManager, PathMatcher
 
 
 def test_move_file(setup_teardown):
@@ -83,6 +85,94 @@ def test_copy_file(setup_teardown):
     assert os.path.exists(file_to_copy)
 
 
+def test_copy_file_methods(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([1], [])
+    fm = FileManager.reset_file_manager([reference_dir], [scan_dir, move_to_dir], run_mode=True)
+    src = os.path.join(scan_dir, "1.jpg")
+    os.utime(src, (1000000000, 1000000000))
+    with open(src, 'rb') as f:
+        content = f.read()
+
+    def unsupported(*args, **kwargs):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    # each method falls back to the next one if it is not supported - the copy is the same whichever is used
+    expected_methods = ['copy_file_range', 'reflink', 'sendfile', 'buffered']
+    for i in range(len(expected_methods)):
+        dst = os.path.join(move_to_dir, f"{i}.jpg")
+        fm.copy_file(src, dst)
+        with open(dst, 'rb') as f:
+            assert f.read() == content
+        assert os.path.getmtime(dst) == 1000000000
+        if expected_methods[i] == 'copy_file_range':
+            monkeypatch.setattr(os, 'copy_file_range', unsupported, raising=False)
+        elif expected_methods[i] == 'reflink':
+            monkeypatch.setattr(file_manager, 'fcntl', None)
+        elif expected_methods[i] == 'sendfile':
+            monkeypatch.setattr(os, 'sendfile', unsupported, raising=False)
+    assert fm.copy_methods.get('buffered') == 1
+    assert sum(fm.copy_methods.values()) == 4
+
+    # sendfile to a file fails with ENOTSOCK on macOS and BSD - it is only tried on Linux, and falls back anyway
+    monkeypatch.setattr(file_manager.FileManager, 'COPY_METHODS', ['sendfile', 'buffered'])
+
+    def not_socket(*args, **kwargs):
+        raise OSError(errno.ENOTSOCK, "Socket operation on non-socket")
+
+    monkeypatch.setattr(os, 'sendfile', not_socket, raising=False)
+    for platform in ['linux', 'darwin']:
+        monkeypatch.setattr(file_manager.sys, 'platform', platform)
+        dst = os.path.join(move_to_dir, f"sendfile_{platform}.jpg")
+        fm.copy_file(src, dst)
+        with open(dst, 'rb') as f:
+            assert f.read() == content
+    assert fm.copy_methods.get('buffered') == 3
+
+    # other errors are raised
+    monkeypatch.setattr(file_manager.FileManager, 'COPY_METHODS', ['copy_file_range'])
+
+    def io_error(*args, **kwargs):
+        raise OSError(errno.EIO, "Input/output error")
+
+    monkeypatch.setattr(os, 'copy_file_range', io_error, raising=False)
+    with pytest.raises(OSError):
+        fm.copy_file(src, os.path.join(move_to_dir, "error.jpg"))
+
+
+def test_link_file(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([1, 2, 3], [1, 2, 3])
+    fm = FileManager(True).reset_all()
+    fm.add_protected_dir(reference_dir)
+    fm.add_allowed_dir(scan_dir)
+
+    # replacing a protected file should fail
+    with pytest.raises(file_manager.ProtectedPathError):
+        fm.link_file(os.path.join(scan_dir, "1.jpg"), os.path.join(reference_dir, "1.jpg"), 'hardlink')
+
+    # hardlink - the scan file becomes the reference file
+    ref_file, scan_file = os.path.join(reference_dir, "1.jpg"), os.path.join(scan_dir, "1.jpg")
+    assert fm.link_file(ref_file, scan_file, 'hardlink') == 'hardlink'
+    assert os.path.samefile(ref_file, scan_file)
+    assert os.stat(ref_file).st_nlink == 2
+    assert sorted(os.listdir(scan_dir)) == ["1.jpg", "2.jpg", "3.jpg"]  # no temporary files left
+
+    # auto - a reflink if the filesystem supports it, else a hardlink. Either way the content is the same
+    ref_file, scan_file = os.path.join(reference_dir, "2.jpg"), os.path.join(scan_dir, "2.jpg")
+    link_type = fm.link_file(ref_file, scan_file)
+    assert link_type in ('reflink', 'hardlink')
+    assert os.path.samefile(ref_file, scan_file) == (link_type == 'hardlink')
+    with open(ref_file, 'rb') as f1, open(scan_file, 'rb') as f2:
+        assert f1.read() == f2.read()
+
+    # test mode - nothing is changed
+    fm = FileManager.reset_file_manager([reference_dir], [scan_dir], run_mode=False)
+    ref_file, scan_file = os.path.join(reference_dir, "3.jpg"), os.path.join(scan_dir, "3.jpg")
+    assert fm.link_file(ref_file, scan_file, 'hardlink') == 'hardlink'
+    assert not os.path.samefile(ref_file, scan_file)
+
+
 def test_delete_file(setup_teardown):
     scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
     setup_test_files(range(1, 6), [2, 3])
@@ -188,6 +278,37 @@ def test_rmdir(setup_teardown):
 
 
 # The FileManager class should be a singleton, so we should not be able to create multiple instances of it.
+def test_delete_empty_folders(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    for folder in ["a/b/c", "a/d", "e/f", "g"]:
+        os.makedirs(os.path.join(scan_dir, *folder.split('/')))
+    copy_files([1], os.path.join(scan_dir, "a", "d"))
+    copy_files([2], os.path.join(scan_dir, "a", "b", "c"))
+    copy_files([3], os.path.join(scan_dir, "g"))
+    fm = FileManager.reset_file_manager([reference_dir], [scan_dir, move_to_dir], run_mode=True)
+
+    # only the folders files were moved out of, and their parents, are deleted - e/f was empty before
+    fm.move_file(os.path.join(scan_dir, "a", "b", "c", "2.jpg"), os.path.join(move_to_dir, "2.jpg"))
+    fm.move_file(os.path.join(scan_dir, "g", "3.jpg"), os.path.join(move_to_dir, "3.jpg"))
+    assert fm.moved_from_dirs == {os.path.join(scan_dir, "a", "b", "c"), os.path.join(scan_dir, "g")}
+    assert fm.delete_empty_folders(scan_dir, fm.moved_from_dirs) == 3
+    assert sorted(os.listdir(scan_dir)) == ["a", "e"]
+    assert os.listdir(os.path.join(scan_dir, "a")) == ["d"]
+
+    # folders outside the base folder and the base folder itself are never deleted
+    os.makedirs(os.path.join(move_to_dir, "empty"))
+    assert fm.delete_empty_folders(os.path.join(scan_dir, "e"), [os.path.join(move_to_dir, "empty"),
+                                                                  os.path.join(scan_dir, "e")]) == 0
+    assert fm.delete_empty_folders(os.path.join(scan_dir, "e"), [os.path.join(scan_dir, "e", "f")]) == 1
+    assert os.path.isdir(os.path.join(scan_dir, "e"))
+    with pytest.raises(file_manager.ProtectedPathError):
+        fm.delete_empty_folders(reference_dir, [])
+
+    # the full walk deletes all the empty folders
+    os.makedirs(os.path.join(scan_dir, "e", "f"))
+    assert fm.delete_empty_folders_in_tree(scan_dir) == 2
+
+
 def test_singleton():
     fm1 = FileManager(True)
     fm2 = FileManager(True)
@@ -254,6 +375,49 @@ def test_list_tree_os_scandir_bfs_tree_with_many_subfolders(setup_teardown):
     assert set(scan_tree) == scan_files
 
 
+def test_get_files_and_stats_parallel(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+
+    for sub_path in ["sub1", os.path.join("sub1", "sub1"), os.path.join("sub1", "sub2"), "sub2"]:
+        os.makedirs(os.path.join(scan_dir, sub_path))
+        os.makedirs(os.path.join(reference_dir, sub_path))
+        copy_files(range(1, 4), os.path.join(scan_dir, sub_path))
+        copy_files(range(3, 6), os.path.join(reference_dir, sub_path))
+    copy_files(range(1, 3), scan_dir)
+
+    expected_scan = sorted(FileManager.get_files_and_stats(scan_dir), key=lambda x: x['path'])
+    expected_ref = sorted(FileManager.get_files_and_stats(reference_dir), key=lambda x: x['path'])
+
+    # the output should be the same as the single-threaded walk, regardless of the number of workers
+    for max_workers in [1, 2, 8]:
+        scan_stats, ref_stats = FileManager.get_files_and_stats_parallel([scan_dir, reference_dir], max_workers)
+        assert sorted(scan_stats, key=lambda x: x['path']) == expected_scan
+        assert sorted(ref_stats, key=lambda x: x['path']) == expected_ref
+
+    # errors in a worker thread are raised in the calling thread, like in the single-threaded walk
+    with pytest.raises(FileNotFoundError):
+        FileManager.get_files_and_stats_parallel([scan_dir, os.path.join(scan_dir, "non_existing")], 2)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason="Symlinks need privileges on Windows")
+def test_walks_keep_the_given_root(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    os.makedirs(os.path.join(scan_dir, "sub"))
+    copy_files(range(1, 3), os.path.join(scan_dir, "sub"))
+    link_dir = os.path.join(TEMP_DIR, "scan_link")
+    os.symlink(scan_dir, link_dir)
+    monkeypatch.chdir(TEMP_DIR)
+
+    # the paths are under the root as given - a symlink is not resolved, a relative root is made absolute
+    for root, expected_root in [(link_dir, link_dir), ("scan_link", link_dir), (SCAN_DIR_NAME, scan_dir)]:
+        expected = sorted(os.path.join(expected_root, "sub", f"{i}.jpg") for i in range(1, 3))
+        assert sorted(f['path'] for f in FileManager.get_files_and_stats(root)) == expected
+        assert sorted(f['path'] for f in FileManager.iter_files_and_stats(root)) == expected
+        for max_workers in [1, 4]:
+            assert sorted(f['path'] for f in FileManager.get_files_and_stats_parallel([root], max_workers)[0]) == \
+                expected
+
+
 @pytest.mark.skipif(os.name == 'nt', reason="Test is only for Linux paths")
 def test_file_manager_any_is_subfolder_of_linux():
 
@@ -347,6 +511,30 @@ def test_file_manager_is_allowed_path(setup_teardown):
     assert not fm.is_protected_path(os.path.join(scan_dir, "folder3", "subfolder"))
 
 
+def test_path_matcher(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    matcher = PathMatcher([os.path.join(reference_dir, "folder"), os.path.join(reference_dir, "a", "b")])
+    assert matcher.matches(os.path.join(reference_dir, "folder"))
+    assert matcher.matches(os.path.join(reference_dir, "folder", "sub", "1.jpg"))
+    assert matcher.matches(os.path.join(reference_dir, "a", "b", "1.jpg"))
+    assert not matcher.matches(os.path.join(reference_dir, "folder1", "1.jpg"))  # a prefix of a name is not a match
+    assert not matcher.matches(os.path.join(reference_dir, "a", "1.jpg"))
+    assert not matcher.matches(reference_dir)
+    assert not PathMatcher().matches(reference_dir)
+    assert PathMatcher([os.path.abspath(os.sep)]).matches(reference_dir)  # the root folder contains everything
+
+    # operations on resolved paths don't resolve them again
+    fm = FileManager.reset_file_manager([reference_dir], [scan_dir, move_to_dir], run_mode=True)
+    setup_test_files([1], [])
+    src, dst = fm.resolve_path(os.path.join(scan_dir, "1.jpg")), fm.resolve_path(os.path.join(move_to_dir, "1.jpg"))
+    monkeypatch.setattr(FileManager, 'resolve_path', staticmethod(lambda path: pytest.fail(f"{path} resolved again")))
+    assert fm.is_protected_path(os.path.join(reference_dir, "1.jpg"), resolved=True)
+    fm.copy_file(src, dst, resolved=True)
+    fm.delete_file(dst, resolved=True)
+    fm.move_file(src, dst, resolved=True)
+    assert os.listdir(move_to_dir) == ["1.jpg"]
+
+
 def test_python_source_files():
     """
     Test all python files in the project under duplicate_files_in_folders folder. Make sure that all python files
@@ -358,7 +546,8 @@ def test_python_source_files():
     project_root = project_root / "duplicate_files_in_folders"
     python_files = list(project_root.glob("**/*.py"))
     python_files = [str(file) for file in python_files if "__init__.py" not in str(file)]
-    disallowed_functions = ["shutil.copy", "shutil.move", "shutil.rmtree", "os.makedirs", "os.rmdir", "os.remove"]
+    disallowed_functions = ["shutil.copy", "shutil.move", "shutil.rmtree", "os.makedirs", "os.rmdir", "os.remove",
+                            "os.link", "os.replace"]
     exceptions_list = {  # allow these functions in these files
         "initializer.py": ["os.makedirs"]
     }
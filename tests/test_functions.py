@@ -1,7 +1,7 @@
 from duplicate_files_in_folders.duplicates_finder import clean_scan_dir_duplications, find_duplicates_files_v3, \
     process_duplicates
 from duplicate_files_in_folders.file_manager import FileManager
-from duplicate_files_in_folders.utils import parse_arguments, parse_size, check_and_update_filename
+from duplicate_files_in_folders.utils import parse_arguments, parse_size, check_and_update_filename, parse_duration
 from duplicate_files_in_folders.initializer import setup_file_manager
 
 from tests.helpers_testing import *
@@ -37,6 +37,9 @@ def test_parse_arguments():
     assert args.whitelist_ext is None
     assert args.blacklist_ext is None
     assert args.full_hash is False
+    assert args.walk_workers == 1
+    assert args.full_rescan is False
+    assert args.ref_snapshot is False
 
     # Test case 3: Many arguments provided
     args = parse_arguments(['--scan', scan_dir, '--reference_dir', reference_dir, '--move_to', move_to_folder,
@@ -112,6 +115,11 @@ def test_parse_arguments():
                         '--max_size', '-10'], False)
     assert excinfo.type == SystemExit
 
+    with pytest.raises(SystemExit) as excinfo:  # invalid value for walk_workers - zero
+        parse_arguments(['--scan', scan_dir, '--reference_dir', reference_dir, '--move_to', move_to_folder,
+                         '--walk_workers', '0'], False)
+    assert excinfo.type == SystemExit
+
     with pytest.raises(SystemExit) as excinfo:  # invalid value for reference_dir - same as scan_dir
         parse_arguments(['--scan', scan_dir, '--reference_dir', scan_dir, '--move_to', move_to_folder], False)
     assert excinfo.type == SystemExit
@@ -190,6 +198,16 @@ def test_parse_size():
     assert parse_size("0") == 0
 
 
+def test_parse_duration():
+    assert parse_duration("90") == 90
+    assert parse_duration("45m") == 45 * 60
+    assert parse_duration("1.5H") == 90 * 60
+    assert parse_duration("30s") == 30
+    for invalid in ["", "m", "10d", "-5m", "0"]:
+        with pytest.raises(ValueError):
+            parse_duration(invalid)
+
+
 def test_delete_empty_folders_in_tree(setup_teardown):
     scan_dir, reference_dir, move_to_dir, _ = setup_teardown
 
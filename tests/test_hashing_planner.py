@@ -0,0 +1,161 @@
+from duplicate_files_in_folders import hashing_planner
+from duplicate_files_in_folders.duplicates_finder import find_duplicates_files_v3, \
+    prefilter_candidates_by_partial_hash, iter_candidate_batches, iter_duplicate_batches, process_duplicate_batches
+from duplicate_files_in_folders.file_manager import FileManager
+from duplicate_files_in_folders.hashing_planner import plan_hashing, format_plan, HashingBudget
+from duplicate_files_in_folders.initializer import setup_job_state
+from duplicate_files_in_folders.utils_io import get_coverage_string
+from duplicate_files_in_folders.utils import parse_arguments
+from tests.helpers_testing import *
+
+
+def test_plan_small_candidates(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 4), range(1, 4))
+    args = parse_arguments(common_args)
+    scan_stats, ref_stats = FileManager.get_files_and_stats(scan_dir), FileManager.get_files_and_stats(reference_dir)
+
+    # a fast local disk - the executor doesn't depend on the load of the machine running the test
+    monkeypatch.setattr(hashing_planner, 'measure_device', lambda file_infos, cached_paths: {
+        'latency': 0.0001, 'throughput': 500 * 1024 * 1024, 'hash_throughput': 500 * 1024 * 1024, 'sample_bytes': 0})
+
+    plan = plan_hashing(args, scan_dir, reference_dir, scan_stats, ref_stats, scan_first=True)
+    assert plan['order'] == ['scan', 'ref']
+    assert not plan['concurrent']
+    assert not plan['prefilter']
+    for side in ['scan', 'ref']:
+        assert plan[side]['files'] == 3
+        assert plan[side]['uncached_files'] == 3
+        assert plan[side]['cache_hit_ratio'] == 0
+        assert plan[side]['bytes_to_read'] == sum(min(f['size'], 2 * 1024 * 1024) for f in scan_stats)
+        assert plan[side]['executor'] == 'serial'
+    assert format_plan(plan).startswith("Hashing plan: scan then ref;")
+
+    # cached reference hashes are not read again
+    HashManager.get_instance().add_hashes({f['path']: 'hash' for f in ref_stats})
+    plan = plan_hashing(args, scan_dir, reference_dir, scan_stats, ref_stats)
+    assert plan['ref']['cache_hit_ratio'] == 1
+    assert plan['ref']['bytes_to_read'] == 0
+    assert plan['order'] == ['ref', 'scan']  # the cheaper side first
+
+
+def test_plan_high_latency_device_uses_threads(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 11), range(1, 11))
+    args = parse_arguments(common_args)
+    scan_stats = FileManager.get_files_and_stats(scan_dir)
+
+    monkeypatch.setattr(hashing_planner, 'measure_device', lambda file_infos, cached_paths: {
+        'latency': 0.05, 'throughput': 100 * 1024 * 1024, 'hash_throughput': 500 * 1024 * 1024, 'sample_bytes': 0})
+    plan = plan_hashing(args, scan_dir, reference_dir, scan_stats, [])
+    assert plan['scan']['executor'] == 'threads'
+    assert 1 < plan['scan']['workers'] <= 10
+
+
+def test_partial_hash_prefilter(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    HashManager.reset_instance()
+    HashManager(reference_dir=reference_dir, filename=None, full_hash=True)
+    content = os.urandom(3 * 1024 * 1024)
+    for folder, name, data in [(scan_dir, "same.bin", content), (reference_dir, "same.bin", content),
+                               (scan_dir, "other.bin", content), (reference_dir, "other.bin", b'x' + content[1:])]:
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(data)
+    args = parse_arguments(common_args + ["--full_hash"])
+    scan_stats, ref_stats = FileManager.get_files_and_stats(scan_dir), FileManager.get_files_and_stats(reference_dir)
+
+    assert not plan_hashing(args, scan_dir, reference_dir, scan_stats, ref_stats)['prefilter']
+    monkeypatch.setattr(hashing_planner, 'PREFILTER_MIN_SIZE_RATIO', 1)
+    plan = plan_hashing(args, scan_dir, reference_dir, scan_stats, ref_stats)
+    assert plan['prefilter']
+
+    scan_candidates, ref_candidates = prefilter_candidates_by_partial_hash(args, scan_stats, ref_stats, plan)
+    assert [f['name'] for f in scan_candidates] == ["same.bin"]
+    assert [f['name'] for f in ref_candidates] == ["same.bin"]
+
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    assert len(duplicates) == 1
+
+
+def test_most_valuable_batches_first():
+    groups = {(100, None, None): {'scan': [{'size': 100}], 'ref': [{'size': 100}]},
+              (10, None, None): {'scan': [{'size': 10}] * 20, 'ref': [{'size': 10}]},
+              (50, None, None): {'scan': [{'size': 50}], 'ref': [{'size': 50}]}}
+    batches = list(iter_candidate_batches(dict(groups), 1))
+    assert [batch[0][0]['size'] for batch in batches] == [10, 50, 100]  # by size
+    batches = list(iter_candidate_batches(dict(groups), 1, most_valuable_first=True))
+    assert [batch[0][0]['size'] for batch in batches] == [10, 100, 50]  # by potential bytes reclaimed
+
+
+def test_budget_of_plans():
+    plan = {'scan': {'estimated_seconds': 1.0, 'bytes_to_read': 100, 'sample_bytes': 0},
+            'ref': {'estimated_seconds': 2.0, 'bytes_to_read': 50, 'sample_bytes': 0},
+            'prefilter_bytes': 0, 'concurrent': False}
+    assert HashingBudget.get_plan_cost(plan) == (3.0, 150)
+    assert HashingBudget.get_plan_cost(dict(plan, concurrent=True)) == (2.0, 150)
+    assert HashingBudget.get_plan_cost(dict(plan, prefilter_bytes=20)) == (3.0, 170)
+
+    budget = HashingBudget(max_bytes_read=200)
+    assert budget.allows(plan)
+    budget.charge(plan)
+    assert not budget.allows(plan)
+    assert budget.exhausted_by == 'max_bytes_read'
+    empty_side = {'estimated_seconds': 0, 'bytes_to_read': 0, 'sample_bytes': 0}
+    empty_plan = {'scan': empty_side, 'ref': empty_side, 'prefilter_bytes': 0, 'concurrent': False}
+    assert not budget.allows(empty_plan)
+    assert not HashingBudget(max_runtime=2.0).allows(plan)
+
+    # the samples read to measure the devices are charged too
+    sampled_plan = dict(empty_plan, scan=dict(empty_side, sample_bytes=150))
+    budget = HashingBudget(max_bytes_read=200)
+    assert budget.allows(sampled_plan) and budget.bytes_read == 150
+    assert not budget.allows(plan)
+
+
+def test_budget_defers_batches_to_next_run(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(1, 6))
+    job_dir = os.path.join(TEMP_DIR, "job")
+
+    # the first run reads nothing - every batch is deferred, and the coverage is reported
+    args = parse_arguments(common_args + ["--batch_files", "2", "--max_bytes_read", "1B", "--job", job_dir])
+    setup_job_state(args)
+    counts = {}
+    assert process_duplicate_batches(args, iter_duplicate_batches(args, scan_dir, reference_dir, counts)) == (0, 0, 0)
+    assert counts['deferred_batches'] == 5 and counts['batches'] == 0
+    assert counts['deferred_candidates'] == 10 and counts['deferred_bytes'] == counts['candidate_bytes']
+    assert get_coverage_string(args, counts).startswith("0 of 10 candidates (0%), 0% of the bytes to reclaim")
+    assert set(os.listdir(scan_dir)) == {f"{i}.jpg" for i in range(1, 6)}
+
+    # the next run continues the job with a larger budget
+    JobState.reset_instance()
+    args = parse_arguments(common_args + ["--batch_files", "2", "--max_runtime", "1h", "--resume", job_dir])
+    setup_job_state(args)
+    counts = {}
+    assert process_duplicate_batches(args, iter_duplicate_batches(args, scan_dir, reference_dir, counts))[0] == 5
+    assert counts['deferred_batches'] == 0 and counts['batches'] == 5
+    assert get_coverage_string(args, counts) == "10 of 10 candidates (100%), 100% of the bytes to reclaim"
+    assert not os.listdir(scan_dir)
+
+
+def test_device_measured_once(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 4), range(1, 4))
+    args = parse_arguments(common_args)
+    scan_stats = FileManager.get_files_and_stats(scan_dir)
+    collector = MetricsCollector()
+
+    measured = []
+    original_measure_device = hashing_planner.measure_device
+    monkeypatch.setattr(hashing_planner, 'measure_device',
+                        lambda file_infos, cached_paths: measured.append(1) or original_measure_device(file_infos,
+                                                                                                      cached_paths))
+    plan = plan_hashing(args, scan_dir, reference_dir, scan_stats, [])
+    assert plan['scan']['sample_bytes'] == sum(min(f['size'], hashing_planner.SAMPLE_BYTES) for f in scan_stats)
+    assert collector.counters['files_opened'] == 3
+    assert collector.counters['bytes_read'] == plan['scan']['sample_bytes']
+
+    # the next batches on the device reuse the measure
+    plan = plan_hashing(args, scan_dir, reference_dir, scan_stats, [])
+    assert len(measured) == 1 and plan['scan']['sample_bytes'] == 0
+    assert collector.counters['files_opened'] == 3
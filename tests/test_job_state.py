@@ -0,0 +1,152 @@
+from duplicate_files_in_folders.duplicates_finder import iter_duplicate_batches, process_duplicate_batches
+from duplicate_files_in_folders.file_executor import FileOperationsExecutor
+from duplicate_files_in_folders.file_manager import FileManager
+from duplicate_files_in_folders.initializer import setup_job_state
+from duplicate_files_in_folders.job_state import JobState, JobStateError
+from duplicate_files_in_folders.utils import parse_arguments
+from tests.helpers_testing import *
+
+
+def count_files(folder):
+    return sum(len(files) for _, _, files in os.walk(folder))
+
+
+def test_resume_interrupted_job(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(1, 6))
+    job_dir = os.path.join(TEMP_DIR, "job")
+
+    # the job is interrupted after its first batch
+    args = parse_arguments(common_args + ["--batch_files", "2", "--job", job_dir], False)
+    setup_job_state(args)
+
+    def interrupted(batches):
+        yield next(batches)
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        process_duplicate_batches(args, interrupted(iter_duplicate_batches(args, scan_dir, reference_dir)))
+    assert count_files(move_to_dir) == 1
+    assert JobState.get_instance().completed_batches == {0}
+
+    # a job with the same folder can't be started again, only resumed - with the same arguments
+    with pytest.raises(SystemExit):
+        parse_arguments(common_args + ["--job", job_dir], False)
+    JobState.reset_instance()
+    with pytest.raises(JobStateError):
+        JobState(job_dir, parse_arguments(common_args + ["--batch_files", "3", "--resume", job_dir], False),
+                 resume=True)
+
+    # the resumed job doesn't walk the folders and skips the completed batch
+    JobState.reset_instance()
+    args = parse_arguments(common_args + ["--batch_files", "2", "--resume", job_dir], False)
+    setup_job_state(args)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("a resumed job must not walk the folders")
+
+    monkeypatch.setattr(FileManager, 'iter_files_and_stats', fail)
+    counts = {}
+    files_moved, files_created, duplicate_scan_files_moved = process_duplicate_batches(
+        args, iter_duplicate_batches(args, scan_dir, reference_dir, counts, background=True))
+    assert files_moved == 4
+    assert counts['skipped_batches'] == 1 and counts['batches'] == 4
+    assert counts['scan_files'] == 5 and counts['ref_files'] == 5
+    assert count_files(move_to_dir) == 5
+    assert count_files(scan_dir) == 0
+
+
+def test_journal_prevents_double_moves(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 4), [])
+    job_dir = os.path.join(TEMP_DIR, "job")
+    args = parse_arguments(common_args + ["--job", job_dir], False)
+    setup_job_state(args)
+
+    executor = FileOperationsExecutor()
+    for i in range(1, 3):
+        executor.add('move', os.path.join(scan_dir, f"{i}.jpg"), os.path.join(move_to_dir, f"{i}.jpg"))
+    executor.run()
+
+    # the process stopped right after moving 3.jpg, before journaling it as done
+    src, dst = os.path.join(scan_dir, "3.jpg"), os.path.join(move_to_dir, "3.jpg")
+    JobState.get_instance().action_started({'operation': 'move', 'src': FileManager.resolve_path(src),
+                                            'requested': dst, 'dst': FileManager.resolve_path(dst), 'size': 1})
+    os.rename(src, dst)
+
+    JobState.reset_instance()
+    job = setup_job_state(parse_arguments(common_args + ["--resume", job_dir], False))
+    executor = FileOperationsExecutor()
+    for i in range(1, 4):
+        # the moves are done - the destinations are not renamed to free names, and the files are not moved again
+        assert executor.add('move', os.path.join(scan_dir, f"{i}.jpg"), os.path.join(move_to_dir, f"{i}.jpg")) == \
+            FileManager.resolve_path(os.path.join(move_to_dir, f"{i}.jpg"))
+    assert executor.run()['moved'] == 0
+    assert executor.skipped == 3 and job.skipped_actions == 3
+    assert sorted(os.listdir(move_to_dir)) == ["1.jpg", "2.jpg", "3.jpg"]
+
+    # test mode doesn't journal
+    FileManager.reset_file_manager([reference_dir], [scan_dir, move_to_dir], run_mode=False)
+    setup_test_files([4], [])
+    executor = FileOperationsExecutor()
+    executor.add('move', os.path.join(scan_dir, "4.jpg"), os.path.join(move_to_dir, "4.jpg"))
+    executor.run()
+    assert not job.is_action_done('move', FileManager.resolve_path(os.path.join(scan_dir, "4.jpg")),
+                                  os.path.join(move_to_dir, "4.jpg"))
+
+
+def test_resume_job_with_relative_modified_time(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 3), range(1, 3))
+    job_dir = os.path.join(TEMP_DIR, "job")
+    args = parse_arguments(common_args + ["--modified_after", "30d", "--job", job_dir])
+    setup_job_state(args)
+    modified_after = args.modified_after
+
+    # 30d is resolved to another time in every run - the job compares the option, and resumes with its own cutoff
+    JobState.reset_instance()
+    args = parse_arguments(common_args + ["--modified_after", "30d", "--resume", job_dir])
+    setup_job_state(args)
+    assert args.modified_after == modified_after
+
+    # a different window is reported as a usage error
+    JobState.reset_instance()
+    with pytest.raises(SystemExit):
+        parse_arguments(common_args + ["--modified_after", "20d", "--resume", job_dir])
+
+
+def test_resume_job_interrupted_inside_batch(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(1, 6))
+    job_dir = os.path.join(TEMP_DIR, "job")
+
+    # the job is interrupted after the first move of its only batch
+    args = parse_arguments(common_args + ["--move_workers", "1", "--job", job_dir], False)
+    setup_job_state(args)
+    original_move_file = FileManager.move_file
+    moves = []
+
+    def move_file(self, *move_args, **kwargs):
+        if moves:
+            raise KeyboardInterrupt
+        moves.append(1)
+        return original_move_file(self, *move_args, **kwargs)
+
+    monkeypatch.setattr(FileManager, 'move_file', move_file)
+    with pytest.raises(KeyboardInterrupt):
+        process_duplicate_batches(args, iter_duplicate_batches(args, scan_dir, reference_dir))
+    monkeypatch.undo()
+    assert count_files(move_to_dir) == 1 and not JobState.get_instance().completed_batches
+
+    # a new process - the hashes of the interrupted batch were not saved. The moved file is not hashed again, and
+    # the other files are moved
+    JobState.reset_instance()
+    HashManager.reset_instance()
+    HashManager(reference_dir=reference_dir, filename=None)
+    args = parse_arguments(common_args + ["--move_workers", "1", "--resume", job_dir], False)
+    setup_job_state(args)
+    files_moved, files_created, duplicate_scan_files_moved = process_duplicate_batches(
+        args, iter_duplicate_batches(args, scan_dir, reference_dir))
+    assert files_moved == 4
+    assert count_files(move_to_dir) == 5
+    assert count_files(scan_dir) == 0
@@ -0,0 +1,107 @@
+import cProfile
+import json
+import pstats
+import tracemalloc
+
+from df_finder3 import main
+from duplicate_files_in_folders.metrics import MetricsCollector
+from duplicate_files_in_folders.profiler import RunProfiler, get_collapsed_stacks
+from duplicate_files_in_folders.utils import parse_arguments
+from tests.helpers_testing import *
+
+
+def test_metrics_of_stages():
+    # without a collector, the stages and counters do nothing
+    items = [1, 2, 3]
+    assert MetricsCollector.iter_stage('walk', items) is items
+    with MetricsCollector.stage('walk'):
+        MetricsCollector.count('bytes_read', 10)
+
+    metrics = MetricsCollector()
+    try:
+        with MetricsCollector.stage('actions'):
+            MetricsCollector.count('file_operations')
+            with MetricsCollector.stage('save'):  # a nested stage is not counted in its parent
+                MetricsCollector.count('file_operations', 2)
+        assert list(MetricsCollector.iter_stage('walk', range(25), chunk_size=10)) == list(range(25))
+        report = metrics.get_report()
+        assert report['stages']['actions']['file_operations'] == 1
+        assert report['stages']['save']['file_operations'] == 2
+        assert report['stages']['walk']['calls'] == 3
+        assert report['total']['file_operations'] == 3
+        assert report['stages']['actions']['wall_seconds'] >= report['stages']['save']['wall_seconds'] >= 0
+    finally:
+        MetricsCollector.reset_instance()
+
+
+def test_metrics_json(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(3, 8))
+    metrics_file = os.path.join(TEMP_DIR, "metrics.json")
+
+    main(parse_arguments(common_args + ["--metrics_json", metrics_file]))
+    assert set(os.listdir(move_to_dir)) == {f"{i}.jpg" for i in range(3, 6)}
+
+    with open(metrics_file, encoding='utf-8') as f:
+        report = json.load(f)
+    stages = report['stages']
+    assert {'walk', 'candidate_join', 'keys_scan', 'keys_ref', 'actions', 'save'} <= set(stages)
+    assert stages['walk']['stat_calls'] == 10
+    assert stages['keys_scan']['files_opened'] + stages['keys_ref']['files_opened'] > 0
+    assert stages['keys_scan']['bytes_read'] > 0
+    assert stages['actions']['file_operations'] >= 3
+
+    with pytest.raises(SystemExit):  # not in the folders that are walked
+        parse_arguments(common_args + ["--metrics_json", os.path.join(scan_dir, "metrics.json")])
+
+
+def test_profile(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(3, 8))
+    profile_dir = os.path.join(TEMP_DIR, "profile")
+
+    main(parse_arguments(common_args + ["--profile", profile_dir, "--profile_memory"]))
+    assert set(os.listdir(move_to_dir)) == {f"{i}.jpg" for i in range(3, 6)}
+    assert not tracemalloc.is_tracing()  # stopped when the profile is saved
+
+    files = set(os.listdir(profile_dir))
+    for stage in ['run', 'walk', 'keys_scan', 'actions']:
+        assert {f"{stage}.pstats", f"{stage}.collapsed.txt"} <= files
+    assert 'memory.txt' in files and 'keys_scan.tracemalloc' in files
+    stats = pstats.Stats(os.path.join(profile_dir, "keys_scan.pstats"))
+    assert any(func[2] == 'compute_partial_hash' for func in stats.stats)
+
+    # each line is a stack of frames and a number of microseconds, starting with the stage in the run stacks
+    with open(os.path.join(profile_dir, "run.collapsed.txt"), encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert lines
+    for line in lines:
+        stack, value = line.rsplit(' ', 1)
+        assert int(value) > 0
+        assert stack.split(';')[0] in {'walk', 'candidate_join', 'keys_scan', 'keys_ref', 'actions', 'save'}
+    assert any('compute_partial_hash' in line for line in lines)
+
+    with pytest.raises(SystemExit):
+        parse_arguments(common_args + ["--profile_memory"])
+
+
+def test_collapsed_stacks():
+    def leaf():
+        return sum(range(20000))
+
+    def branch():
+        return leaf() + leaf()
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    branch()
+    leaf()
+    profiler.disable()
+    stacks = get_collapsed_stacks(pstats.Stats(profiler))
+    branch_stacks = [stack for stack in stacks if stack.startswith('branch') and 'leaf' in stack]
+    root_stacks = [stack for stack in stacks if stack.startswith('leaf')]
+    assert branch_stacks and root_stacks
+    # leaf() was called twice from branch() and once without it - its time is split the same way
+    branch_time = sum(stacks[stack] for stack in branch_stacks)
+    root_time = sum(stacks[stack] for stack in root_stacks)
+    assert branch_time > root_time
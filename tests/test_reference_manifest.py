@@ -0,0 +1,203 @@
+from df_finder3 import main
+from duplicate_files_in_folders.duplicates_finder import find_duplicates_files_v3, process_duplicates
+from duplicate_files_in_folders.file_manager import FileManager
+from duplicate_files_in_folders.reference_manifest import export_reference_manifest, load_reference_manifest, \
+    get_manifest_file_path, read_manifest_header, load_checksum_file
+from duplicate_files_in_folders.utils import parse_arguments
+from tests.helpers_testing import *
+
+
+def test_compute_digests(setup_teardown):
+    scan_dir, _, _, _ = setup_teardown
+    file_path = os.path.join(scan_dir, "big_file.bin")
+    with open(file_path, 'wb') as f:
+        f.write(os.urandom(3 * 1024 * 1024 + 17))  # bigger than the partial hash size
+
+    digests = HashManager.compute_digests(file_path)
+    assert digests['partial'] == HashManager.compute_partial_hash(file_path)
+    hash_manager = HashManager.get_instance()
+    hash_manager.full_hash = True
+    assert digests['full'] == hash_manager.compute_hash(file_path)
+    hash_manager.full_hash = False
+
+
+def test_export_and_load_manifest(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([], range(1, 4))
+    setup_test_files([], range(4, 6), subfolder="sub1")
+
+    args = parse_arguments(["--reference_dir", reference_dir, "--move_to", move_to_dir, "--action",
+                            "export_manifest"])
+    manifest_file = get_manifest_file_path(args)
+    assert export_reference_manifest(args, reference_dir, manifest_file) == 5
+    assert read_manifest_header(manifest_file)['root'] == os.path.abspath(reference_dir)
+
+    root, files_stats = load_reference_manifest(manifest_file)
+    assert root == os.path.abspath(reference_dir)
+    ref_stats = {file_info['path']: file_info for file_info in FileManager.get_files_and_stats(reference_dir)}
+    assert set(file_info['path'] for file_info in files_stats) == set(ref_stats.keys())
+    for file_info in files_stats:
+        assert file_info['size'] == ref_stats[file_info['path']]['size']
+        assert file_info['modified_time'] == ref_stats[file_info['path']]['modified_time']
+        assert file_info['partial_hash'] == HashManager.compute_partial_hash(file_info['path'])
+
+    # paths can be rebased on another root
+    _, files_stats = load_reference_manifest(manifest_file, os.path.join(TEMP_DIR, "other_root"))
+    assert all(file_info['path'].startswith(os.path.join(TEMP_DIR, "other_root")) for file_info in files_stats)
+
+
+def test_move_duplicates_with_offline_reference(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(1, 4))
+    setup_test_files([], range(4, 6), subfolder="sub1")
+
+    args = parse_arguments(["--reference_dir", reference_dir, "--move_to", move_to_dir, "--action",
+                            "export_manifest"])
+    manifest_file = os.path.join(TEMP_DIR, "manifest.jsonl.gz")
+    export_reference_manifest(args, reference_dir, manifest_file)
+
+    # take the reference folder offline
+    shutil.rmtree(reference_dir)
+
+    args = parse_arguments(["--scan", scan_dir, "--reference_manifest", manifest_file, "--move_to", move_to_dir,
+                            "--run"])
+    assert args.reference_dir == os.path.abspath(reference_dir)
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, args.reference_dir)
+    assert len(duplicates) == 5
+    assert len(ref_stats) == 5
+
+    files_moved, files_created = process_duplicates(duplicates, args)
+    assert files_moved == 5 and files_created == 0
+    assert os.path.exists(os.path.join(move_to_dir, "1.jpg"))
+    assert os.path.exists(os.path.join(move_to_dir, "sub1", "4.jpg"))
+    assert not FileManager.get_files_and_stats(scan_dir)
+
+
+def test_export_manifest_main(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([], range(1, 4))
+
+    args = parse_arguments(["--reference_dir", reference_dir, "--move_to", move_to_dir, "--action",
+                            "export_manifest"])
+    main(args)
+    _, files_stats = load_reference_manifest(get_manifest_file_path(args))
+    assert len(files_stats) == 3
+
+
+def test_parse_arguments_with_manifest(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+
+    # scan_dir is required for all actions but export_manifest
+    with pytest.raises(SystemExit):
+        parse_arguments(["--reference_dir", reference_dir, "--move_to", move_to_dir], False)
+
+    # reference_dir is required if there is no reference manifest
+    with pytest.raises(SystemExit):
+        parse_arguments(["--scan_dir", scan_dir, "--move_to", move_to_dir], False)
+
+    # the manifest file must exist
+    with pytest.raises(SystemExit):
+        parse_arguments(["--scan_dir", scan_dir, "--move_to", move_to_dir, "--reference_manifest",
+                         os.path.join(TEMP_DIR, "non_existing.jsonl.gz")])
+
+    # a manifest cannot be exported from a manifest
+    with pytest.raises(SystemExit):
+        parse_arguments(["--reference_dir", reference_dir, "--move_to", move_to_dir, "--action", "export_manifest",
+                         "--reference_manifest", os.path.join(TEMP_DIR, "manifest.jsonl.gz")], False)
+
+
+def write_checksum_file(checksum_file, reference_dir, algorithm, line_format):
+    reference_files = sorted(FileManager.get_files_and_stats(reference_dir), key=lambda x: x['path'])
+    with open(checksum_file, 'w') as f:
+        for file_info in reference_files:
+            relative_path = os.path.relpath(file_info['path'], reference_dir)
+            digest = HashManager.compute_checksum(file_info['path'], algorithm)
+            f.write(line_format.format(digest=digest, path=relative_path, abs_path=file_info['path'],
+                                       size=file_info['size']) + '\n')
+
+
+def test_parse_checksum_files(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([], range(1, 4))
+    checksum_file = os.path.join(TEMP_DIR, "CHECKSUMS")
+
+    formats = [('sha256', "{digest}  {path}"),  # sha256sum
+               ('sha256', "{digest} *{path}"),  # sha256sum binary mode
+               ('md5', "MD5 ({path}) = {digest}"),  # BSD style
+               ('md5', "{size:>10}  {digest}  {abs_path}")]  # md5deep -z
+    for algorithm, line_format in formats:
+        write_checksum_file(checksum_file, reference_dir, algorithm, line_format)
+        loaded_algorithm, files_stats = load_checksum_file(checksum_file, reference_dir)
+        assert loaded_algorithm == algorithm
+        assert len(files_stats) == 3
+        for file_info in files_stats:
+            assert file_info['checksum'] == HashManager.compute_checksum(file_info['path'], algorithm)
+
+    # hashdeep
+    checksum_file = os.path.join(reference_dir, "CHECKSUMS")
+    with open(checksum_file, 'w') as f:
+        f.write("%%%% HASHDEEP-1.0\n%%%% size,md5,sha256,filename\n## Invoked from: /tmp\n")
+        for file_info in FileManager.get_files_and_stats(reference_dir):
+            if file_info['name'] == "CHECKSUMS":
+                continue
+            f.write(f"{file_info['size']},{HashManager.compute_checksum(file_info['path'], 'md5')},"
+                    f"{HashManager.compute_checksum(file_info['path'], 'sha256')},{file_info['path']}\n")
+    loaded_algorithm, files_stats = load_checksum_file(checksum_file)  # the root is the folder of the checksum file
+    assert loaded_algorithm == 'sha256'
+    assert len(files_stats) == 3
+    assert all(file_info['checksum'] for file_info in files_stats)
+
+
+def test_checksums_of_changed_files_are_not_trusted(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([], range(1, 4))
+    checksum_file = os.path.join(TEMP_DIR, "SHA256SUMS")
+    write_checksum_file(checksum_file, reference_dir, 'sha256', "{digest}  {path}")
+
+    # 1.jpg is modified after the checksum file was created, 3.jpg is missing
+    future_time = os.stat(checksum_file).st_mtime + 60
+    os.utime(os.path.join(reference_dir, "1.jpg"), (future_time, future_time))
+    os.remove(os.path.join(reference_dir, "3.jpg"))
+
+    _, files_stats = load_checksum_file(checksum_file, reference_dir)
+    checksums = {file_info['name']: file_info['checksum'] for file_info in files_stats}
+    assert set(checksums.keys()) == {"1.jpg", "2.jpg"}
+    assert checksums["1.jpg"] is None
+    assert checksums["2.jpg"] is not None
+
+
+def test_find_duplicates_with_reference_checksums(setup_teardown, monkeypatch):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 6), range(1, 4))
+    setup_test_files([], range(4, 6), subfolder="sub1")
+    checksum_file = os.path.join(reference_dir, "MD5SUMS")
+    write_checksum_file(checksum_file, reference_dir, 'md5', "{digest}  {path}")
+
+    files_read = []
+    original_compute_checksum = HashManager.compute_checksum
+    monkeypatch.setattr(HashManager, 'compute_checksum', lambda file_path, algorithm: files_read.append(
+        file_path) or original_compute_checksum(file_path, algorithm))
+
+    args = parse_arguments(["--scan", scan_dir, "--reference_checksums", checksum_file, "--move_to", move_to_dir,
+                            "--run", "--ignore_diff", "mdate,filename"])
+    assert args.reference_dir == os.path.abspath(reference_dir)
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, args.reference_dir)
+    assert len(duplicates) == 5
+    assert len(ref_stats) == 5  # the checksum file itself is not a reference file
+    assert files_read and all(file_path.startswith(scan_dir) for file_path in files_read)
+
+
+def test_sha256_checksums_are_added_to_hash_cache(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files([], range(1, 4))
+    checksum_file = os.path.join(TEMP_DIR, "SHA256SUMS")
+    write_checksum_file(checksum_file, reference_dir, 'sha256', "{digest}  {path}")
+
+    HashManager.reset_instance()
+    hash_manager = HashManager(reference_dir=reference_dir, filename=None, full_hash=True)
+    load_checksum_file(checksum_file, reference_dir)
+    cached_hashes = {item['file_path']: item['hash_value']
+                     for item in hash_manager.get_hashes_by_folder(reference_dir)}
+    assert len(cached_hashes) == 3
+    for file_path, hash_value in cached_hashes.items():
+        assert hash_manager.compute_hash(file_path) == hash_value
@@ -0,0 +1,87 @@
+import csv
+import gzip
+import json
+
+from duplicate_files_in_folders.duplicates_finder import find_duplicates_files_v3, create_csv_file
+from duplicate_files_in_folders.report_writer import create_report_sink, get_report_extension
+from duplicate_files_in_folders.utils import parse_arguments
+from tests.helpers_testing import *
+
+
+def get_groups(count, files_per_group=3):
+    return [{'scan': [{'path': f"/scan/{i}_{j}.jpg", 'size': i, 'modified_time': 1000000000.5}
+                      for j in range(files_per_group - 1)],
+             'ref': [{'path': f"/ref/{i}.jpg", 'size': i, 'modified_time': 1000000000.5}]} for i in range(count)]
+
+
+def test_report_formats(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+
+    path = os.path.join(move_to_dir, "report" + get_report_extension('csv'))
+    with create_report_sink('csv', path) as sink:
+        for group in get_groups(2):
+            sink.write_group(group)
+    assert sink.paths == [path]
+    with open(path, newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['key', 'path', 'size', 'modified_time']
+    assert len(rows) == 7
+    assert rows[1][:3] == ['1', '/scan/0_0.jpg', '0'] and rows[6][:3] == ['2', '/ref/1.jpg', '1']
+
+    path = os.path.join(move_to_dir, "report" + get_report_extension('jsonl', compress=True))
+    assert path.endswith(".jsonl.gz")
+    with create_report_sink('jsonl', path, compress=True) as sink:
+        for group in get_groups(2):
+            sink.write_group(group)
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 6
+    assert records[2] == {'key': 1, 'path': '/ref/0.jpg', 'size': 0, 'modified_time': rows[1][3]}
+
+    # an empty report still has its header
+    path = os.path.join(move_to_dir, "empty.csv")
+    create_report_sink('csv', path).close()
+    with open(path, encoding='utf-8') as f:
+        assert f.read().strip() == 'key,path,size,modified_time'
+
+
+def test_report_sharding(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    path = os.path.join(move_to_dir, "report.csv.gz")
+    # groups of 3 rows, shards of at least 4 rows - groups are never split, so each shard has 2 groups
+    with create_report_sink('csv', path, compress=True, shard_rows=4) as sink:
+        for group in get_groups(5):
+            sink.write_group(group)
+    assert [os.path.basename(p) for p in sink.paths] == \
+        ["report_part0001.csv.gz", "report_part0002.csv.gz", "report_part0003.csv.gz"]
+    keys = []
+    for shard in sink.paths:
+        with gzip.open(shard, 'rt', encoding='utf-8', newline='') as f:
+            keys.append([row[0] for row in list(csv.reader(f))[1:]])
+    assert keys == [['1'] * 3 + ['2'] * 3, ['3'] * 3 + ['4'] * 3, ['5'] * 3]
+
+
+def test_report_parquet(setup_teardown):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    path = os.path.join(move_to_dir, "report.parquet")
+    with create_report_sink('parquet', path) as sink:
+        for group in get_groups(3):
+            sink.write_group(group)
+    table = pyarrow_parquet.read_table(path)
+    assert table.num_rows == 9
+    assert table.column('key').to_pylist() == [1, 1, 1, 2, 2, 2, 3, 3, 3]
+
+
+def test_create_csv_file_formats(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 4), range(1, 4))
+    test_cases = [([], ["scan_dups.csv"]),
+                  (["--report_format", "jsonl", "--report_gzip"], ["scan_dups.jsonl.gz"]),
+                  (["--report_shard_rows", "2"], [f"scan_dups_part000{i}.csv" for i in range(1, 4)])]
+    for extra_args, expected_files in test_cases:
+        args = parse_arguments(common_args + ["--action", "create_csv", "--ignore_diff", "mdate"] + extra_args)
+        duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+        assert len(duplicates) == 3
+        report_files = create_csv_file(args, duplicates)
+        assert [os.path.basename(path) for path in report_files] == expected_files
@@ -0,0 +1,151 @@
+import time
+
+from duplicate_files_in_folders.duplicates_finder import find_duplicates_files_v3
+from duplicate_files_in_folders.file_filter import FileFilter
+from duplicate_files_in_folders.file_manager import FileManager
+from duplicate_files_in_folders.initializer import setup_tree_snapshot
+from duplicate_files_in_folders.tree_snapshot import TreeSnapshot
+from duplicate_files_in_folders.utils import parse_arguments
+from tests.helpers_testing import *
+
+
+def sorted_by_path(files_stats):
+    return sorted(files_stats, key=lambda x: x['path'])
+
+
+def set_mtime_in_past(*paths):
+    """ Move the modification time of folders out of the racy window, so the snapshot trusts it. """
+    past_time = time.time() - 60
+    for path in paths:
+        os.utime(path, (past_time, past_time))
+
+
+@pytest.fixture
+def tree_snapshot(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    for sub_path in ["sub1", os.path.join("sub1", "sub1"), "sub2"]:
+        os.makedirs(os.path.join(reference_dir, sub_path))
+        copy_files(range(1, 4), os.path.join(reference_dir, sub_path))
+    copy_files(range(4, 6), reference_dir)
+    set_mtime_in_past(reference_dir, *[os.path.join(reference_dir, sub_path)
+                                       for sub_path in ["sub1", os.path.join("sub1", "sub1"), "sub2"]])
+    snapshot_file = os.path.join(TEMP_DIR, "ref_snapshot.pkl")
+    yield TreeSnapshot(reference_dir=reference_dir, filename=snapshot_file), reference_dir, snapshot_file
+    TreeSnapshot.reset_instance()
+
+
+def test_unchanged_folders_are_reused(tree_snapshot):
+    snapshot, reference_dir, _ = tree_snapshot
+
+    first_walk = snapshot.get_files_and_stats(reference_dir)
+    assert sorted_by_path(first_walk) == sorted_by_path(FileManager.get_files_and_stats(reference_dir))
+    assert snapshot.rescanned_dirs == 4 and snapshot.reused_dirs == 0
+
+    second_walk = snapshot.get_files_and_stats(reference_dir)
+    assert sorted_by_path(second_walk) == sorted_by_path(first_walk)
+    assert snapshot.rescanned_dirs == 0 and snapshot.reused_dirs == 4
+
+
+def test_changed_folders_are_rescanned(tree_snapshot):
+    snapshot, reference_dir, _ = tree_snapshot
+    snapshot.get_files_and_stats(reference_dir)
+
+    # add a file to sub1/sub1 and remove a file from sub2
+    copy_files([6], os.path.join(reference_dir, "sub1", "sub1"))
+    os.remove(os.path.join(reference_dir, "sub2", "1.jpg"))
+
+    result = snapshot.get_files_and_stats(reference_dir)
+    assert sorted_by_path(result) == sorted_by_path(FileManager.get_files_and_stats(reference_dir))
+    assert snapshot.rescanned_dirs == 2 and snapshot.reused_dirs == 2
+
+    # recently changed folders are always re-scanned, as more changes may happen within the same timestamp tick
+    result = snapshot.get_files_and_stats(reference_dir)
+    assert sorted_by_path(result) == sorted_by_path(FileManager.get_files_and_stats(reference_dir))
+    assert snapshot.rescanned_dirs == 2 and snapshot.reused_dirs == 2
+
+
+def test_full_rescan(tree_snapshot):
+    snapshot, reference_dir, _ = tree_snapshot
+    snapshot.get_files_and_stats(reference_dir)
+    result = snapshot.get_files_and_stats(reference_dir, full_rescan=True)
+    assert sorted_by_path(result) == sorted_by_path(FileManager.get_files_and_stats(reference_dir))
+    assert snapshot.rescanned_dirs == 4 and snapshot.reused_dirs == 0
+
+
+def test_snapshot_with_file_filter(tree_snapshot):
+    snapshot, reference_dir, _ = tree_snapshot
+    result = snapshot.get_files_and_stats(reference_dir, file_filter=FileFilter(include=['1.*']))
+    assert sorted(os.path.relpath(file_info['path'], reference_dir) for file_info in result) == \
+        [os.path.join("sub1", "1.jpg"), os.path.join("sub1", "sub1", "1.jpg"), os.path.join("sub2", "1.jpg")]
+
+    # the file filters are not pushed down into the snapshot, so it can be reused with other filters
+    result = snapshot.get_files_and_stats(reference_dir, file_filter=FileFilter(exclude_dir=['sub2']))
+    assert sorted_by_path(result) == sorted_by_path(
+        FileManager.get_files_and_stats(reference_dir, file_filter=FileFilter(exclude_dir=['sub2'])))
+    assert snapshot.rescanned_dirs == 0 and snapshot.reused_dirs == 3
+
+
+def test_save_and_load_snapshot(tree_snapshot):
+    snapshot, reference_dir, snapshot_file = tree_snapshot
+    first_walk = snapshot.get_files_and_stats(reference_dir)
+    snapshot.save_data()
+    assert os.path.exists(snapshot_file)
+
+    TreeSnapshot.reset_instance()
+    snapshot = TreeSnapshot(reference_dir=reference_dir, filename=snapshot_file)
+    result = snapshot.get_files_and_stats(reference_dir)
+    assert sorted_by_path(result) == sorted_by_path(first_walk)
+    assert snapshot.rescanned_dirs == 0 and snapshot.reused_dirs == 4
+
+
+def test_find_duplicates_with_tree_snapshot(tree_snapshot):
+    snapshot, reference_dir, _ = tree_snapshot
+    scan_dir = os.path.join(TEMP_DIR, SCAN_DIR_NAME)
+    move_to_dir = os.path.join(TEMP_DIR, "move_to")
+    copy_files(range(1, 4), scan_dir)
+
+    args = parse_arguments(["--scan", scan_dir, "--reference_dir", reference_dir, "--move_to", move_to_dir,
+                            "--ignore_diff", "mdate,filename"])
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    assert len(duplicates) == 3
+    assert len(ref_stats) == 11
+    assert snapshot.rescanned_dirs == 4
+
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    assert len(duplicates) == 3
+    assert len(ref_stats) == 11
+    assert snapshot.reused_dirs == 4
+
+    args = parse_arguments(["--scan", scan_dir, "--reference_dir", reference_dir, "--move_to", move_to_dir,
+                            "--ignore_diff", "mdate,filename", "--ref_snapshot", "--full_rescan"])
+    duplicates, scan_stats, ref_stats = find_duplicates_files_v3(args, scan_dir, reference_dir)
+    assert len(duplicates) == 3
+    assert snapshot.rescanned_dirs == 4
+
+
+def test_snapshot_only_when_asked(setup_teardown):
+    scan_dir, reference_dir, move_to_dir, common_args = setup_teardown
+    setup_test_files(range(1, 3), range(1, 3))
+
+    # by default the reference folder is streamed, without a snapshot
+    assert setup_tree_snapshot(parse_arguments(common_args)) is None
+    assert not TreeSnapshot.is_initialized()
+    with pytest.raises(SystemExit):
+        parse_arguments(common_args + ["--full_rescan"])
+
+    assert setup_tree_snapshot(parse_arguments(common_args + ["--ref_snapshot"])) is TreeSnapshot.get_instance()
+    TreeSnapshot.reset_instance()
+
+
+@pytest.mark.skipif(os.name == 'nt', reason="Symlinks need privileges on Windows")
+def test_snapshot_keeps_the_given_root(tree_snapshot):
+    snapshot, reference_dir, _ = tree_snapshot
+    link_dir = os.path.join(TEMP_DIR, "ref_link")
+    os.symlink(reference_dir, link_dir)
+
+    # the same paths as the walks of the FileManager - under the symlink, not the folder it points to
+    expected = sorted(f['path'] for f in FileManager.get_files_and_stats(link_dir))
+    assert all(path.startswith(link_dir + os.sep) for path in expected)
+    assert sorted(f['path'] for f in snapshot.get_files_and_stats(link_dir)) == expected
+    TreeSnapshot.reset_instance()
+    assert TreeSnapshot(reference_dir=link_dir, filename=None).reference_dir == link_dir